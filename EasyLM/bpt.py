@@ -59,10 +59,13 @@ def blockwise_attn(
         precision=None,
         float32_logits=True,
         prevent_cse=True,
+        segment_ids=None,
     ):
     # query, key, value: (batch, seq_len, num_heads, dim_per_head)
     # bias: (batch, seq_len) can be used to mask out attention (e.g. padding)
     # causal: whether to use causal mask
+    # segment_ids: (batch, seq_len) document ids of packed sequences, tokens
+    #   only attend to tokens with the same segment id
     # policy: one of jax.checkpoint_policies
     query = query / jnp.sqrt(query.shape[-1]).astype(dtype)
     if float32_logits:
@@ -94,7 +97,7 @@ def blockwise_attn(
 
     _chunk_bias_fn = functools.partial(
         _chunk_attention_bias,
-        query_chunk_size, key_chunk_size, bias, deterministic,
+        query_chunk_size, key_chunk_size, bias, segment_ids, deterministic,
         attn_dropout, attn_pdrop, causal, dtype)
 
     def scan_attention(args):
@@ -160,7 +163,7 @@ class Carry(NamedTuple):
 
 
 def _chunk_attention_bias(query_chunk_size, key_chunk_size,
-            bias, deterministic, attn_dropout, attn_pdrop, causal,
+            bias, segment_ids, deterministic, attn_dropout, attn_pdrop, causal,
             dtype, query_chunk_idx, key_chunk_idx):
     query_offset = query_chunk_idx * query_chunk_size
     key_offset = key_chunk_idx * key_chunk_size
@@ -172,6 +175,19 @@ def _chunk_attention_bias(query_chunk_size, key_chunk_size,
             slice_sizes=(*bias.shape[:2], min(bias.shape[-2], query_chunk_size), min(bias.shape[-1], key_chunk_size)),
         )
 
+    if segment_ids is not None:
+        batch = segment_ids.shape[0]
+        query_segment_ids = lax.dynamic_slice(
+            segment_ids, start_indices=(0, query_offset), slice_sizes=(batch, query_chunk_size)
+        )
+        key_segment_ids = lax.dynamic_slice(
+            segment_ids, start_indices=(0, key_offset), slice_sizes=(batch, key_chunk_size)
+        )
+        segment_mask_value = (
+            query_segment_ids[:, :, None] != key_segment_ids[:, None, :]
+        ) * jnp.finfo(dtype).min
+        chunk_bias += segment_mask_value.reshape(batch, 1, query_chunk_size, key_chunk_size)
+
     if causal:
         query_idx = lax.broadcasted_iota(dtype=jnp.int32, shape=(query_chunk_size, 1), dimension=0)
         key_idx = lax.broadcasted_iota(dtype=jnp.int32, shape=(1, key_chunk_size), dimension=1)
@@ -1,17 +1,220 @@
 import os
+import json
+import hashlib
+import shutil
+import time
+import uuid
+from collections import deque, namedtuple
+from functools import partial, lru_cache
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 from ml_collections import ConfigDict
 import mlxu
 import jax
 import jax.numpy as jnp
+from jax.experimental import multihost_utils
+from jax.experimental.pjit import pjit
+from jax.interpreters import pxla
+from jax.sharding import PartitionSpec as PS
+from jax.sharding import NamedSharding
 import flax
 from flax.serialization import (
     from_bytes, to_bytes, to_state_dict, from_state_dict
 )
 from flax.traverse_util import flatten_dict, unflatten_dict, empty_node
+import fsspec
 import msgpack
 
-from EasyLM.jax_utils import tree_apply, float_tensor_to_dtype
+from EasyLM.jax_utils import tree_apply, float_tensor_to_dtype, broadcast_string
+
+
+SHARDED_CHECKPOINT_INDEX = 'index.json'
+DISTRIBUTED_CHECKPOINT_MANIFEST = 'manifest.json'
+STREAMING_CHECKPOINT_INDEX_SUFFIX = '.index.json'
+
+
+def parallel_map(fn, items, num_threads, max_pending=None):
+    """ Apply fn to items in a thread pool and yield the results in order.
+        At most max_pending results are held at a time, which bounds the
+        host memory used when fn reads or produces large tensors.
+    """
+    if max_pending is None:
+        max_pending = 2 * num_threads
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        pending = deque()
+        for item in items:
+            pending.append(executor.submit(fn, item))
+            if len(pending) >= max_pending:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def file_exists(path):
+    try:
+        with mlxu.open_file(path, 'rb'):
+            return True
+    except OSError:
+        return False
+
+
+def get_file_size(path):
+    with mlxu.open_file(path, 'rb') as fin:
+        fin.seek(0, os.SEEK_END)
+        return fin.tell()
+
+
+def remove_file(path):
+    """ Remove a local or remote file if it exists. """
+    if '://' in path:
+        fs, _ = fsspec.core.url_to_fs(path)
+        if fs.exists(path):
+            fs.rm(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+def move_path(src, dst):
+    """ Move a local or remote file or directory, replacing dst. """
+    if '://' in dst:
+        fs, _ = fsspec.core.url_to_fs(dst)
+        if fs.exists(dst):
+            fs.rm(dst, recursive=True)
+        fs.mv(src, dst, recursive=True)
+    else:
+        if os.path.isdir(dst):
+            shutil.rmtree(dst)
+        os.replace(src, dst)
+
+
+def tensor_hash(value):
+    value = np.ascontiguousarray(value)
+    return hashlib.blake2b(
+        value.reshape(-1).view(np.uint8).data, digest_size=16
+    ).hexdigest()
+
+
+def get_delta_dtype_by_name(dtype):
+    return jnp.dtype({
+        'bf16': 'bfloat16',
+        'fp16': 'float16',
+        'fp8': 'float8_e4m3fn',
+    }[dtype])
+
+
+QuantizedTensor = namedtuple(
+    'QuantizedTensor', ['values', 'scales', 'block_size', 'dtype']
+)
+
+
+def quantize_blocks(value, quantization, block_size):
+    """ Quantize a tensor to int8 or fp8 in blocks of block_size along the
+        last axis, with one float32 scale per block. If the last dimension is
+        not divisible by block_size, every row is a single block.
+    """
+    last_dim = value.shape[-1]
+    if last_dim % block_size != 0:
+        block_size = last_dim
+    blocks = value.astype(np.float32).reshape(
+        value.shape[:-1] + (last_dim // block_size, block_size)
+    )
+    if quantization == 'int8':
+        dtype = np.dtype(np.int8)
+        max_value = 127.0
+    elif quantization == 'fp8':
+        dtype = jnp.dtype('float8_e4m3fn')
+        max_value = float(jnp.finfo(dtype).max)
+    else:
+        raise ValueError(f'Unknown quantization: {quantization}')
+    absmax = np.max(np.abs(blocks), axis=-1, keepdims=True)
+    scales = np.where(absmax > 0, absmax / max_value, 1.0).astype(np.float32)
+    values = blocks / scales
+    if quantization == 'int8':
+        values = np.clip(np.round(values), -max_value, max_value)
+    return QuantizedTensor(
+        values.astype(dtype).reshape(value.shape), scales[..., 0],
+        block_size, value.dtype.name,
+    )
+
+
+def dequantize_blocks(values, scales, block_size, dtype):
+    """ Inverse of quantize_blocks, works on both numpy and jax arrays. """
+    shape = values.shape
+    blocks = values.astype(np.float32).reshape(
+        shape[:-1] + (shape[-1] // block_size, block_size)
+    )
+    return (blocks * scales[..., None]).reshape(shape).astype(jnp.dtype(dtype))
+
+
+@lru_cache(maxsize=None)
+def get_sharded_dequantize_fn(partition_spec, block_size, dtype):
+    """ Dequantize on devices, producing the output directly in the target
+        sharding. Quantized values come in with the same sharding, while the
+        small scales are replicated.
+    """
+    return pjit(
+        partial(dequantize_blocks, block_size=block_size, dtype=dtype),
+        in_shardings=(partition_spec, PS()),
+        out_shardings=partition_spec,
+    )
+
+
+def compress_bytes(data, compression):
+    if compression == 'zstd':
+        import zstandard
+        return zstandard.ZstdCompressor().compress(data)
+    elif compression == 'lz4':
+        import lz4.frame
+        return lz4.frame.compress(data)
+    raise ValueError(f'Unknown compression: {compression}')
+
+
+def decompress_bytes(data, compression):
+    if compression == 'zstd':
+        import zstandard
+        return zstandard.ZstdDecompressor().decompress(data)
+    elif compression == 'lz4':
+        import lz4.frame
+        return lz4.frame.decompress(data)
+    raise ValueError(f'Unknown compression: {compression}')
+
+
+def encode_partition_spec(partition_spec):
+    return [list(x) if isinstance(x, tuple) else x for x in partition_spec]
+
+
+def decode_partition_spec(encoded):
+    return PS(*[tuple(x) if isinstance(x, list) else x for x in encoded])
+
+
+def normalize_region(index, shape):
+    """ Convert a tuple of slices into a tuple of (start, stop) pairs. """
+    index = tuple(index) + (slice(None),) * (len(shape) - len(index))
+    return tuple(tuple(s.indices(dim)[:2]) for s, dim in zip(index, shape))
+
+
+def regions_overlap(a, b):
+    return all(max(a0, b0) < min(a1, b1) for (a0, a1), (b0, b1) in zip(a, b))
+
+
+def assemble_region(region, pieces, dtype):
+    """ Assemble the given region of a global tensor from saved pieces,
+        each of which is a (region, array) pair.
+    """
+    output = np.empty([stop - start for start, stop in region], dtype=dtype)
+    for piece_region, data in pieces:
+        if not regions_overlap(region, piece_region):
+            continue
+        overlap = [
+            (max(a0, b0), min(a1, b1))
+            for (a0, a1), (b0, b1) in zip(region, piece_region)
+        ]
+        output[tuple(
+            slice(start - r0, stop - r0) for (start, stop), (r0, _) in zip(overlap, region)
+        )] = data[tuple(
+            slice(start - p0, stop - p0) for (start, stop), (p0, _) in zip(overlap, piece_region)
+        )]
+    return output
 
 
 class StreamingCheckpointer(object):
@@ -25,6 +228,32 @@ class StreamingCheckpointer(object):
         config = ConfigDict()
         config.float_dtype = 'bf16'
         config.save_optimizer_state = False
+        # 'streaming' writes a single msgpack file, 'sharded' writes a
+        # directory of tensor files plus a json index, 'distributed' has
+        # every process write the shards on its local devices
+        config.format = 'streaming'
+        config.shard_size_mb = 1024
+        config.io_threads = 8
+        # Copy the train state to host memory and write it in a background
+        # thread, with at most max_pending_saves saves in flight.
+        config.async_save = False
+        config.max_pending_saves = 1
+        # Sharded checkpoints only: path of a sharded base checkpoint, or
+        # 'last_milestone'. Tensors identical to the base are referenced
+        # instead of written, and with delta_dtype set, changed float tensors
+        # are stored as scaled low precision deltas against the base.
+        config.delta_base = ''
+        config.delta_dtype = ''
+        # With delta_base set to 'last_milestone', every milestone after
+        # delta_full_save_freq delta milestones in a row is saved in full,
+        # which bounds the chain of checkpoints a delta depends on.
+        config.delta_full_save_freq = 10
+        # Sharded checkpoints only: per tensor 'zstd' or 'lz4' compression,
+        # and 'int8' or 'fp8' block-wise quantization of float matrices,
+        # which is lossy and meant for serving checkpoints.
+        config.compression = ''
+        config.quantization = ''
+        config.quantization_block_size = 128
 
         if updates is not None:
             config.update(ConfigDict(updates).copy_and_resolve_references())
@@ -34,8 +263,75 @@ class StreamingCheckpointer(object):
         self.config = self.get_default_config(config)
         self.checkpoint_dir = checkpoint_dir
         self.enable = enable
+        self._save_executor = None
+        self._pending_saves = deque()
+        self._blocking_time = 0.0
+        self._last_milestone_path = None
+        self._last_milestone_save = None
+        self._milestone_deltas = 0
+        if (self.config.delta_base != '' or self.config.compression != ''
+                or self.config.quantization != ''):
+            assert self.config.format == 'sharded', (
+                'Delta, compressed and quantized checkpoints require the sharded format'
+            )
+        if self.config.format == 'distributed':
+            # Every process writes to the output directory of process 0
+            self.checkpoint_dir = broadcast_string(checkpoint_dir)
 
     def save_checkpoint(self, train_state, filename, gather_fns=None):
+        self._save(train_state, filename, gather_fns)
+
+    def _save(self, train_state, filename, gather_fns=None, pickles=()):
+        """ Save a checkpoint along with (object, filename) pickles, either
+            in this thread or in the background when async_save is enabled.
+        """
+        start_time = time.time()
+        if self.config.async_save:
+            # Wait for a free slot before taking another host memory snapshot
+            self._wait_for_pending_saves(self.config.max_pending_saves - 1)
+            write_checkpoint = self._snapshot_checkpoint(train_state, filename, gather_fns)
+
+            def write_all():
+                if write_checkpoint is not None:
+                    write_checkpoint()
+                # Pickles are written after the checkpoint, so that dataset
+                # and metadata never refer to a checkpoint that is missing.
+                for obj, pickle_filename in pickles:
+                    self.save_pickle(obj, pickle_filename)
+
+            if self._save_executor is None:
+                self._save_executor = ThreadPoolExecutor(max_workers=1)
+            self._pending_saves.append(self._save_executor.submit(write_all))
+        else:
+            self._save_checkpoint_now(train_state, filename, gather_fns)
+            for obj, pickle_filename in pickles:
+                self.save_pickle(obj, pickle_filename)
+        self._blocking_time = time.time() - start_time
+
+    def _save_checkpoint_now(self, train_state, filename, gather_fns=None):
+        if self.config.format == 'distributed':
+            # Gather functions are not needed, each process writes its own
+            # shards of the train state directly from device memory.
+            self.save_train_state_distributed(
+                train_state, os.path.join(self.checkpoint_dir, filename),
+                self.config.float_dtype,
+                shard_size=self.config.shard_size_mb * 1024 * 1024,
+                io_threads=self.config.io_threads,
+            )
+            return
+        if self.config.format == 'sharded':
+            # Non-writing processes still run the gather functions, since
+            # they may contain collectives across hosts.
+            self.save_train_state_to_dir(
+                train_state,
+                os.path.join(self.checkpoint_dir, filename) if self.enable else None,
+                gather_fns, self.config.float_dtype,
+                shard_size=self.config.shard_size_mb * 1024 * 1024,
+                io_threads=self.config.io_threads,
+                **self._sharded_kwargs(),
+            )
+            return
+        assert self.config.format == 'streaming', f'Unknown checkpoint format: {self.config.format}'
         if self.enable:
             path = os.path.join(self.checkpoint_dir, filename)
         else:
@@ -44,20 +340,479 @@ class StreamingCheckpointer(object):
             train_state, path, gather_fns, self.config.float_dtype
         )
 
+    def _snapshot_checkpoint(self, train_state, filename, gather_fns=None):
+        """ Copy the train state to host memory and return a function that
+            writes the copy to disk, or None if this process writes nothing.
+            Only the copy happens in the calling thread, so all collectives
+            are still issued in the same order on every host.
+        """
+        path = os.path.join(self.checkpoint_dir, filename)
+        shard_size = self.config.shard_size_mb * 1024 * 1024
+        sharded_kwargs = self._sharded_kwargs()
+        base_save = None
+        if self.config.delta_base == 'last_milestone':
+            base_save = self._last_milestone_save
+        flattend_train_state = flatten_dict(to_state_dict(train_state))
+        if self.config.format == 'distributed':
+            # Process 0 waits for the indices of all processes to appear
+            # before writing the manifest, without a device barrier.
+            return partial(
+                self._write_distributed, path,
+                list(self._distributed_local_pieces(flattend_train_state, self.config.float_dtype)),
+                self._distributed_manifest(flattend_train_state),
+                shard_size, self.config.io_threads, synchronize=False,
+            )
+
+        if gather_fns is not None:
+            gather_fns = flatten_dict(to_state_dict(gather_fns))
+        snapshot = {}
+        for key, value in flattend_train_state.items():
+            if gather_fns is not None:
+                value = gather_fns[key](value)
+            else:
+                value = jax.device_get(value)
+            if self.enable:
+                snapshot[key] = np.asarray(
+                    float_tensor_to_dtype(value, self.config.float_dtype)
+                )
+        if not self.enable:
+            return None
+        snapshot = unflatten_dict(snapshot)
+
+        def write():
+            # Checkpoints are written to a temporary path and moved into
+            # place, so a crash never leaves a partial checkpoint. Remote
+            # sharded checkpoints are written in place, since moving them
+            # copies every file, and rely on their index being written last.
+            if base_save is not None:
+                # The base milestone must be complete before its index is read
+                base_save.result()
+            if self.config.format == 'sharded':
+                index_path = os.path.join(path, SHARDED_CHECKPOINT_INDEX)
+            else:
+                index_path = path + STREAMING_CHECKPOINT_INDEX_SUFFIX
+            # Never leave a stale index next to the new checkpoint
+            remove_file(index_path)
+            if self.config.format == 'sharded' and '://' in path:
+                self.save_train_state_to_dir(
+                    snapshot, path, shard_size=shard_size,
+                    io_threads=self.config.io_threads, **sharded_kwargs,
+                )
+                return
+            tmp_path = path + '.tmp'
+            if self.config.format == 'sharded':
+                self.save_train_state_to_dir(
+                    snapshot, tmp_path, shard_size=shard_size,
+                    io_threads=self.config.io_threads, **sharded_kwargs,
+                )
+                move_path(tmp_path, path)
+            else:
+                self.save_train_state_to_file(snapshot, tmp_path)
+                move_path(tmp_path, path)
+                move_path(tmp_path + STREAMING_CHECKPOINT_INDEX_SUFFIX, index_path)
+        return write
+
+    def _sharded_kwargs(self):
+        if self.config.delta_base == 'last_milestone':
+            base_path = self._last_milestone_path
+        else:
+            base_path = self.config.delta_base or None
+        return dict(
+            base_path=base_path,
+            delta_dtype=self.config.delta_dtype or None,
+            compression=self.config.compression or None,
+            quantization=self.config.quantization or None,
+            quantization_block_size=self.config.quantization_block_size,
+        )
+
+    def _wait_for_pending_saves(self, max_pending=0):
+        while len(self._pending_saves) > 0 and (
+            self._pending_saves[0].done() or len(self._pending_saves) > max_pending
+        ):
+            # Raises any exception from the background save
+            self._pending_saves.popleft().result()
+
+    def wait_for_saves(self):
+        """ Block until all background saves have finished. """
+        self._wait_for_pending_saves(0)
+
+    @property
+    def metrics(self):
+        return {
+            'checkpoint_blocking_time': self._blocking_time,
+            'checkpoint_pending_saves': sum(not x.done() for x in self._pending_saves),
+        }
+
     @staticmethod
     def save_train_state_to_file(train_state, path, gather_fns=None, float_dtype=None):
+        """ Save the train state in the streaming format, along with an index
+            sidecar file recording the key, shape, dtype and byte range of
+            every record, so that tensors can be listed or read selectively.
+        """
         train_state = to_state_dict(train_state)
         packer = msgpack.Packer()
         flattend_train_state = flatten_dict(train_state)
         if gather_fns is not None:
             gather_fns = flatten_dict(to_state_dict(gather_fns))
 
+        if path != '/dev/null':
+            # An index left over from a previous checkpoint at this path must
+            # never be used with the new data.
+            remove_file(path + STREAMING_CHECKPOINT_INDEX_SUFFIX)
+
+        tensors = []
+        offset = 0
         with mlxu.open_file(path, "wb") as fout:
             for key, value in flattend_train_state.items():
                 if gather_fns is not None:
                     value = gather_fns[key](value)
                 value = float_tensor_to_dtype(value, float_dtype)
-                fout.write(packer.pack((key, to_bytes(value))))
+                record = packer.pack((key, to_bytes(value)))
+                fout.write(record)
+                tensors.append({
+                    'key': list(key),
+                    'offset': offset,
+                    'nbytes': len(record),
+                    'shape': list(np.shape(value)),
+                    'dtype': np.dtype(value.dtype if hasattr(value, 'dtype') else np.asarray(value).dtype).name,
+                })
+                offset += len(record)
+
+        if path != '/dev/null':
+            with mlxu.open_file(path + STREAMING_CHECKPOINT_INDEX_SUFFIX, 'w') as fout:
+                json.dump({
+                    'format': 'streaming', 'total_nbytes': offset, 'tensors': tensors
+                }, fout)
+
+    @staticmethod
+    def _write_tensor_file(path, tensors, alignment=4096):
+        """ Write raw tensor bytes back to back into a single file. Takes a
+            list of (entry, tensor) pairs and returns the entries completed
+            with where each tensor lives in the file. Tensors start on page
+            boundaries, so that they can be memory mapped in place. Entries
+            with a None tensor refer to data elsewhere and are kept as is.
+        """
+        filename = os.path.basename(path)
+        entries = [entry for entry, value in tensors if value is None]
+        tensors = [(entry, value) for entry, value in tensors if value is not None]
+        if len(tensors) == 0:
+            return entries
+        offset = 0
+        with mlxu.open_file(path, 'wb') as fout:
+            for entry, value in tensors:
+                padding = -offset % alignment
+                if padding > 0:
+                    fout.write(b'\0' * padding)
+                    offset += padding
+                value = np.ascontiguousarray(value)
+                fout.write(value.reshape(-1).view(np.uint8).data)
+                entries.append({
+                    **entry,
+                    'file': filename,
+                    'offset': offset,
+                    'nbytes': value.nbytes,
+                    'shape': entry.get('shape', list(value.shape)),
+                    'dtype': entry.get('dtype', value.dtype.name),
+                })
+                offset += value.nbytes
+        return entries
+
+    @classmethod
+    def _encode_against_base(cls, entry, value, base_entry=None, delta_dtype=None):
+        """ Return the (entry, tensor) pair to write for a tensor given the
+            matching entry of the base checkpoint, if any. """
+        entry['hash'] = tensor_hash(value)
+        if base_entry is None or list(value.shape) != base_entry['shape']:
+            return entry, value
+        if (base_entry.get('hash') == entry['hash']
+                and base_entry.get('target_dtype', base_entry['dtype']) == value.dtype.name):
+            # Unchanged, refer to the data of the base checkpoint
+            return {**base_entry, 'key': entry['key']}, None
+        if delta_dtype is None or not jnp.issubdtype(value.dtype, jnp.floating):
+            return entry, value
+        delta = value.astype(np.float32) - cls.read_sharded_tensor(
+            None, base_entry
+        ).astype(np.float32)
+        # Scale the delta to the full range of the delta dtype, so that
+        # small updates do not underflow in fp8 or fp16.
+        delta_dtype = get_delta_dtype_by_name(delta_dtype)
+        max_value = float(jnp.finfo(delta_dtype).max)
+        absmax = float(np.max(np.abs(delta))) if delta.size > 0 else 0.0
+        scale = absmax / max_value if absmax > 0 else 1.0
+        entry.update({
+            'encoding': 'delta',
+            'delta_of': base_entry,
+            'delta_scale': scale,
+            'target_dtype': value.dtype.name,
+        })
+        return entry, np.clip(delta / scale, -max_value, max_value).astype(delta_dtype)
+
+    @staticmethod
+    def _encode_storage(entry, value, quantization=None, block_size=128,
+                        compression=None):
+        """ Apply quantization and compression to a tensor to be written.
+            The entry keeps the stored shape and dtype, since the written
+            bytes no longer describe them.
+        """
+        if value is None:
+            return entry, value
+        if (quantization is not None and 'encoding' not in entry
+                and value.ndim >= 2 and value.size > 0
+                and jnp.issubdtype(value.dtype, jnp.floating)):
+            quantized = quantize_blocks(value, quantization, block_size)
+            entry.update({
+                'encoding': 'quantized',
+                'shape': list(value.shape),
+                'dtype': quantized.values.dtype.name,
+                'target_dtype': quantized.dtype,
+                'block_size': quantized.block_size,
+                'scales_offset': quantized.values.nbytes,
+            })
+            value = np.concatenate([
+                quantized.values.reshape(-1).view(np.uint8),
+                quantized.scales.reshape(-1).view(np.uint8),
+            ])
+        if compression is not None:
+            value = np.ascontiguousarray(value)
+            entry.setdefault('shape', list(value.shape))
+            entry.setdefault('dtype', value.dtype.name)
+            entry['compression'] = compression
+            value = np.frombuffer(
+                compress_bytes(value.reshape(-1).view(np.uint8).data, compression),
+                dtype=np.uint8,
+            )
+        return entry, value
+
+    @classmethod
+    def save_train_state_to_dir(cls, train_state, path, gather_fns=None,
+                                float_dtype=None, shard_size=1024 ** 3,
+                                io_threads=8, base_path=None, delta_dtype=None,
+                                compression=None, quantization=None,
+                                quantization_block_size=128):
+        """ Save the train state in the sharded format. Tensors are gathered
+            one by one, grouped into files of roughly shard_size bytes, and the
+            files are written concurrently by a thread pool. The index file is
+            written last, so its presence marks a complete checkpoint. If path
+            is None, the tensors are gathered but nothing is written.
+
+            Every tensor is stored with its content hash. Given a sharded base
+            checkpoint, tensors with the same hash as in the base are not
+            written again, and with delta_dtype, other float tensors are
+            stored as deltas against the base.
+        """
+        train_state = to_state_dict(train_state)
+        flattend_train_state = flatten_dict(train_state)
+        if gather_fns is not None:
+            gather_fns = flatten_dict(to_state_dict(gather_fns))
+
+        def gathered_groups():
+            group, group_size = [], 0
+            for key, value in flattend_train_state.items():
+                if gather_fns is not None:
+                    value = gather_fns[key](value)
+                value = np.asarray(float_tensor_to_dtype(value, float_dtype))
+                if path is None:
+                    continue
+                group.append(({'key': list(key)}, value))
+                group_size += value.nbytes
+                if group_size >= shard_size:
+                    yield group
+                    group, group_size = [], 0
+            if len(group) > 0:
+                yield group
+
+        if path is None:
+            for _ in gathered_groups():
+                pass
+            return
+
+        if '://' not in path:
+            os.makedirs(path, exist_ok=True)
+        # When overwriting a checkpoint, its index must not outlive the
+        # tensor files that are about to be replaced.
+        remove_file(os.path.join(path, SHARDED_CHECKPOINT_INDEX))
+
+        base_entries = {}
+        if base_path is not None:
+            for entry in cls.load_sharded_index(base_path)['tensors']:
+                entry.setdefault('base', base_path)
+                base_entries[tuple(entry['key'])] = entry
+
+        def write_group(indexed_group):
+            index, group = indexed_group
+            group = [
+                cls._encode_storage(
+                    *cls._encode_against_base(
+                        entry, value, base_entries.get(tuple(entry['key'])), delta_dtype
+                    ),
+                    quantization, quantization_block_size, compression,
+                )
+                for entry, value in group
+            ]
+            return cls._write_tensor_file(
+                os.path.join(path, f'tensors_{index:05d}.bin'), group
+            )
+
+        # Gathering happens in this thread, in the same order on every host,
+        # while previously gathered groups are written in the background.
+        tensors = []
+        for entries in parallel_map(
+            write_group, enumerate(gathered_groups()),
+            num_threads=io_threads, max_pending=io_threads
+        ):
+            tensors.extend(entries)
+
+        with mlxu.open_file(os.path.join(path, SHARDED_CHECKPOINT_INDEX), 'w') as fout:
+            json.dump({'format': 'sharded', 'tensors': tensors}, fout)
+
+    @staticmethod
+    def _local_shards(value):
+        """ Yield the (region, array) pairs of a tensor that this process is
+            responsible for saving. Replicated shards are saved only once.
+        """
+        if isinstance(value, jax.Array):
+            for shard in value.addressable_shards:
+                if shard.replica_id == 0:
+                    yield (
+                        normalize_region(shard.index, value.shape),
+                        jax.device_get(shard.data),
+                    )
+        elif jax.process_index() == 0:
+            value = np.asarray(value)
+            yield normalize_region((), value.shape), value
+
+    @classmethod
+    def _distributed_local_pieces(cls, flattend_train_state, float_dtype=None):
+        for key, value in flattend_train_state.items():
+            for region, data in cls._local_shards(value):
+                yield key, region, np.asarray(float_tensor_to_dtype(data, float_dtype))
+
+    @staticmethod
+    def _distributed_manifest(flattend_train_state):
+        tensors = []
+        for key, value in flattend_train_state.items():
+            sharding = getattr(value, 'sharding', None)
+            if isinstance(sharding, NamedSharding):
+                partition_spec = sharding.spec
+            else:
+                partition_spec = PS()
+            tensors.append({
+                'key': list(key),
+                'shape': list(np.shape(value)),
+                'partition_spec': encode_partition_spec(partition_spec),
+            })
+        mesh = pxla.thread_resources.env.physical_mesh
+        return {
+            'format': 'distributed',
+            # Identifies the host indices written by the same save
+            'save_id': broadcast_string(uuid.uuid4().hex),
+            'num_processes': jax.process_count(),
+            'mesh': {
+                'axis_names': list(mesh.axis_names),
+                'shape': [mesh.shape[name] for name in mesh.axis_names],
+            },
+            'tensors': tensors,
+        }
+
+    @staticmethod
+    def _host_index_path(path, process_index):
+        return os.path.join(path, f'host_{process_index:05d}.json')
+
+    @classmethod
+    def _load_host_index(cls, path, process_index, save_id=None):
+        """ Load the index written by a process, or return None if it is
+            missing or belongs to a different save than save_id.
+        """
+        host_index_path = cls._host_index_path(path, process_index)
+        if not file_exists(host_index_path):
+            return None
+        with mlxu.open_file(host_index_path, 'r') as fin:
+            host_index = json.load(fin)
+        if save_id is not None and host_index.get('save_id') != save_id:
+            return None
+        return host_index
+
+    @classmethod
+    def _wait_for_host_indices(cls, path, manifest, poll_interval=1.0):
+        """ Wait until every process has written its index for this save.
+            Used instead of a device barrier by background saves, which must
+            not issue collectives outside of the main thread.
+        """
+        remaining = set(range(manifest['num_processes']))
+        while True:
+            remaining = {
+                i for i in remaining
+                if cls._load_host_index(path, i, manifest['save_id']) is None
+            }
+            if len(remaining) == 0:
+                return
+            time.sleep(poll_interval)
+
+    @classmethod
+    def _write_distributed(cls, path, pieces, manifest, shard_size=1024 ** 3,
+                           io_threads=8, synchronize=True):
+        process_index = jax.process_index()
+        if process_index == 0:
+            # The checkpoint being overwritten is no longer complete
+            remove_file(os.path.join(path, DISTRIBUTED_CHECKPOINT_MANIFEST))
+
+        def local_groups():
+            group, group_size = [], 0
+            for key, region, data in pieces:
+                group.append(({'key': list(key), 'region': region}, data))
+                group_size += data.nbytes
+                if group_size >= shard_size:
+                    yield group
+                    group, group_size = [], 0
+            if len(group) > 0:
+                yield group
+
+        if '://' not in path:
+            os.makedirs(path, exist_ok=True)
+
+        def write_group(indexed_group):
+            index, group = indexed_group
+            return cls._write_tensor_file(
+                os.path.join(path, f'host_{process_index:05d}_tensors_{index:05d}.bin'),
+                group
+            )
+
+        entries = []
+        for group_entries in parallel_map(
+            write_group, enumerate(local_groups()),
+            num_threads=io_threads, max_pending=io_threads
+        ):
+            entries.extend(group_entries)
+        with mlxu.open_file(cls._host_index_path(path, process_index), 'w') as fout:
+            json.dump({'save_id': manifest['save_id'], 'tensors': entries}, fout)
+
+        if synchronize:
+            multihost_utils.sync_global_devices(f'distributed_checkpoint_{path}')
+        elif process_index == 0:
+            cls._wait_for_host_indices(path, manifest)
+        if process_index == 0:
+            with mlxu.open_file(os.path.join(path, DISTRIBUTED_CHECKPOINT_MANIFEST), 'w') as fout:
+                json.dump(manifest, fout)
+        if synchronize:
+            multihost_utils.sync_global_devices(f'distributed_checkpoint_manifest_{path}')
+
+    @classmethod
+    def save_train_state_distributed(cls, train_state, path, float_dtype=None,
+                                     shard_size=1024 ** 3, io_threads=8):
+        """ Save the train state in the distributed format. Every process
+            writes the shards of each tensor that live on its local devices,
+            together with an index of their regions in the global tensor, so
+            no tensor is ever gathered to a single host. Once all processes
+            are done, process 0 writes a manifest of the global shapes and
+            partition specs, which marks the checkpoint as complete.
+        """
+        flattend_train_state = flatten_dict(to_state_dict(train_state))
+        cls._write_distributed(
+            path,
+            cls._distributed_local_pieces(flattend_train_state, float_dtype),
+            cls._distributed_manifest(flattend_train_state),
+            shard_size, io_threads,
+        )
 
     def save_pickle(self, obj, filename):
         if self.enable:
@@ -82,46 +837,278 @@ class StreamingCheckpointer(object):
             checkpoint_name = 'value_' + checkpoint_name
 
         if milestone:
+            if (self.config.delta_base == 'last_milestone'
+                    and self.config.delta_full_save_freq > 0
+                    and self._milestone_deltas >= self.config.delta_full_save_freq):
+                # Save this milestone in full to start a new chain of deltas
+                self._last_milestone_path = None
+            full_save = self._last_milestone_path is None
             # Save a milestone checkpoint that will not be overwritten
-            self.save_pickle(metadata, f'metadata_{step}.pkl')
-            self.save_pickle(dataset, f'dataset_{step}.pkl')
-            self.save_checkpoint(
-                checkpoint_state, f'{checkpoint_name}_{step}', checkpoint_gather_fns
+            self._save(
+                checkpoint_state, f'{checkpoint_name}_{step}', checkpoint_gather_fns,
+                pickles=[(metadata, f'metadata_{step}.pkl'), (dataset, f'dataset_{step}.pkl')],
+            )
+            self._milestone_deltas = 0 if full_save else self._milestone_deltas + 1
+            # Milestones are never overwritten, so later deltas can refer to them
+            self._last_milestone_path = os.path.join(
+                self.checkpoint_dir, f'{checkpoint_name}_{step}'
+            )
+            self._last_milestone_save = (
+                self._pending_saves[-1] if self.config.async_save else None
             )
         else:
             # Save a normal checkpoint that can be overwritten
-            self.save_pickle(metadata, 'metadata.pkl')
-            self.save_pickle(dataset, 'dataset.pkl')
-            self.save_checkpoint(
-                checkpoint_state, f'{checkpoint_name}', checkpoint_gather_fns
+            self._save(
+                checkpoint_state, f'{checkpoint_name}', checkpoint_gather_fns,
+                pickles=[(metadata, 'metadata.pkl'), (dataset, 'dataset.pkl')],
             )
 
     @staticmethod
-    def load_checkpoint(path, target=None, shard_fns=None, remove_dict_prefix=None, keys_to_ignore=None):
-        if shard_fns is not None:
-            shard_fns = flatten_dict(
-                to_state_dict(shard_fns)
+    def _filter_key(key, remove_dict_prefix=None, keys_to_ignore=None):
+        """ Return the key to restore a saved tensor under, or None if the
+            tensor should be skipped.
+        """
+        key = tuple(key)
+        if keys_to_ignore is not None and key in keys_to_ignore:
+            return None
+        if remove_dict_prefix is not None:
+            if key[:len(remove_dict_prefix)] == remove_dict_prefix:
+                key = key[len(remove_dict_prefix):]
+            else:
+                return None
+        return key
+
+    @staticmethod
+    def is_sharded_checkpoint(path):
+        return file_exists(os.path.join(path, SHARDED_CHECKPOINT_INDEX))
+
+    @staticmethod
+    def is_distributed_checkpoint(path):
+        return file_exists(os.path.join(path, DISTRIBUTED_CHECKPOINT_MANIFEST))
+
+    @staticmethod
+    def load_streaming_index(path):
+        """ Load the index sidecar of a streaming checkpoint, or return None
+            for checkpoints saved without one. """
+        index_path = path + STREAMING_CHECKPOINT_INDEX_SUFFIX
+        if not file_exists(index_path):
+            return None
+        with mlxu.open_file(index_path, 'r') as fin:
+            index = json.load(fin)
+        if index.get('total_nbytes') != get_file_size(path):
+            # The index does not describe this checkpoint, for example after
+            # the checkpoint was overwritten without it, so decode sequentially.
+            return None
+        return index
+
+    @classmethod
+    def load_checkpoint_index(cls, path):
+        """ List the key, shape and dtype of every tensor in a checkpoint of
+            any format without reading tensor data. Returns None for streaming
+            checkpoints saved without an index.
+        """
+        if cls.is_distributed_checkpoint(path):
+            with mlxu.open_file(os.path.join(path, DISTRIBUTED_CHECKPOINT_MANIFEST), 'r') as fin:
+                manifest = json.load(fin)
+            dtypes = {}
+            for host_index in cls._load_host_indices(path, manifest):
+                for entry in host_index['tensors']:
+                    dtypes[tuple(entry['key'])] = entry['dtype']
+            return [
+                {
+                    'key': tuple(x['key']),
+                    'shape': x['shape'],
+                    'dtype': dtypes.get(tuple(x['key'])),
+                    'partition_spec': x['partition_spec'],
+                }
+                for x in manifest['tensors']
+            ]
+        if cls.is_sharded_checkpoint(path):
+            index = cls.load_sharded_index(path)
+        else:
+            index = cls.load_streaming_index(path)
+            if index is None:
+                return None
+        return [
+            {
+                'key': tuple(x['key']),
+                'shape': x['shape'],
+                'dtype': x.get('target_dtype', x['dtype']),
+                'nbytes': x['nbytes'],
+            }
+            for x in index['tensors']
+        ]
+
+    @classmethod
+    def _load_host_indices(cls, path, manifest, io_threads=8):
+        host_indices = list(parallel_map(
+            lambda i: cls._load_host_index(path, i, manifest.get('save_id')),
+            range(manifest['num_processes']), num_threads=io_threads,
+        ))
+        missing = [i for i, x in enumerate(host_indices) if x is None]
+        assert len(missing) == 0, (
+            f'Distributed checkpoint {path} is incomplete, the indices of '
+            f'processes {missing} are missing or from a different save'
+        )
+        return host_indices
+
+    @staticmethod
+    def load_sharded_index(path):
+        with mlxu.open_file(os.path.join(path, SHARDED_CHECKPOINT_INDEX), 'r') as fin:
+            return json.load(fin)
+
+    @classmethod
+    def read_sharded_tensor(cls, path, entry, use_mmap=False, dequantize=True):
+        """ Read a tensor of a sharded checkpoint. Entries referring to a
+            base checkpoint are read from there, and deltas are added back
+            onto the base tensor. Quantized tensors are returned as a
+            QuantizedTensor if dequantize is False.
+        """
+        path = entry.get('base', path)
+        if entry.get('encoding') == 'delta':
+            base = cls.read_sharded_tensor(path, entry['delta_of'])
+            delta = cls._read_raw_tensor(path, entry)
+            value = base.astype(np.float32) + delta.astype(np.float32) * entry['delta_scale']
+            return value.astype(jnp.dtype(entry['target_dtype']))
+        if entry.get('encoding') == 'quantized':
+            data = cls._read_tensor_bytes(path, entry, use_mmap)
+            offset = entry['scales_offset']
+            quantized = QuantizedTensor(
+                data[:offset].view(jnp.dtype(entry['dtype'])).reshape(entry['shape']),
+                data[offset:].view(np.float32).reshape(entry['shape'][:-1] + [-1]),
+                entry['block_size'], entry['target_dtype'],
+            )
+            if dequantize:
+                return dequantize_blocks(*quantized)
+            return quantized
+        return cls._read_raw_tensor(path, entry, use_mmap)
+
+    @staticmethod
+    def _read_tensor_bytes(path, entry, use_mmap=False):
+        filename = os.path.join(path, entry['file'])
+        if (use_mmap and '://' not in filename and entry['nbytes'] > 0
+                and 'compression' not in entry):
+            # Pages are only read from disk when the tensor is transferred to
+            # devices, and never copied into process memory.
+            return np.memmap(
+                filename, dtype=np.uint8, mode='r', offset=entry['offset'],
+                shape=(entry['nbytes'],)
             )
+        with mlxu.open_file(filename, 'rb') as fin:
+            fin.seek(entry['offset'])
+            data = fin.read(entry['nbytes'])
+        if 'compression' in entry:
+            data = decompress_bytes(data, entry['compression'])
+        return np.frombuffer(data, dtype=np.uint8)
+
+    @classmethod
+    def _read_raw_tensor(cls, path, entry, use_mmap=False):
+        data = cls._read_tensor_bytes(path, entry, use_mmap)
+        return data.view(jnp.dtype(entry['dtype'])).reshape(entry['shape'])
+
+    @staticmethod
+    def _shard_quantized(tensor, shard_fn):
+        """ Place the quantized values with the target sharding and
+            dequantize them on devices, so that only the quantized bytes are
+            transferred from the host.
+        """
+        mesh = pxla.thread_resources.env.physical_mesh
+        partition_spec = getattr(shard_fn, 'partition_spec', None)
+        if mesh.empty or partition_spec is None:
+            return shard_fn(dequantize_blocks(*tensor))
+        values = jax.make_array_from_callback(
+            tensor.values.shape, NamedSharding(mesh, partition_spec),
+            lambda index: tensor.values[index]
+        )
+        dequantize_fn = get_sharded_dequantize_fn(
+            partition_spec, tensor.block_size, tensor.dtype
+        )
+        # The shard function only casts to the target dtype at this point
+        return shard_fn(dequantize_fn(values, tensor.scales))
+
+    @classmethod
+    def iterate_checkpoint(cls, path, shard_fns=None, remove_dict_prefix=None,
+                           keys_to_ignore=None, io_threads=8, use_mmap=False):
+        """ Yield the (key, tensor) pairs of a checkpoint in any of the
+            streaming, sharded or distributed formats, one tensor at a time.
+            shard_fns is a flattened dict of shard functions keyed like the
+            yielded keys. Without shard_fns, tensors are host numpy arrays.
+        """
         if remove_dict_prefix is not None:
             remove_dict_prefix = tuple(remove_dict_prefix)
-        flattend_train_state = {}
-        with mlxu.open_file(path) as fin:
-            # 83886080 bytes = 80 MB, which is 16 blocks on GCS
-            unpacker = msgpack.Unpacker(fin, read_size=83886080, max_buffer_size=0)
-            for key, value in unpacker:
-                key = tuple(key)
-                if keys_to_ignore is not None and key in keys_to_ignore:
-                    continue
-                if remove_dict_prefix is not None:
-                    if key[:len(remove_dict_prefix)] == remove_dict_prefix:
-                        key = key[len(remove_dict_prefix):]
-                    else:
-                        continue
+        if cls.is_distributed_checkpoint(path):
+            yield from cls._iterate_distributed_checkpoint(
+                path, shard_fns, remove_dict_prefix, keys_to_ignore, io_threads
+            )
+        elif cls.is_sharded_checkpoint(path):
+            entries = []
+            for entry in cls.load_sharded_index(path)['tensors']:
+                key = cls._filter_key(entry['key'], remove_dict_prefix, keys_to_ignore)
+                if key is not None:
+                    entries.append((key, entry))
 
-                tensor = from_bytes(None, value)
-                if shard_fns is not None:
+            # Tensors are fetched in parallel but sharded in index order, so
+            # every host issues the shard functions in the same sequence.
+            tensors = parallel_map(
+                lambda x: cls.read_sharded_tensor(
+                    path, x[1], use_mmap, dequantize=shard_fns is None
+                ),
+                entries, num_threads=io_threads,
+            )
+            for (key, _), tensor in zip(entries, tensors):
+                if isinstance(tensor, QuantizedTensor):
+                    tensor = cls._shard_quantized(tensor, shard_fns[key])
+                elif shard_fns is not None:
                     tensor = shard_fns[key](tensor)
-                flattend_train_state[key] = tensor
+                yield key, tensor
+        else:
+            index = cls.load_streaming_index(path)
+            entries = []
+            if index is not None:
+                for entry in index['tensors']:
+                    key = cls._filter_key(entry['key'], remove_dict_prefix, keys_to_ignore)
+                    if key is not None:
+                        entries.append((key, entry))
+
+            if index is not None and len(entries) < len(index['tensors']):
+                # Seek over the skipped tensors instead of decoding them
+                with mlxu.open_file(path, 'rb') as fin:
+                    for key, entry in entries:
+                        fin.seek(entry['offset'])
+                        saved_key, value = msgpack.unpackb(fin.read(entry['nbytes']))
+                        assert tuple(saved_key) == tuple(entry['key']), (
+                            f'Checkpoint index does not match the checkpoint at {path}'
+                        )
+                        tensor = from_bytes(None, value)
+                        if shard_fns is not None:
+                            tensor = shard_fns[key](tensor)
+                        yield key, tensor
+                return
+
+            with mlxu.open_file(path) as fin:
+                # 83886080 bytes = 80 MB, which is 16 blocks on GCS
+                unpacker = msgpack.Unpacker(fin, read_size=83886080, max_buffer_size=0)
+                for key, value in unpacker:
+                    key = cls._filter_key(key, remove_dict_prefix, keys_to_ignore)
+                    if key is None:
+                        continue
+
+                    tensor = from_bytes(None, value)
+                    if shard_fns is not None:
+                        tensor = shard_fns[key](tensor)
+                    yield key, tensor
+
+    @classmethod
+    def load_checkpoint(cls, path, target=None, shard_fns=None, remove_dict_prefix=None,
+                        keys_to_ignore=None, io_threads=8, use_mmap=False):
+        if shard_fns is not None:
+            shard_fns = flatten_dict(
+                to_state_dict(shard_fns)
+            )
+        flattend_train_state = dict(cls.iterate_checkpoint(
+            path, shard_fns, remove_dict_prefix, keys_to_ignore,
+            io_threads=io_threads, use_mmap=use_mmap,
+        ))
 
         if target is not None:
             flattened_target = flatten_dict(
@@ -137,6 +1124,73 @@ class StreamingCheckpointer(object):
 
         return from_state_dict(target, train_state)
 
+    @classmethod
+    def _iterate_distributed_checkpoint(cls, path, shard_fns=None, remove_dict_prefix=None,
+                                        keys_to_ignore=None, io_threads=8):
+        """ Restore tensors from a distributed checkpoint. With shard_fns,
+            each process reads only the saved pieces overlapping the regions
+            of its local devices under the current mesh and partition specs,
+            which may differ from the ones the checkpoint was saved with.
+            Without shard_fns, full tensors are assembled on the host.
+        """
+        def load_json(filename):
+            with mlxu.open_file(os.path.join(path, filename), 'r') as fin:
+                return json.load(fin)
+
+        manifest = load_json(DISTRIBUTED_CHECKPOINT_MANIFEST)
+        pieces = {}
+        for host_index in cls._load_host_indices(path, manifest, io_threads):
+            for entry in host_index['tensors']:
+                entry['region'] = tuple(tuple(x) for x in entry['region'])
+                pieces.setdefault(tuple(entry['key']), []).append(entry)
+
+        tensors = []
+        for tensor in manifest['tensors']:
+            key = cls._filter_key(tensor['key'], remove_dict_prefix, keys_to_ignore)
+            if key is not None:
+                tensors.append((key, tensor))
+
+        if shard_fns is not None:
+            mesh = pxla.thread_resources.env.physical_mesh
+
+        def read_regions(item):
+            key, tensor = item
+            shape = tuple(tensor['shape'])
+            if shard_fns is None:
+                sharding = None
+                regions = {normalize_region((), shape)}
+            else:
+                sharding = NamedSharding(mesh, shard_fns[key].partition_spec)
+                regions = {
+                    normalize_region(index, shape)
+                    for index in sharding.addressable_devices_indices_map(shape).values()
+                }
+            saved = pieces[tuple(tensor['key'])]
+            needed = [
+                (entry['region'], cls.read_sharded_tensor(path, entry))
+                for entry in saved
+                if any(regions_overlap(region, entry['region']) for region in regions)
+            ]
+            dtype = jnp.dtype(saved[0]['dtype'])
+            return sharding, {
+                region: assemble_region(region, needed, dtype) for region in regions
+            }
+
+        for (key, tensor), (sharding, regions) in zip(
+            tensors, parallel_map(read_regions, tensors, num_threads=io_threads)
+        ):
+            shape = tuple(tensor['shape'])
+            if sharding is None:
+                yield key, regions[normalize_region((), shape)]
+                continue
+            array = jax.make_array_from_callback(
+                shape, sharding,
+                lambda index: regions[normalize_region(index, shape)]
+            )
+            # The shard function only casts the dtype here, since the array
+            # already has the target sharding.
+            yield key, shard_fns[key](array)
+
     @staticmethod
     def load_flax_checkpoint(path, target=None, shard_fns=None):
         """ Load a standard flax checkpoint that's not saved with the
@@ -158,7 +1212,12 @@ class StreamingCheckpointer(object):
     def load_trainstate_checkpoint(cls, load_from, trainstate_target=None,
                                    trainstate_shard_fns=None,
                                    disallow_trainstate=False,
-                                   keys_to_ignore=None):
+                                   keys_to_ignore=None, io_threads=8,
+                                   use_mmap=False, params_shard_fns=None):
+        """ Load a train state or params checkpoint. params_shard_fns are
+            the shard functions of the params alone, for loading params with
+            shard functions when there is no train state to shard.
+        """
         if trainstate_target is not None:
             params_target = trainstate_target.params['params']
         else:
@@ -166,8 +1225,6 @@ class StreamingCheckpointer(object):
 
         if trainstate_shard_fns is not None:
             params_shard_fns = trainstate_shard_fns.params['params']
-        else:
-            params_shard_fns = None
 
         load_type, load_path = load_from.split('::', 1)
         if disallow_trainstate:
@@ -180,7 +1237,9 @@ class StreamingCheckpointer(object):
                 path=load_path,
                 target=trainstate_target,
                 shard_fns=trainstate_shard_fns,
-                keys_to_ignore=keys_to_ignore
+                keys_to_ignore=keys_to_ignore,
+                io_threads=io_threads,
+                use_mmap=use_mmap,
             )
         elif load_type == 'trainstate_params':
             # Load the params part of the train state in the streaming format
@@ -189,7 +1248,9 @@ class StreamingCheckpointer(object):
                 target=params_target,
                 shard_fns=params_shard_fns,
                 remove_dict_prefix=('params', 'params'),
-                keys_to_ignore=keys_to_ignore
+                keys_to_ignore=keys_to_ignore,
+                io_threads=io_threads,
+                use_mmap=use_mmap,
             )
             restored_params = flax.core.frozen_dict.freeze(
                 {'params': restored_params}
@@ -200,7 +1261,9 @@ class StreamingCheckpointer(object):
                 path=load_path,
                 target=params_target,
                 shard_fns=params_shard_fns,
-                keys_to_ignore=keys_to_ignore
+                keys_to_ignore=keys_to_ignore,
+                io_threads=io_threads,
+                use_mmap=use_mmap,
             )
             restored_params = flax.core.frozen_dict.freeze(
                 {'params': restored_params}
@@ -1,14 +1,25 @@
+import os
+import sys
 import time
 from functools import partial
 import json
+import glob
 import base64
+import io
+import bisect
+import hashlib
+from collections import deque
 from multiprocessing import Pool
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
 
 
 import mlxu
 from ml_collections import ConfigDict
 import numpy as np
-from datasets import load_dataset, Dataset
+from datasets import load_dataset, load_from_disk, Dataset
+from datasets.fingerprint import Hasher
+import fsspec
 import torch
 from torch.utils.data import DataLoader
 from transformers.utils import logging
@@ -16,9 +27,16 @@ from transformers.data.data_collator import numpy_default_data_collator
 from tqdm import tqdm
 import jax
 import jax.numpy as jnp
+from jax.experimental import multihost_utils
+
+from EasyLM.jax_utils import broadcast_string
 
 logger = logging.get_logger(__name__)
 
+# Part of the fingerprint of cached processed datasets. Bump it whenever the
+# tokenization or processing code changes the processed examples.
+DATASET_PROCESSING_VERSION = 1
+
 class DatasetFactory(object):
     """ Datset builder class. """
 
@@ -26,9 +44,12 @@ class DatasetFactory(object):
     def get_default_config(updates=None):
         config = ConfigDict()
         config.type = 'huggingface'
+        config.shard_by_process = False
         config.text_processor = TextProcessor.get_default_config()
         config.huggingface_dataset = HuggingfaceDataset.get_default_config()
         config.json_dataset = JsonDataset.get_default_config()
+        config.memmap_dataset = MemmapDataset.get_default_config()
+        config.mixture_dataset = MixtureDataset.get_default_config()
         config.json_torch_dataset = JsonTorchDataset.get_default_config()
         config.hf_prompt_dataset = HFPromptDataset.get_default_config()
         config.tulu_prompt_dataset = TuluPromptDataset.get_default_config()
@@ -41,45 +62,35 @@ class DatasetFactory(object):
     def load_dataset(cls, config, tokenizer, seed=42, **kwargs):
         config = cls.get_default_config(config)
         text_processor = TextProcessor(config.text_processor, tokenizer)
+        if config.shard_by_process:
+            # each host only loads its own slice of every global batch
+            if config.type not in ('json_torch', 'tulu_json_torch', 'preference_json_torch'):
+                raise ValueError(f'shard_by_process is not supported for dataset type: {config.type}')
+            kwargs.update(
+                shard_index=jax.process_index(), num_shards=jax.process_count()
+            )
         if config.type == 'huggingface':
             return HuggingfaceDataset(
                 config.huggingface_dataset, tokenizer, text_processor, **kwargs
             )
         elif config.type == 'json':
             return JsonDataset(config.json_dataset, tokenizer, text_processor, **kwargs)
+        elif config.type == 'memmap':
+            return MemmapDataset(config.memmap_dataset, tokenizer, text_processor, **kwargs)
+        elif config.type == 'mixture':
+            return MixtureDataset(config.mixture_dataset, tokenizer, text_processor, **kwargs)
         elif config.type == 'json_torch':
             torch.manual_seed(seed)
             dataset = JsonTorchDataset(config.json_torch_dataset, tokenizer, text_processor, **kwargs)
-            return DataLoader(
-                dataset,
-                batch_size=config.json_torch_dataset.batch_size,
-                num_workers=config.json_torch_dataset.num_workers,
-                shuffle=True,
-                collate_fn=numpy_default_data_collator,
-                drop_last=True  # sometimes batch doesnt split across tpu well.
-            )
+            return cls.json_torch_data_loader(dataset)
         elif config.type == 'tulu_json_torch':
             torch.manual_seed(seed) # keep dataloader order the same across devices.
             dataset = TuluJsonTorchDataset(config.json_torch_dataset, tokenizer, text_processor, **kwargs)
-            return DataLoader(
-                dataset,
-                batch_size=config.json_torch_dataset.batch_size,
-                num_workers=config.json_torch_dataset.num_workers,
-                shuffle=True,
-                collate_fn=numpy_default_data_collator,
-                drop_last=True  # sometimes batch doesnt split across tpu well.
-            )
+            return cls.json_torch_data_loader(dataset)
         elif config.type == 'preference_json_torch':
             torch.manual_seed(seed)
             dataset = PreferenceDataset(config.json_torch_dataset, tokenizer, text_processor, **kwargs)
-            return DataLoader(
-                dataset,
-                batch_size=config.json_torch_dataset.batch_size,
-                num_workers=config.json_torch_dataset.num_workers,
-                shuffle=True,
-                collate_fn=numpy_default_data_collator,
-                drop_last=True  # sometimes batch doesnt split across tpu well.
-            )
+            return cls.json_torch_data_loader(dataset)
         elif config.type == 'hf_prompt':
             torch.manual_seed(seed)
             dataset = HFPromptDataset(config.hf_prompt_dataset, tokenizer, **kwargs)
@@ -105,6 +116,29 @@ class DatasetFactory(object):
         else:
             raise ValueError(f'Unknown dataset type: {config.type}')
 
+    @staticmethod
+    def json_torch_data_loader(dataset):
+        if dataset.length_buckets is not None:
+            # batches are padded only up to the smallest bucket that fits them
+            return DataLoader(
+                dataset,
+                batch_sampler=LengthBucketSampler(
+                    dataset.lengths, dataset.length_buckets, dataset.local_batch_size
+                ),
+                num_workers=dataset.config.num_workers,
+                collate_fn=partial(
+                    length_bucket_data_collator, dataset.length_buckets, dataset.seq_length
+                ),
+            )
+        return DataLoader(
+            dataset,
+            batch_size=dataset.local_batch_size,
+            num_workers=dataset.config.num_workers,
+            shuffle=True,
+            collate_fn=numpy_default_data_collator,
+            drop_last=True  # sometimes batch doesnt split across tpu well.
+        )
+
     def __init__(self):
         raise ValueError('DatasetFactory is a static class and should not be instantiated.')
 
@@ -200,6 +234,305 @@ class TextProcessor(object):
         return token_buffer, loss_mask_buffer, *aux
 
 
+class TokenBuffer(object):
+    """ FIFO buffer of tokens and loss masks backed by preallocated numpy
+        arrays. Tokenized examples are written at the end and batches are
+        taken from the front with a single copy, instead of rebuilding python
+        lists for every batch. The remaining tokens are moved back to the
+        front only when the end of the arrays is reached.
+    """
+
+    def __init__(self, capacity, token_dtype=np.int32):
+        self._tokens = np.zeros(capacity, dtype=token_dtype)
+        self._loss_masks = np.zeros(capacity, dtype=np.float32)
+        self._start = 0
+        self._end = 0
+
+    def __len__(self):
+        return self._end - self._start
+
+    def _reserve(self, size):
+        length = len(self)
+        if length + size > len(self._tokens):
+            capacity = max(2 * len(self._tokens), length + size)
+            tokens = np.zeros(capacity, dtype=self._tokens.dtype)
+            loss_masks = np.zeros(capacity, dtype=np.float32)
+        else:
+            tokens, loss_masks = self._tokens, self._loss_masks
+        tokens[:length] = self._tokens[self._start:self._end]
+        loss_masks[:length] = self._loss_masks[self._start:self._end]
+        self._tokens, self._loss_masks = tokens, loss_masks
+        self._start, self._end = 0, length
+
+    def extend(self, tokens, loss_masks):
+        size = len(tokens)
+        if self._end + size > len(self._tokens):
+            self._reserve(size)
+        self._tokens[self._end:self._end + size] = tokens
+        self._loss_masks[self._end:self._end + size] = loss_masks
+        self._end += size
+
+    def take_batch(self, batch_size, seq_length):
+        """ Take batch_size * seq_length tokens from the front of the buffer.
+            Targets are shifted by one token, so the buffer must hold at least
+            one more token than the batch.
+        """
+        chunk_size = batch_size * seq_length
+        assert len(self) > chunk_size
+        start = self._start
+        batch = {
+            'input_tokens': self._tokens[start:start + chunk_size].reshape(
+                batch_size, seq_length
+            ).copy(),
+            'target_tokens': self._tokens[start + 1:start + chunk_size + 1].reshape(
+                batch_size, seq_length
+            ).copy(),
+            'loss_masks': self._loss_masks[start + 1:start + chunk_size + 1].reshape(
+                batch_size, seq_length
+            ).copy(),
+        }
+        self._start += chunk_size
+        return batch
+
+    @property
+    def tokens(self):
+        return self._tokens[self._start:self._end]
+
+    @property
+    def loss_masks(self):
+        return self._loss_masks[self._start:self._end]
+
+
+_worker_text_processor = None
+
+
+def _init_tokenizer_worker(text_processor):
+    global _worker_text_processor
+    _worker_text_processor = text_processor
+
+
+def _worker_process_example(example):
+    return _worker_text_processor(example, has_aux=True)
+
+
+def batched(iterator, batch_size):
+    batch = []
+    for example in iterator:
+        batch.append(example)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if len(batch) > 0:
+        yield batch
+
+
+def parallel_process_examples(text_processor, examples, processes,
+                              batch_size=1024, chunk_size=32):
+    """ Apply the text processor to (example, *aux) tuples in a process pool.
+        The text processor is sent to each worker once, and the next batch of
+        examples is processed while the current one is consumed.
+    """
+    if processes == 1:
+        for example in examples:
+            yield text_processor(example, has_aux=True)
+        return
+    batched_iterator = batched(examples, batch_size)
+    with Pool(processes, initializer=_init_tokenizer_worker,
+              initargs=(text_processor, )) as pool:
+        def submit_next_batch():
+            for batch in batched_iterator:
+                return pool.map_async(
+                    _worker_process_example, batch, chunksize=chunk_size
+                )
+            return None
+
+        next_batch = submit_next_batch()
+        while next_batch is not None:
+            current_batch, next_batch = next_batch, submit_next_batch()
+            for example in current_batch.get():
+                yield example
+
+
+def pack_token_batches(examples, buffer, batch_size, seq_length,
+                       bos_token_id=None, throughput_window_size=200):
+    """ Pack (tokens, loss_masks, *aux) examples into batches through a
+        TokenBuffer. Yields (batch, throughput metrics, aux of the last example
+        added to the buffer). The first input token of every sequence is
+        replaced by bos_token_id when it is given.
+    """
+    chunk_size = batch_size * seq_length
+    last_time = 0.0
+    step_times = []
+    start_time = time.time()
+    total_tokens = 0
+    for tokens, loss_masks, *aux in examples:
+        buffer.extend(tokens, loss_masks)
+        while len(buffer) > chunk_size + 1:
+            total_tokens += chunk_size
+            step_times.append(time.time() - last_time)
+            last_time = time.time()
+            if len(step_times) > throughput_window_size:
+                step_times = step_times[-throughput_window_size:]
+            metrics = {
+                'dataset_accumulated_tps': total_tokens / (time.time() - start_time),
+                'dataset_average_tps': chunk_size / np.mean(step_times),
+            }
+            batch = buffer.take_batch(batch_size, seq_length)
+            batch['attention_mask'] = np.ones((batch_size, seq_length), dtype=np.int32)
+            if bos_token_id is not None:
+                batch['input_tokens'][:, 0] = bos_token_id
+            yield batch, metrics, aux
+
+
+def _tokenize_json_range(path, start, end):
+    """ Tokenize the lines of a JSON lines file starting in the byte range
+        [start, end). The tokens and loss masks are returned in a shared memory
+        block, only the per example metadata is sent through the pipe.
+    """
+    tokens, loss_masks, lengths, locs, line_indices = [], [], [], [], []
+    num_lines = 0
+    with mlxu.open_file(path, 'rb') as fin:
+        if start > 0:
+            # skip the line containing byte start - 1, it belongs to the previous range
+            fin.seek(start - 1)
+            fin.readline()
+        while fin.tell() < end:
+            line = fin.readline()
+            if not line:
+                break
+            data = JsonDataset.parse_json(line.decode('utf-8'))
+            if data is not None:
+                example_tokens, example_loss_masks = _worker_text_processor(data)
+                tokens.append(np.asarray(example_tokens, dtype=np.int32))
+                loss_masks.append(np.asarray(example_loss_masks, dtype=np.float32))
+                lengths.append(len(example_tokens))
+                locs.append(fin.tell())
+                line_indices.append(num_lines)
+            num_lines += 1
+        end_loc = fin.tell()
+
+    num_tokens = int(sum(lengths))
+    shm_name = None
+    if num_tokens > 0:
+        shm = SharedMemory(create=True, size=num_tokens * 8)
+        np.concatenate(tokens, out=np.ndarray((num_tokens,), dtype=np.int32, buffer=shm.buf))
+        np.concatenate(loss_masks, out=np.ndarray(
+            (num_tokens,), dtype=np.float32, buffer=shm.buf, offset=num_tokens * 4
+        ))
+        shm_name = shm.name
+        shm.close()
+        # the parent attaches to the block and unlinks it, so it is not tracked here
+        resource_tracker.unregister(shm._name, 'shared_memory')
+    return dict(
+        shm_name=shm_name,
+        num_tokens=num_tokens,
+        lengths=np.array(lengths, dtype=np.int64),
+        locs=np.array(locs, dtype=np.int64),
+        line_indices=np.array(line_indices, dtype=np.int64),
+        num_lines=num_lines,
+        end_loc=end_loc,
+    )
+
+
+class JsonTokenizerPool(object):
+    """ Process pool that tokenizes a JSON lines file in parallel. Each worker
+        receives the text processor once at startup and reads its own byte
+        ranges of the file, so only file offsets and packed numpy arrays in
+        shared memory cross process boundaries.
+    """
+
+    def __init__(self, text_processor, processes, chunk_bytes=4 * 1024 * 1024):
+        self.text_processor = text_processor
+        self.processes = processes
+        self.chunk_bytes = chunk_bytes
+
+    @staticmethod
+    def _read_shared_arrays(result):
+        num_tokens = result['num_tokens']
+        if result['shm_name'] is None:
+            return np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.float32)
+        if sys.version_info >= (3, 13):
+            shm = SharedMemory(name=result['shm_name'], track=False)
+        else:
+            # tracked until unlink() below unregisters it
+            shm = SharedMemory(name=result['shm_name'])
+        try:
+            tokens = np.ndarray((num_tokens,), dtype=np.int32, buffer=shm.buf).copy()
+            loss_masks = np.ndarray(
+                (num_tokens,), dtype=np.float32, buffer=shm.buf, offset=num_tokens * 4
+            ).copy()
+        finally:
+            shm.close()
+            shm.unlink()
+        return tokens, loss_masks
+
+    def iterate(self, path, start_loc=0, loop=True):
+        """ Yield (tokens, loss_masks, loc, pass_index, line_index) for every
+            example, where loc is the file location after the example and
+            line_index counts the lines read in the current pass over the file.
+            The first pass starts at start_loc.
+        """
+        with mlxu.open_file(path, 'rb') as fin:
+            fin.seek(0, os.SEEK_END)
+            file_size = fin.tell()
+        assert file_size > 0, f'{path} is empty'
+
+        def byte_ranges():
+            loc = start_loc
+            pass_index = 0
+            while True:
+                if loc >= file_size:
+                    if not loop:
+                        return
+                    loc = 0
+                    pass_index += 1
+                end = min(loc + self.chunk_bytes, file_size)
+                yield pass_index, loc, end
+                loc = end
+
+        ranges = byte_ranges()
+        pending = deque()
+        with Pool(self.processes, initializer=_init_tokenizer_worker,
+                  initargs=(self.text_processor, )) as pool:
+
+            def submit_next_range():
+                for pass_index, start, end in ranges:
+                    pending.append((pass_index, pool.apply_async(
+                        _tokenize_json_range, (path, start, end)
+                    )))
+                    break
+
+            try:
+                # keep a bounded number of ranges in flight
+                for _ in range(2 * self.processes):
+                    submit_next_range()
+                line_offset, current_pass = 0, 0
+                while len(pending) > 0:
+                    pass_index, result = pending.popleft()
+                    result = result.get()
+                    submit_next_range()
+                    if pass_index != current_pass:
+                        line_offset, current_pass = 0, pass_index
+                    tokens, loss_masks = self._read_shared_arrays(result)
+                    offsets = np.concatenate([[0], np.cumsum(result['lengths'])])
+                    for i in range(len(result['lengths'])):
+                        yield (
+                            tokens[offsets[i]:offsets[i + 1]],
+                            loss_masks[offsets[i]:offsets[i + 1]],
+                            int(result['locs'][i]),
+                            pass_index,
+                            line_offset + int(result['line_indices'][i]),
+                        )
+                    line_offset += result['num_lines']
+            finally:
+                # release the shared memory of ranges that were not consumed
+                for _, result in pending:
+                    try:
+                        self._read_shared_arrays(result.get())
+                    except Exception:
+                        pass
+
+
 class HuggingfaceDataset(object):
     """ Huggingface dataset, where the dataset is loaded using the huggingface
         datasets.load_dataset() function.
@@ -235,34 +568,22 @@ class HuggingfaceDataset(object):
         chunk_size = self.config.batch_size * self.config.seq_length
         total_tokens = 0
         while True:
-            token_buffer = []
-            loss_mask_buffer = []
+            buffer = TokenBuffer(
+                2 * (chunk_size + 1), token_dtype=self.config.batch_token_dtype
+            )
             for index, example in enumerate(self._dataset):
                 tokens, loss_masks = self.text_processor(example)
-                token_buffer.extend(tokens)
-                loss_mask_buffer.extend(loss_masks)
-                while len(token_buffer) > chunk_size + 1:
+                buffer.extend(tokens, loss_masks)
+                while len(buffer) > chunk_size + 1:
                     total_tokens += chunk_size
                     metrics = {
                         'dataset_example_index': index,
                         'dataset_total_tokens': total_tokens,
                     }
-                    batch = {
-                        'input_tokens': np.array(token_buffer[:chunk_size], dtype=self.config.batch_token_dtype).reshape(
-                            self.config.batch_size, -1
-                        ),
-                        'target_tokens': np.array(token_buffer[1:chunk_size + 1], dtype=self.config.batch_token_dtype).reshape(
-                            self.config.batch_size, -1
-                        ),
-                        'loss_masks': np.array(loss_mask_buffer[1:chunk_size + 1], dtype=np.float32).reshape(
-                            self.config.batch_size, -1
-                        ),
-                    }
+                    batch = buffer.take_batch(self.config.batch_size, self.config.seq_length)
                     if self.config.always_start_with_bos:
                         batch['input_tokens'][:, 0] = self.tokenizer.bos_token_id
                     yield batch, metrics
-                    token_buffer = token_buffer[chunk_size:]
-                    loss_mask_buffer = loss_mask_buffer[chunk_size:]
 
     def get_state_dict(self):
         return dict(config=self.config)
@@ -368,6 +689,8 @@ class JsonDataset(object):
         config.example_index_at_start = 0
         config.tokens_count_at_start = 0
         config.tokenizer_processes = 1
+        config.tokenizer_parallel_chunk_bytes = 4 * 1024 * 1024
+        # deprecated, workers now read byte ranges of tokenizer_parallel_chunk_bytes
         config.tokenizer_parallel_chunk_size = 32
         config.tokenizer_parallel_batch_size = 1024
         config.throughput_average_window_size = 200
@@ -379,13 +702,20 @@ class JsonDataset(object):
     def __init__(self, config, tokenizer, text_processor):
         self.config = self.get_default_config(config)
         assert self.config.path != ''
+        if (self.config.tokenizer_parallel_chunk_size != 32
+                or self.config.tokenizer_parallel_batch_size != 1024):
+            logger.warning(
+                'tokenizer_parallel_chunk_size and tokenizer_parallel_batch_size '
+                'are deprecated and ignored, use tokenizer_parallel_chunk_bytes.'
+            )
         self._tokenizer = tokenizer
         self._text_processor = text_processor
         self._index = self.config.example_index_at_start
         self._file_loc = self.config.start_seek_loc
         self._total_tokens = self.config.tokens_count_at_start
 
-    def parse_json(self, line):
+    @staticmethod
+    def parse_json(line):
         if not line or line == '\n':
             return None
         try:
@@ -412,84 +742,41 @@ class JsonDataset(object):
                     yield data, self._file_loc, self._index
                 self._index += 1
 
-    def batched(self, iterator, batch_size):
-        batch = []
-        for example in iterator:
-            batch.append(example)
-            if len(batch) == batch_size:
-                yield batch
-                batch = []
-        if len(batch) > 0:
-            yield batch
-
     def parallel_example_iterator(self):
         if self.config.tokenizer_processes == 1:
             for example, loc, index in self.json_iterator():
                 yield self.text_processor((example, loc, index), has_aux=True)
         else:
-            process_pool = Pool(self.config.tokenizer_processes)
-            batched_iterator = self.batched(
-                self.json_iterator(), self.config.tokenizer_parallel_batch_size
+            tokenizer_pool = JsonTokenizerPool(
+                self.text_processor, self.config.tokenizer_processes,
+                self.config.tokenizer_parallel_chunk_bytes,
             )
-            with process_pool as pool:
-                map_fn = partial(self.text_processor, has_aux=True)
-                next_batch = pool.map_async(
-                    map_fn, next(batched_iterator),
-                    chunksize=self.config.tokenizer_parallel_chunk_size
-                )
-                while True:
-                    current_batch = next_batch
-                    next_batch = pool.map_async(
-                        map_fn, next(batched_iterator),
-                        chunksize=self.config.tokenizer_parallel_chunk_size
-                    )
-                    for example in current_batch.get():
-                        yield example
+            start_index = self._index
+            examples = tokenizer_pool.iterate(self.config.path, self._file_loc)
+            for tokens, loss_masks, loc, pass_index, line_index in examples:
+                # the line index restarts from 0 every time the file wraps around
+                index = line_index + (start_index if pass_index == 0 else 0)
+                self._file_loc = loc
+                self._index = index + 1
+                yield tokens, loss_masks, loc, index
 
     def __iter__(self):
         chunk_size = self.config.batch_size * self.config.seq_length
-        token_buffer = []
-        loss_mask_buffer = []
-        last_time = 0.0
-        step_times = []
-        start_time = time.time()
-        start_tokens = self._total_tokens
-        for tokens, loss_masks, loc, index in self.parallel_example_iterator():
-            token_buffer.extend(tokens)
-            loss_mask_buffer.extend(loss_masks)
-            while len(token_buffer) > chunk_size + 1:
-                self._total_tokens += chunk_size
-                step_times.append(time.time() - last_time)
-                last_time = time.time()
-                if len(step_times) > self.config.throughput_average_window_size:
-                    step_times = step_times[-self.config.throughput_average_window_size:]
-                average_throughput = chunk_size / np.mean(step_times)
-                accumulated_throughput = (
-                    (self._total_tokens - start_tokens) / (time.time() - start_time)
-                )
-                metrics = {
-                    'dataset_file_loc': loc,
-                    'dataset_example_index': index,
-                    'dataset_total_tokens': self._total_tokens,
-                    'dataset_accumulated_tps': accumulated_throughput,
-                    'dataset_average_tps': average_throughput,
-                }
-                batch = {
-                    'input_tokens': np.array(token_buffer[:chunk_size], dtype=np.int32).reshape(
-                        self.config.batch_size, -1
-                    ),
-                    'target_tokens': np.array(token_buffer[1:chunk_size + 1], dtype=np.int32).reshape(
-                        self.config.batch_size, -1
-                    ),
-                    'loss_masks': np.array(loss_mask_buffer[1:chunk_size + 1], dtype=np.float32).reshape(
-                        self.config.batch_size, -1
-                    ),
-                }
-                if self.config.always_start_with_bos:
-                    batch['input_tokens'][:, 0] = self.tokenizer.bos_token_id
-                yield batch, metrics
-                token_buffer = token_buffer[chunk_size:]
-                loss_mask_buffer = loss_mask_buffer[chunk_size:]
+        batches = pack_token_batches(
+            self.parallel_example_iterator(), TokenBuffer(2 * (chunk_size + 1)),
+            self.config.batch_size, self.config.seq_length,
+            bos_token_id=self.tokenizer.bos_token_id if self.config.always_start_with_bos else None,
+            throughput_window_size=self.config.throughput_average_window_size,
+        )
+        for batch, throughput_metrics, (loc, index) in batches:
+            self._total_tokens += chunk_size
+            metrics = {
+                'dataset_file_loc': loc,
+                'dataset_example_index': index,
+                'dataset_total_tokens': self._total_tokens,
+                **throughput_metrics,
+            }
+            yield batch, metrics
 
     def get_state_dict(self):
         return dict(
@@ -539,6 +826,318 @@ class JsonDataset(object):
         return len(self.tokenizer)
 
 
+class MemmapDataset(object):
+    """ Pre-tokenized dataset written by EasyLM.scripts.tokenize_dataset, where
+        the tokens and loss masks of all examples are stored as flat arrays on
+        disk. Batches are sliced directly out of the memory-mapped arrays, so
+        no JSON parsing or tokenization happens during training.
+    """
+
+    @staticmethod
+    def get_default_config(updates=None):
+        config = ConfigDict()
+        config.path = ''
+        config.seq_length = 1024
+        config.batch_size = 8
+        config.always_start_with_bos = False
+        config.start_offset = 0
+        config.throughput_average_window_size = 200
+
+        if updates is not None:
+            config.update(ConfigDict(updates).copy_and_resolve_references())
+        return config
+
+    def __init__(self, config, tokenizer, text_processor):
+        self.config = self.get_default_config(config)
+        assert self.config.path != ''
+        self._tokenizer = tokenizer
+        self._text_processor = text_processor
+        with mlxu.open_file(os.path.join(self.config.path, 'metadata.json'), 'r') as fin:
+            self._metadata = json.load(fin)
+        self._num_tokens = self._metadata['num_tokens']
+        self._tokens = np.memmap(
+            os.path.join(self.config.path, 'tokens.bin'),
+            dtype=self._metadata['token_dtype'], mode='r',
+            shape=(self._num_tokens,),
+        )
+        self._loss_masks = np.memmap(
+            os.path.join(self.config.path, 'loss_masks.bin'),
+            dtype=self._metadata['loss_mask_dtype'], mode='r',
+            shape=(self._num_tokens,),
+        )
+        self._offsets = np.memmap(
+            os.path.join(self.config.path, 'offsets.bin'),
+            dtype=np.int64, mode='r',
+            shape=(self._metadata['num_examples'],),
+        )
+        assert self._num_tokens > self.config.batch_size * self.config.seq_length, (
+            'Memmap dataset is smaller than a single batch.'
+        )
+        self._offset = self.config.start_offset
+
+    def __iter__(self):
+        chunk_size = self.config.batch_size * self.config.seq_length
+        last_time = time.time()
+        step_times = []
+        while True:
+            if self._offset + chunk_size + 1 > self._num_tokens:
+                # Wrap around to the beginning for the next epoch
+                self._offset = 0
+            start = self._offset
+            self._offset += chunk_size
+            step_times.append(time.time() - last_time)
+            last_time = time.time()
+            if len(step_times) > self.config.throughput_average_window_size:
+                step_times = step_times[-self.config.throughput_average_window_size:]
+            metrics = {
+                'dataset_offset': start,
+                'dataset_example_index': int(np.searchsorted(self._offsets, start, side='right')) - 1,
+                'dataset_average_tps': chunk_size / max(np.mean(step_times), 1e-8),
+            }
+            batch = {
+                'input_tokens': self._tokens[start:start + chunk_size].reshape(
+                    self.config.batch_size, -1
+                ),
+                'target_tokens': self._tokens[start + 1:start + chunk_size + 1].reshape(
+                    self.config.batch_size, -1
+                ),
+                'loss_masks': self._loss_masks[start + 1:start + chunk_size + 1].reshape(
+                    self.config.batch_size, -1
+                ),
+                'attention_mask': np.ones(
+                    (self.config.batch_size, self.config.seq_length), dtype=np.int32
+                ),
+            }
+            if self.config.always_start_with_bos:
+                # The memmap is read only, so copy before modifying
+                batch['input_tokens'] = np.array(batch['input_tokens'])
+                batch['input_tokens'][:, 0] = self.tokenizer.bos_token_id
+            yield batch, metrics
+
+    def get_state_dict(self):
+        return dict(config=self.config, offset=self._offset)
+
+    def load_state_dict(self, state_dict):
+        if 'config' in state_dict:
+            self.config.update(ConfigDict(state_dict['config']))
+        self._offset = state_dict.get('offset', self.config.start_offset)
+
+    def __len__(self):
+        return self._num_tokens // self.config.seq_length
+
+    @property
+    def seq_length(self):
+        return self.config.seq_length
+
+    @property
+    def tokenizer(self):
+        return self._tokenizer
+
+    @property
+    def text_processor(self):
+        return self._text_processor
+
+    @property
+    def vocab_size(self):
+        return len(self.tokenizer)
+
+
+class MixtureDataset(object):
+    """ Weighted mixture of streaming sources. Every example is drawn from a
+        source sampled according to the configured weights. A source is either
+        a JSON lines file, a glob pattern of JSON lines shards which are read
+        in order, or a huggingface dataset given as hf:path:name:split.
+    """
+
+    @staticmethod
+    def get_default_config(updates=None):
+        config = ConfigDict()
+        config.sources = ''
+        config.weights = ''
+        config.seed = 42
+        config.seq_length = 1024
+        config.batch_size = 8
+        config.always_start_with_bos = False
+        config.tokenizer_processes = 1
+        config.tokenizer_parallel_chunk_size = 32
+        config.tokenizer_parallel_batch_size = 1024
+        config.throughput_average_window_size = 200
+
+        if updates is not None:
+            config.update(ConfigDict(updates).copy_and_resolve_references())
+        return config
+
+    def __init__(self, config, tokenizer, text_processor):
+        self.config = self.get_default_config(config)
+        assert self.config.sources != ''
+        self._tokenizer = tokenizer
+        self._text_processor = text_processor
+        self._sources = [x.strip() for x in self.config.sources.split(',') if x.strip() != '']
+        if self.config.weights != '':
+            weights = np.array([float(x) for x in self.config.weights.split(',')], dtype=np.float64)
+            assert len(weights) == len(self._sources), (
+                'Number of weights must match the number of sources.'
+            )
+        else:
+            weights = np.ones(len(self._sources), dtype=np.float64)
+        assert np.all(weights >= 0) and np.sum(weights) > 0
+        self._cumulative_weights = np.cumsum(weights / np.sum(weights))
+        self._source_files = {
+            source: self._expand_json_source(source)
+            for source in self._sources if not source.startswith('hf:')
+        }
+
+        # resume state, updated as examples are consumed into batches.
+        # source positions are keyed by the source so that sources and weights
+        # can be changed when resuming.
+        self._seed = self.config.seed
+        self._draws = 0
+        self._source_positions = {source: None for source in self._sources}
+        self._total_tokens = 0
+        # leftover tokens of the last batch, part of the resume state
+        self._buffer = self._new_token_buffer()
+
+    def _new_token_buffer(self):
+        return TokenBuffer(2 * (self.config.batch_size * self.config.seq_length + 1))
+
+    @staticmethod
+    def _expand_json_source(source):
+        if not glob.has_magic(source):
+            return [source]
+        if '://' in source:
+            fs, _ = fsspec.core.url_to_fs(source)
+            files = [fs.unstrip_protocol(x) for x in fs.glob(source)]
+        else:
+            files = glob.glob(source)
+        assert len(files) > 0, f'No files match {source}'
+        return sorted(files)
+
+    def _json_source_iterator(self, source):
+        files = self._source_files[source]
+        file_index, file_loc = self._source_positions[source] or (0, 0)
+        while True:
+            with mlxu.open_file(files[file_index], 'r') as fin:
+                fin.seek(file_loc)
+                while True:
+                    line = fin.readline()
+                    if not line:   # Reached EOF
+                        break
+                    file_loc = fin.tell()
+                    data = JsonDataset.parse_json(line)
+                    if data is not None:
+                        yield data, (file_index, file_loc)
+            file_index = (file_index + 1) % len(files)
+            file_loc = 0
+
+    def _huggingface_source_iterator(self, source):
+        path, name, split = (source[len('hf:'):].split(':') + ['', ''])[:3]
+        dataset = load_dataset(
+            path, name if name != '' else None,
+            split=split if split != '' else 'train', streaming=True
+        )
+        index = self._source_positions[source] or 0
+        while True:
+            for example in dataset.skip(index):
+                index += 1
+                yield example, index
+            index = 0
+
+    def mixture_iterator(self):
+        """ Yield (example, source, source position, draws) from the sources
+            sampled by weight. The sampler only depends on the seed and the
+            number of draws, so it can be restored exactly.
+        """
+        iterators = [
+            self._huggingface_source_iterator(source) if source.startswith('hf:')
+            else self._json_source_iterator(source)
+            for source in self._sources
+        ]
+        rng = np.random.Generator(np.random.PCG64(self._seed).advance(self._draws))
+        draws = self._draws
+        while True:
+            draws += 1
+            source_index = min(
+                int(np.searchsorted(self._cumulative_weights, rng.random(), side='right')),
+                len(self._sources) - 1,
+            )
+            example, position = next(iterators[source_index])
+            yield example, self._sources[source_index], position, draws
+
+    def parallel_example_iterator(self):
+        return parallel_process_examples(
+            self.text_processor, self.mixture_iterator(),
+            self.config.tokenizer_processes,
+            batch_size=self.config.tokenizer_parallel_batch_size,
+            chunk_size=self.config.tokenizer_parallel_chunk_size,
+        )
+
+    def _consume_examples(self):
+        # the resume state advances as examples are moved into the buffer
+        for tokens, loss_masks, source, position, draws in self.parallel_example_iterator():
+            self._source_positions[source] = position
+            self._draws = draws
+            yield tokens, loss_masks
+
+    def __iter__(self):
+        chunk_size = self.config.batch_size * self.config.seq_length
+        batches = pack_token_batches(
+            self._consume_examples(), self._buffer,
+            self.config.batch_size, self.config.seq_length,
+            bos_token_id=self.tokenizer.bos_token_id if self.config.always_start_with_bos else None,
+            throughput_window_size=self.config.throughput_average_window_size,
+        )
+        for batch, throughput_metrics, _ in batches:
+            self._total_tokens += chunk_size
+            metrics = {
+                'dataset_mixture_draws': self._draws,
+                'dataset_total_tokens': self._total_tokens,
+                **throughput_metrics,
+            }
+            yield batch, metrics
+
+    def get_state_dict(self):
+        return dict(
+            config=self.config,
+            seed=self._seed,
+            draws=self._draws,
+            sampler_state=np.random.PCG64(self._seed).advance(self._draws).state,
+            source_positions=dict(self._source_positions),
+            total_tokens=self._total_tokens,
+            token_buffer=self._buffer.tokens.copy(),
+            loss_mask_buffer=self._buffer.loss_masks.copy(),
+        )
+
+    def load_state_dict(self, state_dict):
+        # sources and weights are deliberately not restored from the saved
+        # config, so that the mixture can be changed when resuming.
+        self._seed = state_dict.get('seed', self.config.seed)
+        self._draws = state_dict.get('draws', 0)
+        for source, position in state_dict.get('source_positions', {}).items():
+            if source in self._source_positions:
+                self._source_positions[source] = position
+        self._total_tokens = state_dict.get('total_tokens', 0)
+        self._buffer = self._new_token_buffer()
+        self._buffer.extend(
+            state_dict.get('token_buffer', []), state_dict.get('loss_mask_buffer', [])
+        )
+
+    @property
+    def seq_length(self):
+        return self.config.seq_length
+
+    @property
+    def tokenizer(self):
+        return self._tokenizer
+
+    @property
+    def text_processor(self):
+        return self._text_processor
+
+    @property
+    def vocab_size(self):
+        return len(self.tokenizer)
+
+
 class JsonTorchDataset(object):
     @staticmethod
     def get_default_config(updates=None):
@@ -550,43 +1149,254 @@ class JsonTorchDataset(object):
         config.batch_size = 8
         config.num_workers = 8
         config.remove_truncated_samples = False
+        config.map_batch_size = 1000
+        config.cache_dir = ''
+        config.pack_sequences = False
+        config.length_buckets = ''
+        config.check_tokenization = True
 
         if updates is not None:
             config.update(ConfigDict(updates).copy_and_resolve_references())
         return config
 
-    def __init__(self, config, tokenizer, text_processor):
+    def __init__(self, config, tokenizer, text_processor, shard_index=0, num_shards=1):
         self.config = self.get_default_config(config)
         self._tokenizer = tokenizer
         self._text_processor = text_processor
+        # with num_shards > 1, this dataset only holds every num_shards-th
+        # example and yields its slice of each global batch.
+        self.shard_index = shard_index
+        self.num_shards = num_shards
+        assert self.config.batch_size % self.num_shards == 0, (
+            'batch_size must be divisible by the number of shards.'
+        )
+        self._max_length = None
+        self._input_fingerprint_value = None
+        if self.config.cache_dir != '':
+            self.dataset = self._load_or_build_cached_dataset()
+        else:
+            self.dataset = self._build_dataset()
+
+        self._packed_rows = None
+        self.packing_efficiency = None
+        self.lengths = None
+        self.length_buckets = None
+        if self.config.pack_sequences:
+            assert self.config.length_buckets == '', (
+                'Sequence packing and length buckets cannot be used together.'
+            )
+            self._pack_sequences()
+        elif self.config.length_buckets != '':
+            self.length_buckets = sorted(
+                int(x) for x in self.config.length_buckets.split(',')
+            )
+            assert self.length_buckets[-1] <= self.config.seq_length
+            if self.length_buckets[-1] < self.config.seq_length:
+                self.length_buckets.append(self.config.seq_length)
+            self.lengths = self._compute_lengths()
+
+        if self.num_shards > 1:
+            assert self.length_buckets is None, (
+                'Length buckets are not supported with sharded datasets.'
+            )
+            # every shard must yield the same number of batches per epoch
+            shard_lengths = multihost_utils.process_allgather(np.array(len(self)))
+            self._max_length = int(np.min(shard_lengths))
+            logger.info(
+                'Shard %d of %d has %d examples, using %d.',
+                self.shard_index, self.num_shards, int(shard_lengths[self.shard_index]),
+                self._max_length,
+            )
+
+    def _load_raw_dataset(self):
         if self.config.path:
             # load it all into memory for so I can epoch over it
             with mlxu.open_file(self.config.path, 'r') as fin:
-                dataset = Dataset.from_list([json.loads(line) for line in tqdm(fin, desc="Loading dataset into memory...")])
+                return Dataset.from_list([
+                    json.loads(line) for i, line in enumerate(tqdm(fin, desc="Loading dataset into memory..."))
+                    if i % self.num_shards == self.shard_index
+                ])
         elif self.config.hf_name:
-            dataset = load_dataset(self.config.hf_name, split=config.hf_split)
+            dataset = load_dataset(self.config.hf_name, split=self.config.hf_split)
+            if self.num_shards > 1:
+                dataset = dataset.shard(self.num_shards, self.shard_index)
+            return dataset
         else:
             raise ValueError('Must specify either path or hf_name')
-        self.dataset = dataset.map(
-            self._process_sample,
+
+    def _build_dataset(self):
+        dataset = self._load_raw_dataset()
+        dataset = dataset.map(
+            self._process_batch,
             with_indices=True,
-            batched=False,
+            batched=True,
+            batch_size=self.config.map_batch_size,
             num_proc=self.config.num_workers,
             remove_columns=[x for x in dataset.column_names if x not in ['input_tokens', 'target_tokens', 'loss_masks', 'attention_mask', 'indices', 'truncated']],)
         # filter out examples with no loss token
         # these are useless anyway...
-        samples_before = len(self.dataset)
-        if 'loss_masks' in self.dataset.column_names:
-            self.dataset = self.dataset.filter(lambda x: sum(x['loss_masks'][1:]) > 0)
-        if 'chosen_loss_mask' in self.dataset.column_names:
-            self.dataset = self.dataset.filter(lambda x: sum(x['chosen_loss_mask'][1:]) > 0)
-        if 'rejected_loss_mask' in self.dataset.column_names:
-            self.dataset = self.dataset.filter(lambda x: sum(x['rejected_loss_mask'][1:]) > 0)
+        samples_before = len(dataset)
+        if 'loss_masks' in dataset.column_names:
+            dataset = dataset.filter(lambda x: sum(x['loss_masks'][1:]) > 0)
+        if 'chosen_loss_mask' in dataset.column_names:
+            dataset = dataset.filter(lambda x: sum(x['chosen_loss_mask'][1:]) > 0)
+        if 'rejected_loss_mask' in dataset.column_names:
+            dataset = dataset.filter(lambda x: sum(x['rejected_loss_mask'][1:]) > 0)
         if self.config.remove_truncated_samples:
-            self.dataset = self.dataset.filter(lambda x: not x['truncated'])
-        self.dataset = self.dataset.remove_columns(['truncated'])
-        logger.info('Filtered out %d truncated examples.', samples_before - len(self.dataset))
+            dataset = dataset.filter(lambda x: not x['truncated'])
+        dataset = dataset.remove_columns(['truncated'])
+        logger.info('Filtered out %d truncated examples.', samples_before - len(dataset))
+        return dataset
+
+    def _input_fingerprint(self):
+        """ Fingerprint of the input data, computed once on the first host
+            and broadcast, so that every host agrees on it and remote files
+            are only read once.
+        """
+        if self._input_fingerprint_value is None:
+            fingerprint = ''
+            if jax.process_index() == 0:
+                fingerprint = self._compute_input_fingerprint()
+            self._input_fingerprint_value = broadcast_string(fingerprint)
+        return self._input_fingerprint_value
+
+    def _compute_input_fingerprint(self):
+        if self.config.path:
+            # files are fingerprinted by their content, not their location
+            sha256 = hashlib.sha256()
+            size = 0
+            with mlxu.open_file(self.config.path, 'rb') as fin:
+                for chunk in iter(lambda: fin.read(1 << 24), b''):
+                    sha256.update(chunk)
+                    size += len(chunk)
+            return f'{size}:{sha256.hexdigest()}'
+        elif self.config.hf_name:
+            return load_dataset(self.config.hf_name, split=self.config.hf_split)._fingerprint
+        else:
+            raise ValueError('Must specify either path or hf_name')
 
+    def cache_fingerprint(self):
+        """ Fingerprint of everything that determines the processed dataset:
+            the input data, the tokenizer, the sequence length and the
+            processing code.
+        """
+        hasher = Hasher()
+        hasher.update(f'{type(self).__module__}.{type(self).__qualname__}')
+        hasher.update(DATASET_PROCESSING_VERSION)
+        hasher.update(self._input_fingerprint())
+        hasher.update(self.tokenizer)
+        hasher.update(self.config.seq_length)
+        hasher.update(self.config.remove_truncated_samples)
+        hasher.update(self.config.check_tokenization)
+        hasher.update((self.shard_index, self.num_shards))
+        return hasher.hexdigest()
+
+    def _load_or_build_cached_dataset(self):
+        """ Load the processed dataset from cache_dir, building and saving it
+            first if needed. In multi-host jobs only the first host builds the
+            cache, the other hosts wait for it if cache_dir is shared. Sharded
+            datasets are cached per shard by each host.
+        """
+        cache_path = os.path.join(self.config.cache_dir, self.cache_fingerprint())
+        # the marker file is written last, so partial saves are never loaded
+        marker_path = os.path.join(cache_path, 'complete')
+        fs, _ = fsspec.core.url_to_fs(cache_path)
+
+        def save(dataset):
+            dataset.save_to_disk(cache_path)
+            with fs.open(marker_path, 'w') as fout:
+                fout.write(self.config.to_json_best_effort())
+
+        if self.num_shards == 1:
+            if jax.process_index() == 0 and not fs.exists(marker_path):
+                logger.info('Building dataset cache at %s.', cache_path)
+                save(self._build_dataset())
+            if jax.process_count() > 1:
+                multihost_utils.sync_global_devices('json_torch_dataset_cache')
+
+        if fs.exists(marker_path):
+            logger.info('Loading cached dataset from %s.', cache_path)
+            return load_from_disk(cache_path)
+        # cache_dir is not shared with the first host
+        dataset = self._build_dataset()
+        save(dataset)
+        return dataset
+
+    def _compute_lengths(self):
+        """ Number of non-padding tokens of each example. For preference data
+            this is the longer of the chosen and rejected sequences.
+        """
+        mask_columns = [
+            c for c in ('attention_mask', 'chosen_attn_mask', 'rejected_attn_mask')
+            if c in self.dataset.column_names
+        ]
+        lengths = self.dataset.map(
+            lambda x: {'length': [
+                int(max(sum(masks) for masks in example_masks))
+                for example_masks in zip(*[x[c] for c in mask_columns])
+            ]},
+            batched=True,
+            num_proc=self.config.num_workers,
+            remove_columns=self.dataset.column_names,
+        )['length']
+        return np.array(lengths, dtype=np.int64)
+
+    def _pack_sequences(self):
+        """ Bin-pack the padded examples into rows of seq_length tokens using
+            best-fit decreasing. Each row is assembled lazily in __getitem__.
+        """
+        assert 'input_tokens' in self.dataset.column_names, (
+            'Sequence packing is only supported for single sequence datasets.'
+        )
+        self._lengths = self._compute_lengths()
+        # sorted list of (remaining space, row index) for best-fit lookups
+        remaining_space = []
+        packed_rows = []
+        for idx in np.argsort(-self._lengths, kind='stable'):
+            length = self._lengths[idx]
+            position = bisect.bisect_left(remaining_space, (length, -1))
+            if position < len(remaining_space):
+                space, row = remaining_space.pop(position)
+                packed_rows[row].append(int(idx))
+            else:
+                space, row = self.config.seq_length, len(packed_rows)
+                packed_rows.append([int(idx)])
+            bisect.insort(remaining_space, (space - length, row))
+        self._packed_rows = packed_rows
+        self.packing_efficiency = float(
+            np.sum(self._lengths) / (len(packed_rows) * self.config.seq_length)
+        )
+        logger.info(
+            'Packed %d examples into %d rows, packing efficiency %.3f.',
+            len(self.dataset), len(packed_rows), self.packing_efficiency
+        )
+
+    def _get_packed_row(self, idx):
+        seq_length = self.config.seq_length
+        input_tokens = np.full(seq_length, self.tokenizer.pad_token_id, dtype=np.int32)
+        target_tokens = np.full(seq_length, self.tokenizer.pad_token_id, dtype=np.int32)
+        loss_masks = np.zeros(seq_length, dtype=np.float32)
+        segment_ids = np.zeros(seq_length, dtype=np.int32)
+        position_ids = np.zeros(seq_length, dtype=np.int32)
+        start = 0
+        for segment_id, example_idx in enumerate(self._packed_rows[idx], start=1):
+            example = self.dataset[example_idx]
+            length = self._lengths[example_idx]
+            end = start + length
+            input_tokens[start:end] = example['input_tokens'][:length]
+            target_tokens[start:end] = example['target_tokens'][:length]
+            loss_masks[start:end] = example['loss_masks'][:length]
+            segment_ids[start:end] = segment_id
+            position_ids[start:end] = np.arange(length)
+            start = end
+        return {
+            "input_tokens": input_tokens,
+            "target_tokens": target_tokens,
+            "loss_masks": loss_masks,
+            "attention_mask": (segment_ids > 0).astype(np.int32),
+            "segment_ids": segment_ids,
+            "position_ids": position_ids,
+        }
 
     def _json_iterator(self):
         with mlxu.open_file(self.config.path, 'r') as fin:
@@ -601,8 +1411,20 @@ class JsonTorchDataset(object):
                 yield data
 
     def __getitem__(self, idx):
+        if self._packed_rows is not None:
+            return self._get_packed_row(idx)
         return self.dataset[idx]
 
+    def _process_batch(self, samples, indices):
+        """ Process a batch of samples for datasets.map(batched=True). Subclasses
+            can override this to tokenize the whole batch at once.
+        """
+        outputs = [
+            self._process_sample({key: samples[key][i] for key in samples}, idx)
+            for i, idx in enumerate(indices)
+        ]
+        return {key: [output[key] for output in outputs] for key in outputs[0]}
+
     def _process_sample(self, sample, idx):
         tokens = self.tokenizer.encode(sample['prompt'] + sample['completion'])
         truncated = False
@@ -633,7 +1455,17 @@ class JsonTorchDataset(object):
         }
 
     def __len__(self):
-        return len(self.dataset)
+        if self._packed_rows is not None:
+            length = len(self._packed_rows)
+        else:
+            length = len(self.dataset)
+        if self._max_length is not None:
+            length = min(length, self._max_length)
+        return length
+
+    @property
+    def local_batch_size(self):
+        return self.config.batch_size // self.num_shards
 
     @property
     def seq_length(self):
@@ -656,7 +1488,20 @@ class TuluJsonTorchDataset(JsonTorchDataset):
 
     def _process_sample(self, sample, idx):
         # run tulu processor
-        tokens, labels, attention_mask, truncated = self.encode_with_messages_format(sample['messages'], self.tokenizer, self.config.seq_length)
+        return self._format_encoded_example(*self.encode_with_messages_format(
+            sample['messages'], self.tokenizer, self.config.seq_length,
+            check=self.config.check_tokenization,
+        ))
+
+    def _process_batch(self, samples, indices):
+        encoded = self.encode_batch_with_messages_format(
+            samples['messages'], self.tokenizer, self.config.seq_length,
+            check=self.config.check_tokenization,
+        )
+        outputs = [self._format_encoded_example(*x) for x in encoded]
+        return {key: [output[key] for output in outputs] for key in outputs[0]}
+
+    def _format_encoded_example(self, tokens, labels, attention_mask, truncated):
         loss_masks = [1.0 if x != -100 else 0.0 for x in labels]
         # before padding, account for shifting
         input_tokens = tokens[:-1].tolist()
@@ -676,24 +1521,134 @@ class TuluJsonTorchDataset(JsonTorchDataset):
             "truncated": truncated,
         }
 
-    def encode_with_messages_format(self, messages, tokenizer, max_seq_length, only_train_last_message=False):
+    @staticmethod
+    def _concat_messages(messages, tokenizer):
+        message_text = ""
+        for message in messages:
+            if message["role"] == "system":
+                message_text += "<|system|>\n" + message["content"].strip() + "\n"
+            elif message["role"] == "user":
+                message_text += "<|user|>\n" + message["content"].strip() + "\n"
+            elif message["role"] == "assistant":
+                message_text += "<|assistant|>\n" + message["content"].strip() + tokenizer.eos_token + "\n"
+            else:
+                raise ValueError("Invalid role: {}".format(message["role"]))
+        return message_text
+
+    @classmethod
+    def _concat_messages_with_spans(cls, messages, tokenizer, only_train_last_message):
+        """ Concatenate messages in the tulu format, returning the text and the
+            character spans that are masked out of the loss.
+        """
         if len(messages) == 0:
             raise ValueError('messages field is empty.')
         if only_train_last_message and messages[-1]["role"] != "assistant":
             raise ValueError('last message is not assistant despite the fact we are only training on it.')
 
-        def _concat_messages(messages):
-            message_text = ""
-            for message in messages:
-                if message["role"] == "system":
-                    message_text += "<|system|>\n" + message["content"].strip() + "\n"
-                elif message["role"] == "user":
-                    message_text += "<|user|>\n" + message["content"].strip() + "\n"
-                elif message["role"] == "assistant":
-                    message_text += "<|assistant|>\n" + message["content"].strip() + tokenizer.eos_token + "\n"
-                else:
-                    raise ValueError("Invalid role: {}".format(message["role"]))
-            return message_text
+        message_text = ""
+        masked_spans = []
+        for message_idx, message in enumerate(messages):
+            message_start = len(message_text)
+            message_text += cls._concat_messages([message], tokenizer)
+            message_end = len(message_text)
+            # mask the non-assistant part for avoiding loss
+            # optionally, we mask all but the final message.
+            if message["role"] != "assistant" or (only_train_last_message and message_idx < len(messages) - 1):
+                if message_idx < len(messages) - 1 and messages[message_idx+1]["role"] == "assistant":
+                    # here we also ignore the role of the assistant
+                    message_end += len("<|assistant|>\n")
+                masked_spans.append((message_start, message_end))
+        return message_text, masked_spans
+
+    @classmethod
+    def encode_batch_with_messages_format(cls, batch_messages, tokenizer, max_seq_length, only_train_last_message=False, check=True):
+        """ Tokenize a batch of conversations in a single tokenizer call. Each
+            conversation is tokenized once, and the labels are built from the
+            token offsets instead of re-tokenizing every message prefix. With
+            check, every example is compared against the prefix tokenization,
+            which is used instead when they differ, so the output is always
+            identical to it.
+        """
+        if not getattr(tokenizer, 'is_fast', False):
+            # offset mappings are only available for fast tokenizers
+            return [
+                cls._encode_with_messages_format_by_prefix(
+                    messages, tokenizer, max_seq_length, only_train_last_message
+                )
+                for messages in batch_messages
+            ]
+
+        example_texts, example_masked_spans = [], []
+        for messages in batch_messages:
+            message_text, masked_spans = cls._concat_messages_with_spans(
+                messages, tokenizer, only_train_last_message
+            )
+            example_texts.append(tokenizer.bos_token + message_text.strip())
+            example_masked_spans.append(masked_spans)
+
+        tokenized = tokenizer(
+            example_texts,
+            add_special_tokens=False,
+            return_offsets_mapping=True,
+            return_attention_mask=False,
+        )
+        bos_length = len(tokenizer.bos_token)
+        outputs = []
+        for input_ids, offsets, masked_spans in zip(
+                tokenized['input_ids'], tokenized['offset_mapping'], example_masked_spans):
+            # the number of tokens starting before a character boundary is the
+            # length of the tokenized text up to that boundary.
+            token_starts = [start for start, _ in offsets]
+            labels = list(input_ids)
+            for span_start, span_end in masked_spans:
+                start_idx = bisect.bisect_left(token_starts, bos_length + span_start)
+                end_idx = bisect.bisect_left(token_starts, bos_length + span_end)
+                labels[start_idx:end_idx] = [-100] * (end_idx - start_idx)
+            truncated = len(input_ids) > max_seq_length
+            input_ids = np.array(input_ids[:max_seq_length], dtype=np.int64)
+            labels = np.array(labels[:max_seq_length], dtype=np.int64)
+            outputs.append((input_ids, labels, np.ones_like(input_ids), truncated))
+
+        if check:
+            for i, messages in enumerate(batch_messages):
+                expected = cls._encode_with_messages_format_by_prefix(
+                    messages, tokenizer, max_seq_length, only_train_last_message
+                )
+                if not cls._encoded_examples_equal(outputs[i], expected):
+                    logger.warning(
+                        'Offset based tokenization differs from the prefix '
+                        'tokenization, falling back to the prefix tokenization.'
+                    )
+                    outputs[i] = expected
+        return outputs
+
+    @staticmethod
+    def _encoded_examples_equal(x, y):
+        input_ids_x, labels_x, _, truncated_x = x
+        input_ids_y, labels_y, _, truncated_y = y
+        return (
+            truncated_x == truncated_y
+            and np.array_equal(np.asarray(input_ids_x), np.asarray(input_ids_y))
+            and np.array_equal(np.asarray(labels_x), np.asarray(labels_y))
+        )
+
+    @classmethod
+    def encode_with_messages_format(cls, messages, tokenizer, max_seq_length, only_train_last_message=False, check=True):
+        return cls.encode_batch_with_messages_format(
+            [messages], tokenizer, max_seq_length, only_train_last_message, check
+        )[0]
+
+    @classmethod
+    def _encode_with_messages_format_by_prefix(cls, messages, tokenizer, max_seq_length, only_train_last_message=False):
+        """ Reference implementation that tokenizes every message prefix, used
+            for slow tokenizers without offset mappings.
+        """
+        if len(messages) == 0:
+            raise ValueError('messages field is empty.')
+        if only_train_last_message and messages[-1]["role"] != "assistant":
+            raise ValueError('last message is not assistant despite the fact we are only training on it.')
+
+        _concat_messages = partial(cls._concat_messages, tokenizer=tokenizer)
 
         example_text = _concat_messages(messages).strip()
         example_text = tokenizer.bos_token + example_text
@@ -757,8 +1712,23 @@ class TuluJsonTorchDataset(JsonTorchDataset):
 class PreferenceDataset(TuluJsonTorchDataset):
 
     def _process_sample(self, sample, idx):
-        chosen_input_ids, chosen_labels, chosen_attn_mask, chosen_truncated = self.encode_with_messages_format(sample['chosen'], self.tokenizer, self.config.seq_length, only_train_last_message=True)
-        rejected_input_ids, rejected_labels, rejected_attn_mask, rejected_truncated = self.encode_with_messages_format(sample['rejected'], self.tokenizer, self.config.seq_length, only_train_last_message=True)
+        chosen = self.encode_with_messages_format(sample['chosen'], self.tokenizer, self.config.seq_length, only_train_last_message=True, check=self.config.check_tokenization)
+        rejected = self.encode_with_messages_format(sample['rejected'], self.tokenizer, self.config.seq_length, only_train_last_message=True, check=self.config.check_tokenization)
+        return self._format_encoded_pair(chosen, rejected, idx, sample.get('margin'))
+
+    def _process_batch(self, samples, indices):
+        chosen = self.encode_batch_with_messages_format(samples['chosen'], self.tokenizer, self.config.seq_length, only_train_last_message=True, check=self.config.check_tokenization)
+        rejected = self.encode_batch_with_messages_format(samples['rejected'], self.tokenizer, self.config.seq_length, only_train_last_message=True, check=self.config.check_tokenization)
+        margins = samples.get('margin', [None] * len(indices))
+        outputs = [
+            self._format_encoded_pair(*x)
+            for x in zip(chosen, rejected, indices, margins)
+        ]
+        return {key: [output[key] for output in outputs] for key in outputs[0]}
+
+    def _format_encoded_pair(self, chosen, rejected, idx, margin=None):
+        chosen_input_ids, chosen_labels, chosen_attn_mask, chosen_truncated = chosen
+        rejected_input_ids, rejected_labels, rejected_attn_mask, rejected_truncated = rejected
         # convert to lists
         chosen_input_ids = chosen_input_ids.tolist()
         chosen_labels = chosen_labels.tolist()
@@ -788,8 +1758,8 @@ class PreferenceDataset(TuluJsonTorchDataset):
         }
 
         # add margin if it exists
-        if 'margin' in sample:
-            batch_item['margin'] = np.array(sample['margin'], dtype=np.float32)
+        if margin is not None:
+            batch_item['margin'] = np.array(margin, dtype=np.float32)
         return batch_item
 
 
@@ -843,6 +1813,75 @@ class TuluPromptDataset(JsonTorchDataset):
         }
     
 
+class LengthBucketSampler(object):
+    """ Batch sampler that groups examples into buckets by length, so that
+        each batch only needs to be padded to its bucket length. Examples are
+        shuffled within each bucket and batches are shuffled across buckets.
+        Incomplete batches of each bucket are dropped.
+    """
+
+    def __init__(self, lengths, buckets, batch_size, shuffle=True):
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        bucket_ids = np.searchsorted(buckets, lengths, side='left')
+        self.bucket_indices = [
+            np.nonzero(bucket_ids == i)[0] for i in range(len(buckets))
+        ]
+
+    def __iter__(self):
+        batches = []
+        for indices in self.bucket_indices:
+            if self.shuffle:
+                # use the torch RNG so that the order is the same across hosts
+                indices = indices[torch.randperm(len(indices)).numpy()]
+            for i in range(0, len(indices) - self.batch_size + 1, self.batch_size):
+                batches.append(indices[i:i + self.batch_size].tolist())
+        if self.shuffle:
+            batches = [batches[i] for i in torch.randperm(len(batches)).tolist()]
+        return iter(batches)
+
+    def __len__(self):
+        return sum(len(indices) // self.batch_size for indices in self.bucket_indices)
+
+
+def length_bucket_data_collator(buckets, seq_length, features, bucket_length=None):
+    """ Collate a batch and truncate the padding down to the smallest bucket
+        length that fits the longest example in the batch, or to bucket_length
+        if it is given.
+    """
+    batch = numpy_default_data_collator(features)
+    if bucket_length is None:
+        length = max(
+            int(np.max(np.sum(batch[key], axis=1)))
+            for key in ('attention_mask', 'chosen_attn_mask', 'rejected_attn_mask')
+            if key in batch
+        )
+        bucket_length = buckets[int(np.searchsorted(buckets, length, side='left'))]
+    for key, value in batch.items():
+        if value.ndim >= 2 and value.shape[1] == seq_length:
+            batch[key] = value[:, :bucket_length]
+    return batch
+
+
+def length_bucket_batch_shapes(dataset, batch_size):
+    """ Shapes and dtypes of the batches of each length bucket of a dataset,
+        as produced by length_bucket_data_collator, keyed by bucket length.
+        Used to compile the train step for every bucket ahead of time.
+    """
+    features = [dataset[0]] * batch_size
+    batch_shapes = {}
+    for bucket_length in dataset.length_buckets:
+        batch = length_bucket_data_collator(
+            dataset.length_buckets, dataset.seq_length, features,
+            bucket_length=bucket_length,
+        )
+        batch_shapes[bucket_length] = {
+            key: jax.ShapeDtypeStruct(value.shape, value.dtype)
+            for key, value in batch.items()
+        }
+    return batch_shapes
+
+
 # util method for padding out a batch to match a batch size. This lets us use small batches
 # while still respecting the TPU sharding
 def pad_out_to_full_batch(desired_batch_size, batch):
@@ -857,6 +1896,127 @@ def pad_out_to_full_batch(desired_batch_size, batch):
         )
     return batch
 
+
+class ReferenceLogps(object):
+    """ Reference model log probabilities of a preference dataset, looked up
+        by the example indices that the dataset yields with every batch.
+    """
+
+    def __init__(self):
+        self.chosen_logps = None
+        self.rejected_logps = None
+
+    def update(self, indices, chosen_logps, rejected_logps):
+        """ Set the reference logps of this shard from computed values. """
+        self._build_lookup(
+            np.asarray(indices, dtype=np.int64).reshape(-1),
+            np.asarray(chosen_logps, dtype=np.float32).reshape(-1),
+            np.asarray(rejected_logps, dtype=np.float32).reshape(-1),
+        )
+
+    def _build_lookup(self, indices, chosen_logps, rejected_logps):
+        size = int(np.max(indices)) + 1 if len(indices) > 0 else 0
+        self.chosen_logps = np.full(size, np.nan, dtype=np.float32)
+        self.rejected_logps = np.full(size, np.nan, dtype=np.float32)
+        self.chosen_logps[indices] = chosen_logps
+        self.rejected_logps[indices] = rejected_logps
+
+    def __call__(self, indices):
+        """ Return the chosen and rejected reference logps of a batch. """
+        indices = np.asarray(indices).reshape(-1)
+        chosen_logps = self.chosen_logps[indices]
+        rejected_logps = self.rejected_logps[indices]
+        assert not np.isnan(chosen_logps).any(), (
+            'Reference logps are missing for some examples.'
+        )
+        return chosen_logps, rejected_logps
+
+
+def checkpoint_fingerprint(checkpoint):
+    """ Fingerprint of the contents of a checkpoint given as type::path.
+        Sharded and distributed checkpoints are identified by their index
+        files, which record the hash or layout of every tensor, and single
+        file checkpoints by their size and modification time or checksum.
+    """
+    load_type, path = checkpoint.split('::', 1)
+    fs, _ = fsspec.core.url_to_fs(path)
+    hasher = Hasher()
+    hasher.update(load_type)
+    if fs.isdir(path):
+        for filename in sorted(fs.ls(path, detail=False)):
+            if filename.endswith('.json'):
+                with fs.open(filename, 'rb') as fin:
+                    hasher.update(fin.read())
+    else:
+        info = fs.info(path)
+        hasher.update(info['size'])
+        for key in ('md5Hash', 'crc32c', 'ETag', 'etag', 'mtime', 'updated', 'LastModified'):
+            if key in info:
+                hasher.update(str(info[key]))
+                break
+    return hasher.hexdigest()
+
+
+class ReferenceLogpsCache(ReferenceLogps):
+    """ On-disk cache of the reference model log probabilities of a preference
+        dataset, keyed by the dataset fingerprint, the contents of the
+        reference checkpoint, or the seed when the reference model is not
+        loaded from a checkpoint, and the sequence length. Each dataset shard
+        is stored in its own file, so with shard_by_process every host
+        computes and stores only the examples it holds.
+    """
+
+    def __init__(self, cache_dir, dataset, reference_checkpoint, extra=None, seed=None):
+        super().__init__()
+        assert cache_dir != '', 'The reference logps cache requires a cache_dir'
+        hasher = Hasher()
+        hasher.update(dataset.cache_fingerprint())
+        if reference_checkpoint != '':
+            # computed on the first host, so that every host uses the same key
+            fingerprint = ''
+            if jax.process_index() == 0:
+                fingerprint = checkpoint_fingerprint(reference_checkpoint)
+            hasher.update(broadcast_string(fingerprint))
+        else:
+            # the reference model is randomly initialized from the seed
+            hasher.update(seed)
+        hasher.update(dataset.seq_length)
+        hasher.update(extra)
+        self.fingerprint = hasher.hexdigest()
+        self.shard_index = getattr(dataset, 'shard_index', 0)
+        self.num_shards = getattr(dataset, 'num_shards', 1)
+        self.path = os.path.join(
+            cache_dir, self.fingerprint,
+            f'shard_{self.shard_index:05d}_of_{self.num_shards:05d}.npz'
+        )
+
+    def load(self):
+        """ Load this shard from disk, returning whether it was found. """
+        fs, _ = fsspec.core.url_to_fs(self.path)
+        if not fs.exists(self.path):
+            return False
+        with mlxu.open_file(self.path, 'rb') as fin:
+            data = np.load(fin)
+            self._build_lookup(data['indices'], data['chosen_logps'], data['rejected_logps'])
+        logger.info('Loaded reference logps from %s.', self.path)
+        return True
+
+    def save(self):
+        valid = ~np.isnan(self.chosen_logps)
+        if '://' not in self.path:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        buffer = io.BytesIO()
+        np.savez(
+            buffer, indices=np.nonzero(valid)[0],
+            chosen_logps=self.chosen_logps[valid],
+            rejected_logps=self.rejected_logps[valid],
+        )
+        # a single write, so a partially written shard is never loaded
+        with mlxu.open_file(self.path, 'wb') as fout:
+            fout.write(buffer.getvalue())
+        logger.info('Saved reference logps to %s.', self.path)
+
+
 if __name__ == "__main__":
     from EasyLM.models.llama.llama_model import LlamaTokenizerFast
     tokenizer = LlamaTokenizerFast.from_pretrained('Meta-Llama-3-8B')
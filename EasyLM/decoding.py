@@ -0,0 +1,863 @@
+import queue
+import threading
+from collections import deque, OrderedDict
+from concurrent.futures import Future
+
+import numpy as np
+from ml_collections import ConfigDict
+import jax
+import jax.numpy as jnp
+
+
+def warp_logits(logits, temperature, top_k=0, top_p=1.0):
+    """ Apply temperature, top k and top p filtering to a batch of logits.
+        Filtered out tokens get a logit of -inf. temperature has one entry
+        per row, and must be positive.
+    """
+    logits = logits.astype(jnp.float32) / temperature[:, None]
+    if top_k > 0:
+        kth_logit = jax.lax.top_k(logits, top_k)[0][:, -1:]
+        logits = jnp.where(logits < kth_logit, -jnp.inf, logits)
+    if top_p < 1.0:
+        sorted_logits = jnp.sort(logits, axis=-1)[:, ::-1]
+        cumulative_probs = jnp.cumsum(jax.nn.softmax(sorted_logits, axis=-1), axis=-1)
+        # keep the smallest set of tokens whose probability reaches top_p
+        cutoff_index = jnp.sum(cumulative_probs < top_p, axis=-1, keepdims=True)
+        cutoff_logit = jnp.take_along_axis(sorted_logits, cutoff_index, axis=-1)
+        logits = jnp.where(logits < cutoff_logit, -jnp.inf, logits)
+    return logits
+
+
+def sample_next_tokens(logits, rng, temperature, top_k=0, top_p=1.0):
+    """ Sample one token per row of logits. Rows with a temperature of 0 are
+        decoded greedily.
+    """
+    greedy_tokens = jnp.argmax(logits, axis=-1)
+    sampled_tokens = jax.random.categorical(
+        rng, warp_logits(logits, jnp.maximum(temperature, 1e-6), top_k, top_p), axis=-1
+    )
+    return jnp.where(temperature > 0, sampled_tokens, greedy_tokens).astype(jnp.int32)
+
+
+def token_probs(logits, temperature, top_k=0, top_p=1.0):
+    """ The distribution sample_next_tokens samples from for a batch of
+        logits, which is one hot for rows with a temperature of 0.
+    """
+    probs = jax.nn.softmax(
+        warp_logits(logits, jnp.maximum(temperature, 1e-6), top_k, top_p), axis=-1
+    )
+    greedy_probs = jax.nn.one_hot(
+        jnp.argmax(logits, axis=-1), logits.shape[-1], dtype=probs.dtype
+    )
+    return jnp.where(temperature[:, None] > 0, probs, greedy_probs)
+
+
+def speculative_decode_step(target_forward, draft_forward, target_cache, draft_cache,
+                            last_tokens, cache_lengths, active, rng, temperature,
+                            num_draft_tokens, top_k=0, top_p=1.0):
+    """ One round of speculative decoding for a batch of sequences. last_tokens
+        holds the last token of every sequence, which is not in the caches
+        yet. The draft model proposes num_draft_tokens tokens after it, and the
+        target model scores all of them in a single forward. Draft tokens are
+        accepted with the rejection sampling rule of Leviathan et al., and a
+        token is sampled from the residual distribution at the first rejection,
+        or from the target model when all are accepted, so the outputs follow
+        the sampling distribution of the target model exactly.
+
+        target_forward and draft_forward have the signature of
+        FlaxLLaMAForCausalLM.cached_forward without params. Rows that are not
+        active are not written to the caches. Returns the updated caches,
+        num_draft_tokens + 1 tokens of which the first num_accepted + 1 are
+        the new tokens of each sequence, and num_accepted. Both caches then
+        hold last_tokens and all draft tokens, and the caller rolls back the
+        rejected ones by advancing cache_lengths by num_accepted + 1 only.
+    """
+    batch_size = last_tokens.shape[0]
+    rngs = jax.random.split(rng, num_draft_tokens + 2)
+    input_mask = active.astype(jnp.int32)[:, None]
+
+    tokens = last_tokens
+    draft_tokens, draft_probs = [], []
+    for i in range(num_draft_tokens + 1):
+        logits, draft_cache = draft_forward(
+            draft_cache, tokens[:, None], cache_lengths + i, input_mask
+        )
+        if i == num_draft_tokens:
+            # the last draft token is only written, in case all are accepted
+            break
+        probs = token_probs(logits[:, 0], temperature, top_k, top_p)
+        tokens = jax.random.categorical(rngs[i], jnp.log(probs), axis=-1).astype(jnp.int32)
+        draft_tokens.append(tokens)
+        draft_probs.append(probs)
+    draft_tokens = jnp.stack(draft_tokens, axis=1)
+    draft_probs = jnp.stack(draft_probs, axis=1)
+
+    logits, target_cache = target_forward(
+        target_cache, jnp.concatenate([last_tokens[:, None], draft_tokens], axis=1),
+        cache_lengths, jnp.repeat(input_mask, num_draft_tokens + 1, axis=1),
+    )
+    vocab_size = logits.shape[-1]
+    target_probs = token_probs(
+        logits.reshape(-1, vocab_size),
+        jnp.repeat(temperature, num_draft_tokens + 1), top_k, top_p,
+    ).reshape(batch_size, num_draft_tokens + 1, vocab_size)
+
+    # accept a draft token with probability min(1, p / q)
+    p = jnp.take_along_axis(target_probs[:, :-1], draft_tokens[:, :, None], axis=-1)[..., 0]
+    q = jnp.take_along_axis(draft_probs, draft_tokens[:, :, None], axis=-1)[..., 0]
+    accepted = jax.random.uniform(rngs[-2], p.shape) * q < p
+    num_accepted = jnp.sum(jnp.cumprod(accepted.astype(jnp.int32), axis=1), axis=1)
+
+    # resample from max(p - q, 0) at the first rejection, and from the target
+    # distribution after the last draft token
+    draft_probs = jnp.concatenate(
+        [draft_probs, jnp.zeros_like(draft_probs[:, :1])], axis=1
+    )
+    residual = jnp.maximum(target_probs - draft_probs, 0.0)
+    residual = jnp.take_along_axis(residual, num_accepted[:, None, None], axis=1)[:, 0]
+    fallback = jnp.take_along_axis(target_probs, num_accepted[:, None, None], axis=1)[:, 0]
+    residual = jnp.where(jnp.sum(residual, axis=-1, keepdims=True) > 0, residual, fallback)
+    next_tokens = jax.random.categorical(rngs[-1], jnp.log(residual), axis=-1)
+
+    tokens = jnp.concatenate([draft_tokens, jnp.zeros_like(draft_tokens[:, :1])], axis=1)
+    tokens = jnp.where(
+        jnp.arange(num_draft_tokens + 1)[None, :] == num_accepted[:, None],
+        next_tokens[:, None], tokens
+    ).astype(jnp.int32)
+    return target_cache, draft_cache, tokens, num_accepted
+
+
+def speculative_generate(target_forward, draft_forward, target_cache, draft_cache,
+                         input_ids, attention_mask, rng, max_new_tokens,
+                         num_draft_tokens, eos_token_id, pad_token_id,
+                         temperature=1.0, top_k=0, top_p=1.0):
+    """ Sample up to max_new_tokens tokens after a batch of left padded
+        prompts with speculative decoding, for use inside jit in place of HF
+        generate. The caches must be empty and hold at least the prompt
+        length + max_new_tokens + num_draft_tokens + 1 tokens. Returns the
+        prompts followed by the generated tokens, padded after EOS, and the
+        total number of proposed and accepted draft tokens.
+    """
+    batch_size, prompt_length = input_ids.shape
+    output_length = max_new_tokens + num_draft_tokens + 1
+    temperature = jnp.full((batch_size, ), temperature, dtype=jnp.float32)
+    batch_index = jnp.arange(batch_size)[:, None]
+
+    # move the prompts to the start of each row, and prefill all but the last
+    # prompt token, which is fed by the first round
+    prompt_lengths = jnp.sum(attention_mask, axis=1).astype(jnp.int32)
+    prompt_tokens = jnp.take_along_axis(
+        input_ids,
+        (jnp.arange(prompt_length)[None, :] + prompt_length - prompt_lengths[:, None]) % prompt_length,
+        axis=1
+    )
+    prefill_mask = jnp.arange(prompt_length)[None, :] < prompt_lengths[:, None] - 1
+    cache_lengths = jnp.zeros((batch_size, ), dtype=jnp.int32)
+    logit_positions = jnp.zeros((batch_size, 1), dtype=jnp.int32)
+    _, target_cache = target_forward(
+        target_cache, prompt_tokens, cache_lengths, prefill_mask.astype(jnp.int32),
+        logit_positions,
+    )
+    _, draft_cache = draft_forward(
+        draft_cache, prompt_tokens, cache_lengths, prefill_mask.astype(jnp.int32),
+        logit_positions,
+    )
+
+    def cond_fn(state):
+        return jnp.logical_not(jnp.all(state['finished']))
+
+    def body_fn(state):
+        rng, step_rng = jax.random.split(state['rng'])
+        active = jnp.logical_not(state['finished'])
+        target_cache, draft_cache, tokens, num_accepted = speculative_decode_step(
+            target_forward, draft_forward, state['target_cache'], state['draft_cache'],
+            state['last_tokens'], state['cache_lengths'], active, step_rng,
+            temperature, num_draft_tokens, top_k, top_p,
+        )
+        num_new_tokens = jnp.where(active, num_accepted + 1, 0)
+        # drop the tokens after EOS
+        is_eos = (tokens == eos_token_id) & (
+            jnp.arange(num_draft_tokens + 1)[None, :] < num_new_tokens[:, None]
+        )
+        has_eos = jnp.any(is_eos, axis=1)
+        num_new_tokens = jnp.where(
+            has_eos, jnp.argmax(is_eos, axis=1) + 1, num_new_tokens
+        )
+        positions = jnp.where(
+            jnp.arange(num_draft_tokens + 1)[None, :] < num_new_tokens[:, None],
+            state['num_generated'][:, None] + jnp.arange(num_draft_tokens + 1)[None, :],
+            output_length,
+        )
+        num_generated = state['num_generated'] + num_new_tokens
+        return dict(
+            rng=rng,
+            target_cache=target_cache,
+            draft_cache=draft_cache,
+            last_tokens=jnp.take_along_axis(
+                tokens, jnp.maximum(num_new_tokens - 1, 0)[:, None], axis=1
+            )[:, 0],
+            cache_lengths=state['cache_lengths'] + num_new_tokens,
+            output=state['output'].at[batch_index, positions].set(tokens, mode='drop'),
+            num_generated=num_generated,
+            finished=state['finished'] | has_eos | (num_generated >= max_new_tokens),
+            num_draft_tokens=state['num_draft_tokens'] + num_draft_tokens * jnp.sum(active),
+            num_accepted_tokens=state['num_accepted_tokens'] + jnp.sum(
+                jnp.where(active, num_accepted, 0)
+            ),
+        )
+
+    state = jax.lax.while_loop(cond_fn, body_fn, dict(
+        rng=rng,
+        target_cache=target_cache,
+        draft_cache=draft_cache,
+        last_tokens=jnp.take_along_axis(
+            prompt_tokens, jnp.maximum(prompt_lengths - 1, 0)[:, None], axis=1
+        )[:, 0].astype(jnp.int32),
+        cache_lengths=jnp.maximum(prompt_lengths - 1, 0),
+        output=jnp.full((batch_size, output_length), pad_token_id, dtype=jnp.int32),
+        num_generated=jnp.zeros((batch_size, ), dtype=jnp.int32),
+        finished=jnp.zeros((batch_size, ), dtype=jnp.bool_),
+        num_draft_tokens=jnp.zeros((), dtype=jnp.int32),
+        num_accepted_tokens=jnp.zeros((), dtype=jnp.int32),
+    ))
+    sequences = jnp.concatenate(
+        [input_ids, state['output'][:, :max_new_tokens].astype(input_ids.dtype)], axis=1
+    )
+    return sequences, state['num_draft_tokens'], state['num_accepted_tokens']
+
+
+class DecodeRequest(object):
+    """ A generation or scoring request tracked by the DecodeEngine. Scoring
+        requests have target_tokens, the token following each prompt token,
+        and accumulate the log likelihood of the targets from score_start on.
+        A request with forks only prefills a shared prefix, whose pages are
+        then handed to the fork requests as their shared_pages.
+    """
+
+    def __init__(self, prompt_tokens, max_new_tokens, temperature=0.0, stop_fn=None,
+                 target_tokens=None, score_start=0):
+        self.prompt_tokens = list(prompt_tokens)
+        self.max_new_tokens = max_new_tokens
+        self.temperature = temperature
+        self.stop_fn = stop_fn
+        self.target_tokens = target_tokens
+        self.score_start = score_start
+        self.loglikelihood = 0.0
+        self.is_greedy = True
+        self.output_tokens = []
+        # tokens to write to the cache before decoding, which include the
+        # tokens generated so far when a preempted request is resumed
+        self.prefill_tokens = list(prompt_tokens)
+        self.prefill_position = 0
+        self.forks = None
+        self.shared_pages = []
+        self.future = Future()
+
+    @property
+    def prefilling(self):
+        return self.prefill_position < len(self.prefill_tokens)
+
+    @property
+    def reusable_length(self):
+        # leading prefill tokens whose outputs are not needed, which can be
+        # taken from the prefix cache
+        if self.target_tokens is not None:
+            return self.score_start
+        return len(self.prefill_tokens) - 1
+
+
+class DecodeEngine(object):
+    """ Continuous batching decode engine. The engine owns a KV cache with a
+        fixed number of sequence slots and runs one model step at a time over
+        all of them in a background thread. New requests are admitted into free
+        slots between steps, prompts are prefilled in chunks alongside the
+        slots that are decoding, and sequences are retired at EOS, when a stop
+        condition is met, or when their slot is full.
+
+        With a page_size, the cache is paged: slots do not reserve max_length
+        tokens each, but take fixed size pages from a shared pool of num_pages
+        pages as they grow, so many more slots fit in the same memory. Requests
+        are only admitted when there are free pages for their prompt, and when
+        the pool runs out, the most recently admitted sequence is preempted:
+        its pages are freed and it is later resumed by prefilling its prompt
+        and the tokens generated so far.
+
+        A paged cache can also keep a prefix cache of prefix_cache_pages
+        pages. Every full page of a sequence is keyed by a hash of all the
+        tokens up to the end of the page, and new requests whose prompt starts
+        with cached pages share those pages and only prefill the rest of the
+        prompt. Pages no longer used by any sequence stay cached up to the
+        budget and are evicted least recently used first, also when the pool
+        needs free pages.
+
+        The engine is model agnostic. step_fn(tokens, num_new_tokens,
+        cache_lengths, temperature, page_tables) must write the first
+        num_new_tokens tokens of each row of tokens into the cache after the
+        cache_lengths tokens already in that slot, and return the next token
+        sampled after the last new token of each row. page_tables lists the
+        pages of each slot for a paged cache, and is None otherwise. Scoring
+        requests additionally need score_fn, which takes the target token
+        following every new token as an extra argument, and returns the next
+        tokens, the log probability of every target and whether every target
+        is the greedy token.
+
+        With a speculate_fn, steps in which no slot is prefilling decode
+        several tokens per slot with speculative decoding.
+        speculate_fn(last_tokens, cache_lengths, temperature, page_tables,
+        active) must run speculative_decode_step with num_draft_tokens draft
+        tokens, and return its tokens and num_accepted. step_fn and score_fn
+        must then also write the new tokens to the draft model cache.
+    """
+
+    @staticmethod
+    def get_default_config(updates=None):
+        config = ConfigDict()
+        config.num_slots = 16
+        config.prefill_chunk_size = 128
+        config.page_size = 0
+        config.num_pages = 0
+        config.prefix_cache_pages = 0
+        config.num_draft_tokens = 4
+
+        if updates is not None:
+            config.update(ConfigDict(updates).copy_and_resolve_references())
+        return config
+
+    def __init__(self, config, step_fn, max_length, eos_token_id, pad_token_id=0,
+                 score_fn=None, speculate_fn=None):
+        self.config = self.get_default_config(config)
+        self.step_fn = step_fn
+        self.score_fn = score_fn
+        self.speculate_fn = speculate_fn
+        self.max_length = max_length
+        self.eos_token_id = eos_token_id
+        self.pad_token_id = pad_token_id
+        self.slots = [None] * self.config.num_slots
+        self.cache_lengths = np.zeros(self.config.num_slots, dtype=np.int32)
+        self.admission_order = np.zeros(self.config.num_slots, dtype=np.int64)
+        self.paged = self.config.page_size > 0
+        if self.paged:
+            self.pages_per_slot = -(-max_length // self.config.page_size)
+            assert self.config.num_pages >= self.pages_per_slot, (
+                'num_pages must hold at least one sequence of max_length tokens'
+            )
+            self.page_tables = np.zeros(
+                (self.config.num_slots, self.pages_per_slot), dtype=np.int32
+            )
+            self.slot_pages = [[] for _ in range(self.config.num_slots)]
+            self.free_pages = list(range(self.config.num_pages))
+            self.page_refcounts = np.zeros(self.config.num_pages, dtype=np.int32)
+        self.prefix_caching = self.config.prefix_cache_pages > 0
+        if self.prefix_caching:
+            assert self.paged, 'The prefix cache requires a paged cache'
+            # prefix hash to page, and page to prefix hash for cached pages
+            self.prefix_cache = {}
+            self.page_hashes = {}
+            # cached pages not used by any sequence, least recently used first
+            self.idle_cached_pages = OrderedDict()
+            self.slot_hashes = [[] for _ in range(self.config.num_slots)]
+        self.total_steps = 0
+        self.total_generated_tokens = 0
+        self.total_admitted = 0
+        self.total_preemptions = 0
+        self.total_prefix_lookups = 0
+        self.total_prefix_hits = 0
+        self.total_prefill_tokens = 0
+        self.total_saved_prefill_tokens = 0
+        self.total_draft_tokens = 0
+        self.total_accepted_draft_tokens = 0
+        self._waiting = deque()
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, prompt_tokens, max_new_tokens, temperature=0.0, stop_fn=None):
+        """ Queue a request and return a future of its generated tokens, not
+            including EOS. stop_fn(output_tokens) can end generation early.
+        """
+        assert 0 < len(prompt_tokens) < self.max_length, (
+            f'Prompt length must be between 1 and {self.max_length - 1}'
+        )
+        request = DecodeRequest(prompt_tokens, max_new_tokens, temperature, stop_fn)
+        self._queue.put(request)
+        return request.future
+
+    def submit_loglikelihood(self, tokens, continuation_start):
+        """ Queue a scoring request and return a future of the total log
+            likelihood of tokens[continuation_start:] given the tokens before,
+            and whether all of them are greedy.
+        """
+        if continuation_start == len(tokens):
+            future = Future()
+            future.set_result((0.0, True))
+            return future
+        request = self._scoring_request(tokens, continuation_start)
+        self._queue.put(request)
+        return request.future
+
+    def submit_loglikelihood_group(self, prefix_tokens, continuations):
+        """ Score several continuations of the same prefix and return a list
+            of futures like submit_loglikelihood. With a paged cache, the
+            prefix is only prefilled once, and its pages are then shared by
+            all continuations, which only prefill the partially filled last
+            page of the prefix and themselves.
+        """
+        prefix_tokens = list(prefix_tokens)
+        num_shared_pages = 0
+        if self.paged:
+            # the continuations need the logits of the last prefix token
+            num_shared_pages = (len(prefix_tokens) - 1) // self.config.page_size
+        if len(continuations) < 2 or num_shared_pages == 0:
+            return [
+                self.submit_loglikelihood(prefix_tokens + list(x), len(prefix_tokens))
+                for x in continuations
+            ]
+        futures = []
+        forks = []
+        for continuation in continuations:
+            if len(continuation) == 0:
+                futures.append(self.submit_loglikelihood(prefix_tokens, len(prefix_tokens)))
+                continue
+            request = self._scoring_request(
+                prefix_tokens + list(continuation), len(prefix_tokens)
+            )
+            forks.append(request)
+            futures.append(request.future)
+        if len(forks) > 0:
+            request = DecodeRequest(
+                prefix_tokens[:num_shared_pages * self.config.page_size], 0
+            )
+            request.forks = forks
+            self._queue.put(request)
+        return futures
+
+    def _scoring_request(self, tokens, continuation_start):
+        assert 0 < continuation_start < len(tokens) <= self.max_length + 1, (
+            f'Scored sequences must have at most {self.max_length + 1} tokens'
+        )
+        assert self.score_fn is not None, 'Scoring requires a score_fn'
+        tokens = list(tokens)
+        # the last token is only a target and never written to the cache
+        return DecodeRequest(
+            tokens[:-1], 0, target_tokens=tokens[1:],
+            score_start=continuation_start - 1,
+        )
+
+    def generate(self, prompts, max_new_tokens, temperature=0.0, stop_fn=None):
+        futures = [
+            self.submit(prompt, max_new_tokens, temperature, stop_fn)
+            for prompt in prompts
+        ]
+        return [future.result() for future in futures]
+
+    @property
+    def metrics(self):
+        metrics = {
+            'decode_engine_active_slots': sum(x is not None for x in self.slots),
+            'decode_engine_queued_requests': self._queue.qsize() + len(self._waiting),
+            'decode_engine_total_steps': self.total_steps,
+            'decode_engine_total_generated_tokens': self.total_generated_tokens,
+        }
+        if self.paged:
+            metrics['decode_engine_free_pages'] = len(self.free_pages)
+            metrics['decode_engine_total_preemptions'] = self.total_preemptions
+        if self.prefix_caching:
+            metrics['decode_engine_prefix_cache_pages'] = len(self.prefix_cache)
+            metrics['decode_engine_prefix_cache_hit_rate'] = (
+                self.total_prefix_hits / max(self.total_prefix_lookups, 1)
+            )
+            metrics['decode_engine_total_prefill_tokens'] = self.total_prefill_tokens
+            metrics['decode_engine_total_saved_prefill_tokens'] = (
+                self.total_saved_prefill_tokens
+            )
+        if self.speculate_fn is not None:
+            metrics['decode_engine_draft_acceptance_rate'] = (
+                self.total_accepted_draft_tokens / max(self.total_draft_tokens, 1)
+            )
+        return metrics
+
+    def _run(self):
+        while True:
+            try:
+                # only block waiting for requests when there is nothing to decode
+                self._admit(block=all(x is None for x in self.slots))
+                if any(x is not None for x in self.slots):
+                    self._step()
+            except Exception as e:
+                # fail every request the engine holds, so that no caller
+                # waits forever on a request that will never be stepped
+                for slot, request in enumerate(self.slots):
+                    if request is not None:
+                        self._fail(request, e)
+                        self._retire(slot)
+                while len(self._waiting) > 0:
+                    self._fail(self._waiting.popleft(), e)
+                while True:
+                    try:
+                        self._fail(self._queue.get_nowait(), e)
+                    except queue.Empty:
+                        break
+
+    def _fail(self, request, error):
+        for fork in request.forks or []:
+            self._fail(fork, error)
+        # waiting forks hold a reference to their shared pages
+        for page in request.shared_pages:
+            self._release_page(page)
+        request.shared_pages = []
+        if not request.future.done():
+            request.future.set_exception(error)
+
+    def _admit(self, block):
+        if block and len(self._waiting) == 0:
+            self._waiting.append(self._queue.get())
+        while True:
+            try:
+                self._waiting.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        while len(self._waiting) > 0 and None in self.slots:
+            request = self._waiting[0]
+            # forks already hold a reference to their shared pages
+            shared = len(request.shared_pages) > 0
+            cached_prefix = request.shared_pages
+            if not shared and self.prefix_caching:
+                cached_prefix = self._lookup_prefix(request)
+            if self.paged:
+                needed_pages = self._num_pages(
+                    min(len(request.prefill_tokens) + 1, self.max_length)
+                ) - len(cached_prefix)
+                available_pages = len(self.free_pages)
+                if self.prefix_caching:
+                    available_pages += len(self.idle_cached_pages) - sum(
+                        page in self.idle_cached_pages for page in cached_prefix
+                    )
+                if available_pages < needed_pages:
+                    if any(x is not None for x in self.slots):
+                        # pages are freed as the active sequences finish
+                        break
+                    # nothing is running, so the missing pages are held by
+                    # waiting forks, which then prefill their prefix instead
+                    if self._unpin_waiting_forks(request):
+                        continue
+                    self._waiting.popleft()
+                    self._fail(request, RuntimeError(
+                        'Not enough free pages to admit the request'
+                    ))
+                    continue
+            self._waiting.popleft()
+            slot = self.slots.index(None)
+            self.slots[slot] = request
+            self.cache_lengths[slot] = 0
+            self.total_admitted += 1
+            self.admission_order[slot] = self.total_admitted
+            if shared or self.prefix_caching:
+                self._reuse_prefix(slot, cached_prefix, shared)
+
+    def _retire(self, slot):
+        self.slots[slot] = None
+        self.cache_lengths[slot] = 0
+        if self.paged:
+            for page in self.slot_pages[slot]:
+                self._release_page(page)
+            self.slot_pages[slot] = []
+        if self.prefix_caching:
+            self.slot_hashes[slot] = []
+
+    def _num_pages(self, num_tokens):
+        return -(-num_tokens // self.config.page_size)
+
+    def _allocate_pages(self, slot, num_tokens):
+        """ Make sure the slot has pages for num_tokens tokens. """
+        pages = self.slot_pages[slot]
+        while len(pages) < self._num_pages(num_tokens):
+            if len(self.free_pages) == 0 and not self._evict_cached_page():
+                return False
+            page = self.free_pages.pop()
+            self.page_refcounts[page] = 1
+            self.page_tables[slot, len(pages)] = page
+            pages.append(page)
+        return True
+
+    def _release_page(self, page):
+        self.page_refcounts[page] -= 1
+        if self.page_refcounts[page] > 0:
+            return
+        if self.prefix_caching and page in self.page_hashes:
+            self.idle_cached_pages[page] = None
+            while len(self.idle_cached_pages) > self.config.prefix_cache_pages:
+                self._evict_cached_page()
+        else:
+            self.free_pages.append(page)
+
+    def _evict_cached_page(self):
+        """ Move the least recently used idle cached page to the free pages. """
+        if not self.prefix_caching or len(self.idle_cached_pages) == 0:
+            return False
+        page, _ = self.idle_cached_pages.popitem(last=False)
+        del self.prefix_cache[self.page_hashes.pop(page)]
+        self.free_pages.append(page)
+        return True
+
+    def _page_hash(self, parent_hash, tokens, page_index):
+        page_size = self.config.page_size
+        return hash((
+            parent_hash,
+            tuple(tokens[page_index * page_size:(page_index + 1) * page_size])
+        ))
+
+    def _lookup_prefix(self, request):
+        """ Return the pages of the longest cached prefix of the request that
+            it does not need to compute.
+        """
+        cached_prefix = []
+        parent_hash = None
+        for page_index in range(request.reusable_length // self.config.page_size):
+            parent_hash = self._page_hash(parent_hash, request.prefill_tokens, page_index)
+            if parent_hash not in self.prefix_cache:
+                break
+            cached_prefix.append(self.prefix_cache[parent_hash])
+        return cached_prefix
+
+    def _reuse_prefix(self, slot, pages, shared=False):
+        """ Start the slot with the given pages of its prefix already filled. """
+        request = self.slots[slot]
+        for page in pages:
+            if not shared:
+                self.idle_cached_pages.pop(page, None)
+                self.page_refcounts[page] += 1
+            self.page_tables[slot, len(self.slot_pages[slot])] = page
+            self.slot_pages[slot].append(page)
+            if self.prefix_caching:
+                self.slot_hashes[slot].append(self._page_hash(
+                    self.slot_hashes[slot][-1] if len(self.slot_hashes[slot]) > 0 else None,
+                    request.prefill_tokens, len(self.slot_hashes[slot])
+                ))
+        request.shared_pages = []
+        num_reused_tokens = len(pages) * self.config.page_size
+        self.cache_lengths[slot] = num_reused_tokens
+        request.prefill_position = num_reused_tokens
+        self.total_saved_prefill_tokens += num_reused_tokens
+        if not shared:
+            self.total_prefix_lookups += 1
+            self.total_prefix_hits += int(num_reused_tokens > 0)
+
+    def _fork(self, slot):
+        """ Hand the pages of a prefilled shared prefix to its forks. """
+        request = self.slots[slot]
+        for fork in reversed(request.forks):
+            fork.shared_pages = list(self.slot_pages[slot])
+            self.page_refcounts[fork.shared_pages] += 1
+            self._waiting.appendleft(fork)
+        request.future.set_result(None)
+        self._retire(slot)
+
+    def _unpin_waiting_forks(self, keep):
+        """ Release the shared pages held by the waiting forks other than
+            keep. Returns whether any pages were released.
+        """
+        released = False
+        for request in self._waiting:
+            if request is keep or len(request.shared_pages) == 0:
+                continue
+            for page in request.shared_pages:
+                self._release_page(page)
+            request.shared_pages = []
+            released = True
+        return released
+
+    def _cache_full_pages(self, slot):
+        """ Add the pages of a slot which have been filled to the prefix cache. """
+        request = self.slots[slot]
+        hashes = self.slot_hashes[slot]
+        tokens = None
+        while len(hashes) < self.cache_lengths[slot] // self.config.page_size:
+            if tokens is None:
+                # the tokens in the cache, also for resumed requests
+                tokens = request.prompt_tokens + request.output_tokens
+            page_index = len(hashes)
+            page_hash = self._page_hash(
+                hashes[-1] if page_index > 0 else None, tokens, page_index
+            )
+            hashes.append(page_hash)
+            page = self.slot_pages[slot][page_index]
+            # identical pages computed concurrently are not cached twice
+            if page_hash not in self.prefix_cache and page not in self.page_hashes:
+                self.prefix_cache[page_hash] = page
+                self.page_hashes[page] = page_hash
+
+    def _preempt(self, slot):
+        request = self.slots[slot]
+        request.prefill_tokens = request.prompt_tokens + request.output_tokens
+        request.prefill_position = 0
+        request.loglikelihood = 0.0
+        request.is_greedy = True
+        self._retire(slot)
+        self._waiting.appendleft(request)
+        self.total_preemptions += 1
+
+    def _reserve_pages(self, slot, num_tokens):
+        """ Allocate pages for num_tokens tokens in the slot, preempting the
+            most recently admitted sequences when the pool is exhausted.
+            Returns False if the slot itself was preempted.
+        """
+        while not self._allocate_pages(slot, num_tokens):
+            victim = max(
+                (x for x in range(self.config.num_slots) if self.slots[x] is not None),
+                key=lambda x: self.admission_order[x]
+            )
+            self._preempt(victim)
+            if victim == slot:
+                return False
+        return True
+
+    def _append_token(self, slot, token):
+        """ Add a sampled token to the output of a slot, and retire it if the
+            sequence is finished. Returns whether it is finished.
+        """
+        request = self.slots[slot]
+        if token == self.eos_token_id:
+            finished = True
+        else:
+            request.output_tokens.append(token)
+            self.total_generated_tokens += 1
+            finished = (
+                len(request.output_tokens) >= request.max_new_tokens
+                # the last token has no room to be written to the cache
+                or self.cache_lengths[slot] >= self.max_length
+                or (request.stop_fn is not None and request.stop_fn(request.output_tokens))
+            )
+        if finished:
+            request.future.set_result(request.output_tokens)
+            self._retire(slot)
+        return finished
+
+    def _speculative_step(self):
+        num_slots = self.config.num_slots
+        num_draft_tokens = self.config.num_draft_tokens
+        last_tokens = np.full(num_slots, self.pad_token_id, dtype=np.int32)
+        active = np.zeros(num_slots, dtype=np.bool_)
+        temperature = np.zeros(num_slots, dtype=np.float32)
+        for slot in np.argsort(self.admission_order):
+            request = self.slots[slot]
+            if request is None:
+                continue
+            # the draft tokens are written to the cache before verification,
+            # and those past the end of the slot are dropped
+            if self.paged and not self._reserve_pages(slot, min(
+                self.cache_lengths[slot] + num_draft_tokens + 1,
+                self.pages_per_slot * self.config.page_size,
+            )):
+                continue
+            last_tokens[slot] = request.output_tokens[-1]
+            active[slot] = True
+            temperature[slot] = request.temperature
+        if not np.any(active):
+            return
+
+        page_tables = self.page_tables.copy() if self.paged else None
+        tokens, num_accepted = (np.asarray(x) for x in self.speculate_fn(
+            last_tokens, self.cache_lengths.copy(), temperature, page_tables, active
+        ))
+        self.total_steps += 1
+
+        for slot, request in enumerate(self.slots):
+            if request is None:
+                continue
+            self.total_draft_tokens += num_draft_tokens
+            self.total_accepted_draft_tokens += int(num_accepted[slot])
+            for i in range(num_accepted[slot] + 1):
+                # the last token and the draft tokens before token i are
+                # now in the cache
+                self.cache_lengths[slot] += 1
+                if self._append_token(slot, int(tokens[slot, i])):
+                    break
+            if self.slots[slot] is not None and self.prefix_caching:
+                self._cache_full_pages(slot)
+
+    def _step(self):
+        if any(x is not None and x.prefilling for x in self.slots):
+            chunk_size = self.config.prefill_chunk_size
+        elif self.speculate_fn is not None:
+            return self._speculative_step()
+        else:
+            chunk_size = 1
+        num_slots = self.config.num_slots
+        tokens = np.full((num_slots, chunk_size), self.pad_token_id, dtype=np.int32)
+        num_new_tokens = np.zeros(num_slots, dtype=np.int32)
+        temperature = np.zeros(num_slots, dtype=np.float32)
+        target_tokens = None
+        # the oldest sequences get pages first and the newest are preempted
+        for slot in np.argsort(self.admission_order):
+            request = self.slots[slot]
+            if request is None:
+                continue
+            if request.prefilling:
+                new_tokens = request.prefill_tokens[
+                    request.prefill_position:request.prefill_position + chunk_size
+                ]
+            else:
+                new_tokens = request.output_tokens[-1:]
+            if self.paged and not self._reserve_pages(
+                slot, self.cache_lengths[slot] + len(new_tokens)
+            ):
+                continue
+            tokens[slot, :len(new_tokens)] = new_tokens
+            num_new_tokens[slot] = len(new_tokens)
+            temperature[slot] = request.temperature
+            if request.prefilling:
+                self.total_prefill_tokens += len(new_tokens)
+            if request.target_tokens is not None:
+                if target_tokens is None:
+                    target_tokens = np.full_like(tokens, self.pad_token_id)
+                target_tokens[slot, :len(new_tokens)] = request.target_tokens[
+                    request.prefill_position:request.prefill_position + len(new_tokens)
+                ]
+        if not np.any(num_new_tokens > 0):
+            return
+
+        page_tables = self.page_tables.copy() if self.paged else None
+        if target_tokens is None:
+            next_tokens = np.asarray(self.step_fn(
+                tokens, num_new_tokens, self.cache_lengths.copy(), temperature,
+                page_tables,
+            ))
+        else:
+            next_tokens, target_logprobs, target_is_greedy = (
+                np.asarray(x) for x in self.score_fn(
+                    tokens, num_new_tokens, self.cache_lengths.copy(), temperature,
+                    page_tables, target_tokens,
+                )
+            )
+        self.total_steps += 1
+
+        for slot, request in enumerate(self.slots):
+            if request is None:
+                continue
+            self.cache_lengths[slot] += num_new_tokens[slot]
+            if self.prefix_caching:
+                self._cache_full_pages(slot)
+            if request.forks is not None:
+                request.prefill_position += num_new_tokens[slot]
+                if not request.prefilling:
+                    self._fork(slot)
+                continue
+            if request.target_tokens is not None:
+                positions = request.prefill_position + np.arange(num_new_tokens[slot])
+                scored = positions >= request.score_start
+                request.loglikelihood += float(
+                    np.sum(target_logprobs[slot, :num_new_tokens[slot]][scored])
+                )
+                request.is_greedy = request.is_greedy and bool(
+                    np.all(target_is_greedy[slot, :num_new_tokens[slot]][scored])
+                )
+                request.prefill_position += num_new_tokens[slot]
+                if not request.prefilling:
+                    request.future.set_result((request.loglikelihood, request.is_greedy))
+                    self._retire(slot)
+                continue
+            if request.prefilling:
+                request.prefill_position += num_new_tokens[slot]
+                if request.prefilling:
+                    continue
+            self._append_token(slot, int(next_tokens[slot]))
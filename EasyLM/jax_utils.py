@@ -5,6 +5,9 @@ from functools import partial
 import re
 import dataclasses
 import random
+import time
+import queue
+import threading
 from ml_collections import ConfigDict
 from ml_collections.config_dict.config_dict import placeholder
 
@@ -12,8 +15,9 @@ import flax
 import jax
 import jax.numpy as jnp
 from jax.sharding import PartitionSpec as PS
-from jax.sharding import Mesh
+from jax.sharding import Mesh, NamedSharding
 from jax.experimental import mesh_utils
+from jax.experimental import multihost_utils
 from jax.experimental.pjit import with_sharding_constraint as _with_sharding_constraint
 from jax.experimental.pjit import pjit
 from jax.interpreters import pxla
@@ -89,6 +93,145 @@ class FlaxTemperatureLogitsWarper(FlaxLogitsWarper):
         return scores / jnp.clip(self.temperature, a_min=1e-8)
 
 
+def make_array_from_host_data(sharding, x, process_local=False):
+    """ Create a global array from host data. With process_local, every host
+        holds its own slice of the global array along the first axis, in
+        process order, otherwise every host holds the whole global array.
+    """
+    x = np.asarray(x)
+    if not process_local:
+        return jax.make_array_from_callback(x.shape, sharding, lambda index: x[index])
+    if hasattr(jax, 'make_array_from_process_local_data'):
+        return jax.make_array_from_process_local_data(sharding, x)
+
+    # older jax: the local slice covers the rows addressed by the local devices
+    global_shape = (x.shape[0] * jax.process_count(), ) + x.shape[1:]
+    index_map = sharding.addressable_devices_indices_map(global_shape)
+    row_ranges = [index[0].indices(global_shape[0])[:2] for index in index_map.values()]
+    local_start = min(start for start, _ in row_ranges)
+    local_stop = max(stop for _, stop in row_ranges)
+    assert local_stop - local_start == x.shape[0], (
+        'The process local data does not match the rows addressed by the local devices.'
+    )
+
+    def callback(index):
+        start, stop = index[0].indices(global_shape[0])[:2]
+        return x[(slice(start - local_start, stop - local_start), ) + tuple(index[1:])]
+
+    return jax.make_array_from_callback(global_shape, sharding, callback)
+
+
+class DevicePrefetchIterator(object):
+    """ Iterate over a host data loader in a background thread and place the
+        next few batches on device ahead of time, so that batch collation and
+        host to device transfer overlap with the train step. Streaming datasets
+        yielding (batch, metrics) pairs are supported, only the batch is moved
+        to device. Keys in host_keys are left on host as numpy arrays.
+
+        The iterable runs ahead of the consumer, so its resume state is taken
+        with state_fn in the background thread after every batch, and
+        state_dict is the state as of the last batch returned by the iterator.
+    """
+    _end_of_data = object()
+
+    def __init__(self, iterable, mesh, partition_spec=PS(('dp', 'fsdp')),
+                 prefetch_size=2, process_local=False, host_keys=(),
+                 state_fn=None):
+        self.sharding = NamedSharding(mesh, partition_spec)
+        # process_local means each host only loads its own slice of the
+        # global batch, otherwise every host holds the full global batch.
+        self.process_local = process_local
+        self.host_keys = set(host_keys)
+        self._state_fn = state_fn
+        self._state_dict = state_fn() if state_fn is not None else None
+        self._queue = queue.Queue(maxsize=prefetch_size)
+        self._stop_event = threading.Event()
+        self._finished = False
+        self._queue_depth = 0
+        self._wait_time = 0.0
+        self._total_wait_time = 0.0
+        self._num_batches = 0
+        self._thread = threading.Thread(
+            target=self._prefetch, args=(iterable, ), daemon=True
+        )
+        self._thread.start()
+
+    def _to_device(self, batch):
+        return {
+            key: np.asarray(value) if key in self.host_keys
+            else make_array_from_host_data(self.sharding, value, self.process_local)
+            for key, value in batch.items()
+        }
+
+    def _put(self, item):
+        while not self._stop_event.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _prefetch(self, iterable):
+        try:
+            for item in iterable:
+                if isinstance(item, (list, tuple)):
+                    item = (self._to_device(item[0]), item[1])
+                else:
+                    item = self._to_device(item)
+                state = self._state_fn() if self._state_fn is not None else None
+                if not self._put((item, state)):
+                    return
+        except Exception as e:
+            self._put(e)
+            return
+        self._put(self._end_of_data)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._finished:
+            raise StopIteration
+        self._queue_depth = self._queue.qsize()
+        start_time = time.time()
+        item = self._queue.get()
+        self._wait_time = time.time() - start_time
+        if item is self._end_of_data:
+            self._finished = True
+            raise StopIteration
+        if isinstance(item, Exception):
+            self._finished = True
+            raise item
+        item, self._state_dict = item
+        self._total_wait_time += self._wait_time
+        self._num_batches += 1
+        return item
+
+    def close(self):
+        """ Stop the background thread and release the prefetched batches. """
+        self._stop_event.set()
+        self._finished = True
+        while True:
+            try:
+                self._queue.get_nowait()
+            except queue.Empty:
+                break
+        self._thread.join()
+
+    @property
+    def state_dict(self):
+        return self._state_dict
+
+    @property
+    def metrics(self):
+        return {
+            'prefetch_queue_depth': self._queue_depth,
+            'prefetch_wait_time': self._wait_time,
+            'prefetch_average_wait_time': self._total_wait_time / max(self._num_batches, 1),
+        }
+
+
 def make_shard_and_gather_fns(partition_specs, dtype_specs=None):
     """ Create pytree of sharding and gathering functions from pytree of
         partition specs.
@@ -112,7 +255,17 @@ def make_shard_and_gather_fns(partition_specs, dtype_specs=None):
             out_shardings=partition_spec
         )
         def shard_fn(tensor):
+            mesh = pxla.thread_resources.env.physical_mesh
+            if isinstance(tensor, np.ndarray) and not mesh.empty:
+                # Transfer only the slices each local device needs, straight
+                # from the host array, which may be a memory mapped file.
+                tensor = jax.make_array_from_callback(
+                    tensor.shape, NamedSharding(mesh, partition_spec),
+                    lambda index: tensor[index]
+                )
             return jax_shard_function(tensor).block_until_ready()
+        # Exposed so that checkpoint loaders can place shards directly
+        shard_fn.partition_spec = partition_spec
         return shard_fn
 
     def make_gather_fn(partition_spec, dtype_spec=None):
@@ -138,6 +291,18 @@ def make_shard_and_gather_fns(partition_specs, dtype_specs=None):
     return shard_fns, gather_fns
 
 
+def broadcast_string(value, max_length=4096):
+    """ Broadcast a string from process 0 to all processes. """
+    if jax.process_count() == 1:
+        return value
+    data = np.zeros(max_length, dtype=np.uint8)
+    encoded = np.frombuffer(value.encode('utf-8'), dtype=np.uint8)
+    assert len(encoded) <= max_length, 'String too long to broadcast'
+    data[:len(encoded)] = encoded
+    data = np.asarray(multihost_utils.broadcast_one_to_all(data))
+    return data.tobytes().rstrip(b'\0').decode('utf-8')
+
+
 def set_random_seed(seed):
     np.random.seed(seed)
     random.seed(seed)
@@ -20,11 +20,16 @@
 import gc
 import json
 import os
+import re
 import shutil
+from collections import deque
+from multiprocessing import Pool
 
+import numpy as np
 import mlxu
 from flax.traverse_util import flatten_dict
 import torch
+from safetensors.torch import save_file
 from transformers import LlamaConfig, LlamaForCausalLM, LlamaForSequenceClassification
 
 from EasyLM.checkpoint import StreamingCheckpointer
@@ -37,6 +42,8 @@ FLAGS, FLAGS_DEF = mlxu.define_flags_with_default(
     model_size='13b',
     output_dir='',
     is_reward_model=False,
+    streaming=False,
+    num_workers=4,
 )
 
 
@@ -191,6 +198,184 @@ def load_and_convert_checkpoint(path):
     return torch_params
 
 
+def permute_rotary(w, n_heads, dims_per_head, dim):
+    """ Permute the query or key projection for the sliced rotary embedding
+        used by HuggingFace LLaMA. """
+    return w.view(n_heads, dims_per_head // 2, 2, dim).transpose(1, 2).reshape(
+        n_heads * dims_per_head, dim
+    )
+
+
+STREAMING_LAYER_KEYS = {
+    'attention.wq.kernel': 'self_attn.q_proj.weight',
+    'attention.wk.kernel': 'self_attn.k_proj.weight',
+    'attention.wv.kernel': 'self_attn.v_proj.weight',
+    'attention.wo.kernel': 'self_attn.o_proj.weight',
+    'feed_forward.w1.kernel': 'mlp.gate_proj.weight',
+    'feed_forward.w2.kernel': 'mlp.down_proj.weight',
+    'feed_forward.w3.kernel': 'mlp.up_proj.weight',
+    'attention_norm.kernel': 'input_layernorm.weight',
+    'ffn_norm.kernel': 'post_attention_layernorm.weight',
+}
+
+STREAMING_OTHER_KEYS = {
+    'transformer.wte.embedding': 'model.embed_tokens.weight',
+    'transformer.ln_f.kernel': 'model.norm.weight',
+    'lm_head.kernel': 'lm_head.weight',
+    'score.kernel': 'score.weight',
+}
+
+
+def to_torch_bf16(tensor):
+    tensor = np.ascontiguousarray(tensor)
+    if tensor.dtype.name == 'bfloat16':
+        # Reinterpret the bits instead of going through a float32 copy
+        return torch.from_numpy(tensor.view(np.int16)).view(torch.bfloat16)
+    return torch.from_numpy(tensor.astype(np.float32)).to(torch.bfloat16)
+
+
+def convert_streaming_tensor(key, tensor, params):
+    """ Convert a single EasyLM tensor to its HuggingFace name and layout. """
+    n_heads = params['n_heads']
+    n_kv_heads = params.get('n_kv_heads', n_heads)
+    dim = params['dim']
+    dims_per_head = dim // n_heads
+
+    match = re.match(r'transformer\.h\.(\d+)\.(.*)', key)
+    if match is not None:
+        layer_i, name = match.groups()
+        hf_key = f'model.layers.{layer_i}.{STREAMING_LAYER_KEYS[name]}'
+    else:
+        hf_key = STREAMING_OTHER_KEYS[key]
+
+    tensor = to_torch_bf16(tensor)
+    if match_keywords(key, ['kernel'], ['norm', 'ln_f']):
+        tensor = tensor.T.contiguous()
+    if key.endswith('attention.wq.kernel'):
+        tensor = permute_rotary(tensor, n_heads, dims_per_head, dim)
+    elif key.endswith('attention.wk.kernel'):
+        tensor = permute_rotary(tensor, n_kv_heads, dims_per_head, dim)
+    return hf_key, tensor.contiguous()
+
+
+def write_streaming_shard(tensors, path, params):
+    """ Convert a group of tensors and write them as one safetensors file. """
+    state_dict = dict(
+        convert_streaming_tensor(key, tensor, params) for key, tensor in tensors
+    )
+    save_file(state_dict, path, metadata={'format': 'pt'})
+    return {key: value.numel() * value.element_size() for key, value in state_dict.items()}
+
+
+def stream_convert_checkpoint(load_from, model_path, model_size,
+                              is_reward_model=False, num_workers=4):
+    """ Convert an EasyLM checkpoint to HuggingFace safetensors without
+        materializing the model. Tensors are read one at a time, grouped by
+        layer, and each layer is converted and written as its own shard by a
+        pool of worker processes. At most num_workers layers are held in
+        memory at once, in addition to the layers still being read.
+    """
+    os.makedirs(model_path, exist_ok=True)
+    params = LLAMA_STANDARD_CONFIGS[model_size]
+    n_layers = params['n_layers']
+    num_files = n_layers + 3
+    other_file_index = {
+        'transformer.wte.embedding': n_layers + 1,
+        'transformer.ln_f.kernel': n_layers + 2,
+        'lm_head.kernel': n_layers + 3,
+        'score.kernel': n_layers + 3,
+    }
+
+    load_type, load_path = load_from.split('::', 1)
+    assert load_type in ('params', 'trainstate_params'), (
+        'Streaming conversion supports params:: and trainstate_params:: checkpoints'
+    )
+    tensors = StreamingCheckpointer.iterate_checkpoint(
+        load_path,
+        remove_dict_prefix=('params', 'params') if load_type == 'trainstate_params' else None,
+    )
+
+    def tensor_groups():
+        # Tensors are buffered per output file, and each file is emitted once
+        # all of its tensors have been read, so the checkpoint order does not
+        # matter. Tensors of a layer are usually contiguous, which keeps a
+        # single layer in the buffer.
+        groups = {}
+        emitted = set()
+        for key, tensor in tensors:
+            key = '.'.join(key)
+            match = re.match(r'transformer\.h\.(\d+)\.', key)
+            if match is not None:
+                index, group_size = int(match.group(1)) + 1, len(STREAMING_LAYER_KEYS)
+            else:
+                index, group_size = other_file_index[key], 1
+            assert index not in emitted, (
+                f'{key} belongs to {filename(index)}, which was already written'
+            )
+            groups.setdefault(index, []).append((key, tensor))
+            if len(groups[index]) == group_size:
+                emitted.add(index)
+                yield index, groups.pop(index)
+        # files missing some tensors are written with the ones that exist
+        for index in sorted(groups):
+            yield index, groups.pop(index)
+
+    def filename(index):
+        return f'model-{index:05d}-of-{num_files:05d}.safetensors'
+
+    weight_map = {}
+    total_size = 0
+    pending = deque()
+
+    def collect(index, sizes):
+        nonlocal total_size
+        for key, size in sizes.items():
+            weight_map[key] = filename(index)
+            total_size += size
+
+    pool = Pool(num_workers) if num_workers > 0 else None
+    for index, group in tensor_groups():
+        path = os.path.join(model_path, filename(index))
+        if pool is None:
+            collect(index, write_streaming_shard(group, path, params))
+            continue
+        while len(pending) >= num_workers:
+            done_index, result = pending.popleft()
+            collect(done_index, result.get())
+        print(f'Converting {filename(index)}')
+        pending.append((index, pool.apply_async(write_streaming_shard, (group, path, params))))
+    while len(pending) > 0:
+        index, result = pending.popleft()
+        collect(index, result.get())
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    write_json(
+        {'metadata': {'total_size': total_size}, 'weight_map': weight_map},
+        os.path.join(model_path, 'model.safetensors.index.json'),
+    )
+    config = LlamaConfig(
+        hidden_size=params['dim'],
+        intermediate_size=params['intermediate_size'],
+        num_attention_heads=params['n_heads'],
+        num_hidden_layers=n_layers,
+        rms_norm_eps=params.get('norm_eps', params.get('rms_norm_eps')),
+        max_position_embeddings=params.get('max_position_embeddings', 8192),
+        num_key_value_heads=params.get('n_kv_heads', params['n_heads']),
+        vocab_size=params.get('vocab_size', 32000),
+        rope_theta=params.get('rope_theta', 100000),
+        rope_scaling=params.get('rope_scaling', None),
+        torch_dtype='bfloat16',
+    )
+    if is_reward_model:
+        config.num_labels = 1
+        config.architectures = ['LlamaForSequenceClassification']
+    else:
+        config.architectures = ['LlamaForCausalLM']
+    config.save_pretrained(model_path)
+
+
 def read_json(path):
     with open(path, "r") as f:
         return json.load(f)
@@ -218,11 +403,11 @@ def write_model(loaded, model_path, model_size, is_reward_model=False):
 
     # permute for sliced rotary
     def permute(w):
-        return w.view(n_heads, dim // n_heads // 2, 2, dim).transpose(1, 2).reshape(dim, dim)
+        return permute_rotary(w, n_heads, dims_per_head, dim)
     
     # gqa means we need a slightly diff permute for the k_proj
     def permute_gqa(w):
-        return w.view(n_kv_heads, dims_per_head // 2, 2, dim).transpose(1, 2).reshape(dims_per_head * n_kv_heads, dim)
+        return permute_rotary(w, n_kv_heads, dims_per_head, dim)
 
 
     param_count = 0
@@ -407,6 +592,15 @@ def main(argv):
             tokenizer_path=FLAGS.output_dir,
             input_tokenizer_path=FLAGS.tokenizer_path,
         )
+    if FLAGS.streaming:
+        stream_convert_checkpoint(
+            FLAGS.load_checkpoint,
+            model_path=FLAGS.output_dir,
+            model_size=FLAGS.model_size,
+            is_reward_model=FLAGS.is_reward_model,
+            num_workers=FLAGS.num_workers,
+        )
+        return
     write_model(
         load_and_convert_checkpoint(FLAGS.load_checkpoint),
         model_path=FLAGS.output_dir,
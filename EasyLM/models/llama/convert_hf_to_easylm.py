@@ -5,14 +5,26 @@ python convert_hf_to_easylm.py  \
        --output_file /path/easylm_format.stream   \
        --model_size 7b \
        --streaming
+
+For large models, add --use_safetensors --mmap to memory map the safetensors
+shards and convert one tensor at a time with a pool of --num_workers workers,
+keeping at most --max_memory_gb of converted tensors in flight.
 """
+import json
+import struct
 import time
+from collections import deque
+from multiprocessing import Pool
 from pathlib import Path
 import argparse
 
+import numpy as np
 import mlxu
 import torch
 import flax
+from flax.serialization import to_bytes
+import jax.numpy as jnp
+import msgpack
 
 from EasyLM.checkpoint import StreamingCheckpointer
 
@@ -85,6 +97,48 @@ LLAMA_STANDARD_CONFIGS = {
             "rope_type": "llama3"
         },
     },
+    '70b31': {
+        'dim': 8192,
+        'intermediate_size': 28672,
+        'n_layers': 80,
+        'n_heads': 64,
+        'n_kv_heads': 8,
+        'norm_eps': 1e-5,
+        'vocab_size': 128256,
+        'rope_theta': 500000,
+        'max_position_embeddings': 131072,
+        'rope_scaling': {
+            "factor": 8.0,
+            "low_freq_factor": 1.0,
+            "high_freq_factor": 4.0,
+            "original_max_position_embeddings": 8192,
+            "rope_type": "llama3"
+        },
+    },
+    '405b31': {
+        'dim': 16384,
+        'intermediate_size': 53248,
+        'n_layers': 126,
+        'n_heads': 128,
+        'n_kv_heads': 16,
+        'norm_eps': 1e-5,
+        'vocab_size': 128256,
+        'rope_theta': 500000,
+        'max_position_embeddings': 131072,
+        'rope_scaling': {
+            "factor": 8.0,
+            "low_freq_factor": 1.0,
+            "high_freq_factor": 4.0,
+            "original_max_position_embeddings": 8192,
+            "rope_type": "llama3"
+        },
+    },
+}
+
+SAFETENSORS_DTYPES = {
+    'BF16': 'bfloat16',
+    'F16': 'float16',
+    'F32': 'float32',
 }
 
 
@@ -95,10 +149,120 @@ def inverse_permute(w, n_heads, input_dim, output_dim):
     return inverted_w
 
 
+def read_safetensors_header(path):
+    """ Return the offset of the data section and the tensor infos of a
+        safetensors file, without reading any tensor data. """
+    with open(path, 'rb') as fin:
+        header_size = struct.unpack('<Q', fin.read(8))[0]
+        header = json.loads(fin.read(header_size))
+    header.pop('__metadata__', None)
+    return 8 + header_size, header
+
+
+def convert_mmap_tensor(task):
+    """ Memory map a single safetensors tensor, convert it to the EasyLM layout
+        and return it serialized, ready to be written to the stream. """
+    key, path, data_offset, info, transform = task
+    start, end = info['data_offsets']
+    tensor = np.memmap(
+        path, dtype=jnp.dtype(SAFETENSORS_DTYPES[info['dtype']]), mode='r',
+        offset=data_offset + start, shape=tuple(info['shape']),
+    )
+    if 'permute' in transform:
+        n_heads, input_dim, output_dim = transform['permute']
+        tensor = inverse_permute(tensor, n_heads, input_dim, output_dim)
+    if transform.get('transpose', False):
+        tensor = tensor.transpose()
+    if 'slice' in transform:
+        tensor = tensor[tuple(slice(*x) for x in transform['slice'])]
+    tensor = tensor.astype(np.float16, order='C')
+    return key, to_bytes(tensor)
+
+
+def mmap_convert(args, params):
+    """ Convert memory mapped safetensors shards to the EasyLM streaming
+        format one tensor at a time. Tensors are converted by a pool of
+        workers, and written in order as soon as they are ready. At most
+        max_memory_gb worth of tensors are converted ahead of the writer.
+    """
+    locations = {}
+    for ckpt_path in sorted(Path(args.checkpoint_dir).glob("*.safetensors")):
+        data_offset, header = read_safetensors_header(ckpt_path)
+        for key, info in header.items():
+            if key.startswith("model."):
+                key = key[6:]
+            locations[key] = (str(ckpt_path), data_offset, info)
+
+    n_heads = params["n_heads"]
+    n_kv_heads = params.get("n_kv_heads", n_heads)
+    dim = params["dim"]
+    tasks = [
+        (('transformer', 'wte', 'embedding'), "embed_tokens.weight", {'slice': [(None, -8)]}),
+        (('transformer', 'ln_f', 'kernel'), "norm.weight", {}),
+    ]
+    for layer in range(params["n_layers"]):
+        prefix = ('transformer', 'h', str(layer))
+        tasks.extend([
+            (prefix + ('attention', 'wq', 'kernel'), f"layers.{layer}.self_attn.q_proj.weight",
+             {'permute': (n_heads, dim, dim), 'transpose': True}),
+            (prefix + ('attention', 'wk', 'kernel'), f"layers.{layer}.self_attn.k_proj.weight",
+             {'permute': (n_kv_heads, dim, dim // (n_heads // n_kv_heads)), 'transpose': True}),
+            (prefix + ('attention', 'wv', 'kernel'), f"layers.{layer}.self_attn.v_proj.weight",
+             {'transpose': True}),
+            (prefix + ('attention', 'wo', 'kernel'), f"layers.{layer}.self_attn.o_proj.weight",
+             {'transpose': True}),
+            (prefix + ('feed_forward', 'w1', 'kernel'), f"layers.{layer}.mlp.gate_proj.weight",
+             {'transpose': True}),
+            (prefix + ('feed_forward', 'w2', 'kernel'), f"layers.{layer}.mlp.down_proj.weight",
+             {'transpose': True}),
+            (prefix + ('feed_forward', 'w3', 'kernel'), f"layers.{layer}.mlp.up_proj.weight",
+             {'transpose': True}),
+            (prefix + ('attention_norm', 'kernel'), f"layers.{layer}.input_layernorm.weight", {}),
+            (prefix + ('ffn_norm', 'kernel'), f"layers.{layer}.post_attention_layernorm.weight", {}),
+        ])
+    tasks.append(
+        (('lm_head', 'kernel'), "lm_head.weight", {'transpose': True, 'slice': [(None,), (None, -8)]})
+    )
+
+    max_bytes = int(args.max_memory_gb * 1024 ** 3)
+    packer = msgpack.Packer()
+    pending = deque()
+    pending_bytes = 0
+    with Pool(args.num_workers) as pool, mlxu.open_file(args.output_file, "wb") as fout:
+        def write_oldest():
+            nonlocal pending_bytes
+            result, nbytes = pending.popleft()
+            key, value = result.get()
+            fout.write(packer.pack((key, value)))
+            pending_bytes -= nbytes
+
+        for key, hf_key, transform in tasks:
+            path, data_offset, info = locations[hf_key]
+            # The converted copy and its serialized bytes both live in memory
+            nbytes = 2 * int(np.prod(info['shape'])) * np.dtype(np.float16).itemsize
+            while len(pending) > 0 and pending_bytes + nbytes > max_bytes:
+                write_oldest()
+            pending.append((
+                pool.apply_async(convert_mmap_tensor, ((key, path, data_offset, info, transform),)),
+                nbytes
+            ))
+            pending_bytes += nbytes
+        while len(pending) > 0:
+            write_oldest()
+
+
 def main(args):
     start = time.time()
     params = LLAMA_STANDARD_CONFIGS[args.model_size]
 
+    if args.mmap:
+        assert args.use_safetensors, 'Memory mapped conversion requires safetensors inputs'
+        mmap_convert(args, params)
+        print(
+            f"Save finished!!! take time: {time.time() - start} save path: {args.output_file}"
+        )
+        return
+
     ckpt = {}
     if args.use_safetensors:
         from safetensors import safe_open
@@ -235,6 +399,23 @@ if __name__ == "__main__":
         action='store_true',
         help='Load SafeTensors for model weights',
     )
+    parser.add_argument(
+        '--mmap',
+        action='store_true',
+        help='Memory map SafeTensors inputs and convert one tensor at a time',
+    )
+    parser.add_argument(
+        '--num_workers',
+        type=int,
+        default=8,
+        help='Number of worker processes for memory mapped conversion',
+    )
+    parser.add_argument(
+        '--max_memory_gb',
+        type=float,
+        default=16,
+        help='Memory budget for tensors in flight in memory mapped conversion',
+    )
 
     args = parser.parse_args()
 
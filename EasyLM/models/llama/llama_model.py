@@ -11,7 +11,7 @@ from jax import lax
 from jax.sharding import PartitionSpec as PS
 import flax.linen as nn
 from flax.core.frozen_dict import FrozenDict, freeze, unfreeze
-from flax.linen import combine_masks, make_causal_mask
+from flax.linen import combine_masks, make_causal_mask, make_attention_mask
 from flax.linen.attention import dot_product_attention_weights
 from flax.traverse_util import flatten_dict, unflatten_dict
 from flax.linen import partitioning as nn_partitioning
@@ -470,6 +470,18 @@ class LLaMAConfig(PretrainedConfig):
             ('.*', PS(None)),
         )
 
+    @staticmethod
+    def get_decode_cache_partition_rules():
+        """ Partition rules for the decode cache created by
+            FlaxLLaMAForCausalLM.init_decode_cache.
+        """
+        return (
+            ("cached_(key|value)", PS(("dp", "fsdp"), None, "mp", None)),
+            # pages are shared by all sequences, so only heads are sharded
+            ("(key|value)_pages", PS(None, None, "mp", None)),
+            ('.*', PS(None)),
+        )
+
     @staticmethod
     def get_weight_decay_exclusions():
         # no bias to exclude
@@ -728,6 +740,79 @@ class FlaxLLaMAAttention(nn.Module):
             attention_mask = combine_masks(pad_mask, attention_mask)
         return key, value, attention_mask
 
+    def _update_decode_cache(self, key, value, attention_mask):
+        """ Write the keys and values of a chunk of new tokens into the decode
+            cache created by FlaxLLaMAForCausalLM.init_decode_cache. Every row
+            is a separate sequence slot with its own length, and the valid new
+            tokens, marked by attention_mask, come first in each row.
+        """
+        cache_lengths = self.get_variable("cache", "cache_lengths")
+        cached_key = self.get_variable("cache", "cached_key")
+        cached_value = self.get_variable("cache", "cached_value")
+        batch_size, max_length = cached_key.shape[:2]
+        positions = cache_lengths[:, None] + jnp.arange(key.shape[1])[None, :]
+        # padding tokens are written out of bounds and dropped
+        write_positions = jnp.where(attention_mask > 0, positions, max_length)
+        batch_index = jnp.broadcast_to(jnp.arange(batch_size)[:, None], positions.shape)
+        cached_key = cached_key.at[batch_index, write_positions].set(
+            key.astype(cached_key.dtype), mode='drop'
+        )
+        cached_value = cached_value.at[batch_index, write_positions].set(
+            value.astype(cached_value.dtype), mode='drop'
+        )
+        self.put_variable("cache", "cached_key", cached_key)
+        self.put_variable("cache", "cached_value", cached_value)
+        # entries past the current position are stale and never attended to
+        attention_mask = jnp.arange(max_length)[None, None, :] <= positions[:, :, None]
+        return (
+            cached_key.astype(key.dtype),
+            cached_value.astype(value.dtype),
+            attention_mask[:, None, :, :],
+        )
+
+    def _update_paged_decode_cache(self, key, value, attention_mask):
+        """ Paged version of _update_decode_cache for the cache created by
+            FlaxLLaMAForCausalLM.init_paged_decode_cache. Keys and values live
+            in a pool of fixed size pages shared by all sequences, and each row
+            has a page table listing the pages that hold its tokens in order.
+            The caller allocates pages for the new tokens before the call.
+        """
+        cache_lengths = self.get_variable("cache", "cache_lengths")
+        page_tables = self.get_variable("cache", "page_tables")
+        key_pages = self.get_variable("cache", "key_pages")
+        value_pages = self.get_variable("cache", "value_pages")
+        num_pages, page_size = key_pages.shape[:2]
+        batch_size, pages_per_sequence = page_tables.shape
+        positions = cache_lengths[:, None] + jnp.arange(key.shape[1])[None, :]
+        table_index = positions // page_size
+        write_pages = jnp.take_along_axis(
+            page_tables, jnp.minimum(table_index, pages_per_sequence - 1), axis=1
+        )
+        # padding tokens are written out of bounds and dropped
+        write_pages = jnp.where(
+            (attention_mask > 0) & (table_index < pages_per_sequence),
+            write_pages, num_pages
+        )
+        key_pages = key_pages.at[write_pages, positions % page_size].set(
+            key.astype(key_pages.dtype), mode='drop'
+        )
+        value_pages = value_pages.at[write_pages, positions % page_size].set(
+            value.astype(value_pages.dtype), mode='drop'
+        )
+        self.put_variable("cache", "key_pages", key_pages)
+        self.put_variable("cache", "value_pages", value_pages)
+        # gather the pages of every sequence through its page table
+        max_length = pages_per_sequence * page_size
+        key = key_pages[page_tables].reshape(
+            (batch_size, max_length) + key_pages.shape[2:]
+        ).astype(key.dtype)
+        value = value_pages[page_tables].reshape(
+            (batch_size, max_length) + value_pages.shape[2:]
+        ).astype(value.dtype)
+        # entries past the current position are stale or unallocated
+        attention_mask = jnp.arange(max_length)[None, None, :] <= positions[:, :, None]
+        return key, value, attention_mask[:, None, :, :]
+
     def repeat_kv(self, x, n_rep):
         """torch.repeat_interleave(x, dim=2, repeats=n_rep)"""
         bs, slen, n_kv_heads, head_dim = x.shape
@@ -748,6 +833,7 @@ class FlaxLLaMAAttention(nn.Module):
         init_cache: bool = False,
         output_attentions: bool = False,
         fcm_mask=None,
+        segment_ids=None,
     ):
         xq, xk, xv = self.wq(hidden_states), self.wk(hidden_states), self.wv(hidden_states)
 
@@ -785,7 +871,12 @@ class FlaxLLaMAAttention(nn.Module):
         if not deterministic and self.config.attn_pdrop > 0.0:
             dropout_rng = self.make_rng("dropout")
 
-        if self.config.scan_attention and not (self.has_variable("cache", "cached_key") or init_cache):
+        decoding = (
+            self.has_variable("cache", "cached_key")
+            or self.has_variable("cache", "cache_lengths")
+            or init_cache
+        )
+        if self.config.scan_attention and not decoding:
             # doesn't need blockwise attention if we are doing autoregressive decoding since no quadratic memory
             # if we have GQA - repeat out. have to do here due to kv cache shenanigans.
             xk = self.repeat_kv(xk, self.num_repetitions)
@@ -805,6 +896,7 @@ class FlaxLLaMAAttention(nn.Module):
                 xk,
                 xv,
                 bias=attention_bias,
+                segment_ids=segment_ids,
                 deterministic=deterministic,
                 dropout_rng=dropout_rng,
                 attn_pdrop=self.config.attn_pdrop,
@@ -819,27 +911,37 @@ class FlaxLLaMAAttention(nn.Module):
             )
             attn_output = with_sharding_constraint(attn_output, PS(("dp", "fsdp"), None, "mp", None))
         else:
-            query_length, key_length = xq.shape[1], xk.shape[1]
-
-            if self.has_variable("cache", "cached_key"):
-                mask_shift = self.variables["cache"]["cache_index"]
-                max_decoder_length = self.variables["cache"]["cached_key"].shape[1]
-                causal_mask = lax.dynamic_slice(
-                    self.causal_mask, (0, 0, mask_shift, 0), (1, 1, query_length, max_decoder_length)
-                )
+            if self.has_variable("cache", "page_tables"):
+                xk, xv, attention_mask = self._update_paged_decode_cache(xk, xv, attention_mask)
+            elif self.has_variable("cache", "cache_lengths"):
+                xk, xv, attention_mask = self._update_decode_cache(xk, xv, attention_mask)
             else:
-                causal_mask = self.causal_mask[:, :, :query_length, :key_length]
-
-            batch_size = hidden_states.shape[0]
-            causal_mask = jnp.broadcast_to(causal_mask, (batch_size,) + causal_mask.shape[1:])
-
-            attention_mask = jnp.broadcast_to(jnp.expand_dims(attention_mask, axis=(-3, -2)), causal_mask.shape)
-            attention_mask = combine_masks(attention_mask, causal_mask, fcm_mask)
-
-            # During fast autoregressive decoding, we feed one position at a time,
-            # and cache the keys and values step by step.
-            if self.has_variable("cache", "cached_key") or init_cache:
-                xk, xv, attention_mask = self._concatenate_to_cache(xk, xv, xq, attention_mask)
+                query_length, key_length = xq.shape[1], xk.shape[1]
+
+                if self.has_variable("cache", "cached_key"):
+                    mask_shift = self.variables["cache"]["cache_index"]
+                    max_decoder_length = self.variables["cache"]["cached_key"].shape[1]
+                    causal_mask = lax.dynamic_slice(
+                        self.causal_mask, (0, 0, mask_shift, 0), (1, 1, query_length, max_decoder_length)
+                    )
+                else:
+                    causal_mask = self.causal_mask[:, :, :query_length, :key_length]
+
+                batch_size = hidden_states.shape[0]
+                causal_mask = jnp.broadcast_to(causal_mask, (batch_size,) + causal_mask.shape[1:])
+
+                attention_mask = jnp.broadcast_to(jnp.expand_dims(attention_mask, axis=(-3, -2)), causal_mask.shape)
+                if segment_ids is not None:
+                    # packed sequences: only attend within the same document
+                    segment_mask = make_attention_mask(segment_ids, segment_ids, jnp.equal)
+                else:
+                    segment_mask = None
+                attention_mask = combine_masks(attention_mask, causal_mask, fcm_mask, segment_mask)
+
+                # During fast autoregressive decoding, we feed one position at a time,
+                # and cache the keys and values step by step.
+                if self.has_variable("cache", "cached_key") or init_cache:
+                    xk, xv, attention_mask = self._concatenate_to_cache(xk, xv, xq, attention_mask)
 
             # grouped query attention: repeat if num_kv_heads < num_heads:
             xk = self.repeat_kv(xk, self.num_repetitions)
@@ -968,6 +1070,7 @@ class FlaxLLaMABlock(nn.Module):
         init_cache: bool = False,
         output_attentions: bool = False,
         fcm_mask: Optional[jnp.ndarray] = None,
+        segment_ids: Optional[jnp.ndarray] = None,
     ):
         attn_outputs = self.attention(
             self.attention_norm(hidden_states),
@@ -977,6 +1080,7 @@ class FlaxLLaMABlock(nn.Module):
             init_cache,
             output_attentions,
             fcm_mask,
+            segment_ids,
         )
         attn_output = attn_outputs[0]
         hidden_states = hidden_states + attn_output
@@ -1182,6 +1286,7 @@ class FlaxLLaMABlockCollection(nn.Module):
         output_attentions: bool = False,
         output_hidden_states: bool = False,
         return_dict: bool = True,
+        segment_ids=None,
     ):
         all_attentions = () if output_attentions else None
         all_hidden_states = () if output_hidden_states else None
@@ -1215,6 +1320,7 @@ class FlaxLLaMABlockCollection(nn.Module):
                 init_cache,
                 output_attentions,
                 fcm_mask,
+                segment_ids,
             )
             hidden_states = layer_outputs[0]
 
@@ -1257,6 +1363,7 @@ class FlaxLLaMAModule(nn.Module):
         output_attentions: bool = False,
         output_hidden_states: bool = False,
         return_dict: bool = True,
+        segment_ids=None,
     ):
         input_embeds = self.wte(input_ids.astype("i4"))
 
@@ -1271,6 +1378,7 @@ class FlaxLLaMAModule(nn.Module):
             output_attentions=output_attentions,
             output_hidden_states=output_hidden_states,
             return_dict=return_dict,
+            segment_ids=segment_ids,
         )
 
         hidden_states = outputs[0]
@@ -1330,6 +1438,7 @@ class FlaxLLaMAForCausalLMModule(nn.Module):
         output_attentions: bool = False,
         output_hidden_states: bool = False,
         return_dict: bool = True,
+        segment_ids=None,
     ):
         batch_size, seq_length = input_ids.shape
         if attention_mask is None:
@@ -1348,21 +1457,37 @@ class FlaxLLaMAForCausalLMModule(nn.Module):
             output_attentions=output_attentions,
             output_hidden_states=output_hidden_states,
             return_dict=return_dict,
+            segment_ids=segment_ids,
         )
 
         hidden_states = outputs[0]
-
-        if self.config.tie_word_embeddings:
-            shared_kernel = self.transformer.variables["params"]["wte"]["embedding"].T
-            lm_logits = self.lm_head.apply({"params": {"kernel": shared_kernel}}, hidden_states)
-        else:
-            lm_logits = self.lm_head(hidden_states)
+        lm_logits = self._lm_logits(hidden_states)
 
         if not return_dict:
             return (lm_logits,) + outputs[1:]
 
         return FlaxCausalLMOutput(logits=lm_logits, hidden_states=outputs.hidden_states, attentions=outputs.attentions)
 
+    def _lm_logits(self, hidden_states):
+        if self.config.tie_word_embeddings:
+            shared_kernel = self.transformer.variables["params"]["wte"]["embedding"].T
+            return self.lm_head.apply({"params": {"kernel": shared_kernel}}, hidden_states)
+        return self.lm_head(hidden_states)
+
+    def decode(self, input_ids, attention_mask, position_ids, logit_positions=None):
+        """ Forward pass against the decode cache. Logits are only computed
+            at logit_positions, of shape (batch, n), if given.
+        """
+        hidden_states = self.transformer(
+            input_ids, attention_mask, position_ids,
+            deterministic=True, return_dict=False,
+        )[0]
+        if logit_positions is not None:
+            hidden_states = jnp.take_along_axis(
+                hidden_states, logit_positions[:, :, None], axis=1
+            )
+        return self._lm_logits(hidden_states)
+
 
 @add_start_docstrings("", "")
 class FlaxLLaMAForCausalLM(FlaxLLaMAPreTrainedModel):
@@ -1394,6 +1519,79 @@ class FlaxLLaMAForCausalLM(FlaxLLaMAPreTrainedModel):
         model_kwargs["position_ids"] = model_kwargs["position_ids"][:, -1:] + 1
         return model_kwargs
 
+    def init_decode_cache(self, batch_size, max_length, dtype=jnp.bfloat16):
+        """ Allocate a decode cache of batch_size sequence slots holding up to
+            max_length tokens each. Unlike the cache used by generate, every
+            slot has its own length, so sequences can be started and retired
+            independently. Use with cached_forward.
+        """
+        config = self.config
+        num_key_value_heads = config.num_key_value_heads or config.num_attention_heads
+        head_dim = config.hidden_size // config.num_attention_heads
+        shape = (batch_size, max_length, num_key_value_heads, head_dim)
+        return {'transformer': {'h': {
+            str(i): {'attention': {
+                'cached_key': jnp.zeros(shape, dtype=dtype),
+                'cached_value': jnp.zeros(shape, dtype=dtype),
+            }}
+            for i in range(config.num_hidden_layers)
+        }}}
+
+    def init_paged_decode_cache(self, num_pages, page_size, dtype=jnp.bfloat16):
+        """ Allocate a paged decode cache: a pool of num_pages pages of
+            page_size tokens shared by all sequences. Memory is only used by
+            the pages that sequences actually fill, rather than reserving
+            max_length tokens for every sequence. Use with cached_forward and
+            a page table per sequence.
+        """
+        config = self.config
+        num_key_value_heads = config.num_key_value_heads or config.num_attention_heads
+        head_dim = config.hidden_size // config.num_attention_heads
+        shape = (num_pages, page_size, num_key_value_heads, head_dim)
+        return {'transformer': {'h': {
+            str(i): {'attention': {
+                'key_pages': jnp.zeros(shape, dtype=dtype),
+                'value_pages': jnp.zeros(shape, dtype=dtype),
+            }}
+            for i in range(config.num_hidden_layers)
+        }}}
+
+    def cached_forward(self, params, cache, input_ids, cache_lengths,
+                       input_mask=None, logit_positions=None, page_tables=None):
+        """ Run a chunk of new tokens for every slot of a decode cache.
+            cache_lengths holds the number of tokens already in each slot, and
+            input_mask marks the valid new tokens, which must come first in
+            each row. Returns the logits at logit_positions, or at every
+            position, and the updated cache. The slot lengths are tracked by
+            the caller, which advances them by the number of valid tokens.
+            For a paged cache, page_tables of shape (batch, pages_per_sequence)
+            lists the pages of every slot.
+        """
+        if input_mask is None:
+            input_mask = jnp.ones_like(input_ids)
+        position_ids = cache_lengths[:, None] + jnp.arange(input_ids.shape[1])[None, :]
+        decode_state = {'cache_lengths': cache_lengths}
+        if page_tables is not None:
+            decode_state['page_tables'] = page_tables
+        cache = _map_attention_cache(cache, lambda x: dict(x, **decode_state))
+        logits, variables = self.module.apply(
+            {'params': params['params'], 'cache': cache},
+            input_ids, input_mask, position_ids, logit_positions,
+            method=self.module.decode, mutable=['cache'],
+        )
+        cache = _map_attention_cache(
+            unfreeze(variables['cache']),
+            lambda x: {k: v for k, v in x.items() if k not in decode_state}
+        )
+        return logits, cache
+
+
+def _map_attention_cache(cache, fn):
+    return {'transformer': {'h': {
+        name: {'attention': fn(layer['attention'])}
+        for name, layer in cache['transformer']['h'].items()
+    }}}
+
 
 class FlaxLLaMAForSequenceClassificationModule(nn.Module):
     config: LLaMAConfig
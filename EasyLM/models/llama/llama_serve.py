@@ -7,14 +7,18 @@ import mlxu
 import jax
 import jax.numpy as jnp
 from jax.experimental.pjit import pjit
+import flax
 from jax.sharding import PartitionSpec as PS
 import optax
 from transformers import GenerationConfig, FlaxLogitsProcessorList
 
 from EasyLM.checkpoint import StreamingCheckpointer
 from EasyLM.serving import LMServer
+from EasyLM.decoding import (
+    DecodeEngine, sample_next_tokens, speculative_decode_step
+)
 from EasyLM.jax_utils import (
-    JaxRNG, JaxDistributedConfig, next_rng, match_partition_rules, tree_apply,
+    JaxRNG, JaxDistributedConfig, next_rng, match_partition_rules,
     set_random_seed, get_float_dtype_by_name, make_shard_and_gather_fns,
     with_sharding_constraint, FlaxTemperatureLogitsWarper
 )
@@ -33,6 +37,10 @@ FLAGS, FLAGS_DEF = mlxu.define_flags_with_default(
     do_sample=True,
     num_beams=1,
     add_bos_token=True,
+    continuous_batching=False,
+    decode_engine=DecodeEngine.get_default_config(),
+    load_draft_llama_config='',
+    load_draft_checkpoint='',
     load_llama_config='',
     load_checkpoint='',
     tokenizer=LLaMAConfig.get_tokenizer_config(),
@@ -54,10 +62,6 @@ def main(argv):
 
     with jax.default_device(jax.devices("cpu")[0]):
         llama_config = LLaMAConfig.load_config(FLAGS.load_llama_config)
-        _, params = StreamingCheckpointer.load_trainstate_checkpoint(
-            FLAGS.load_checkpoint, disallow_trainstate=True
-        )
-
         hf_model = FlaxLLaMAForCausalLM(
             llama_config,
             input_shape=(1, FLAGS.seq_length),
@@ -65,8 +69,31 @@ def main(argv):
             _do_init=False
         )
 
+    def params_shapes(model, config):
+        # Partition specs come from the parameter shapes rather than the
+        # loaded params, so that checkpoints are loaded with shard functions
+        # and quantized tensors are dequantized on devices.
+        def init_params(rng):
+            rng_generator = JaxRNG(rng)
+            return model.module.init(
+                input_ids=jnp.zeros((1, 1), dtype=jnp.int32),
+                position_ids=jnp.zeros((1, 1), dtype=jnp.int32),
+                attention_mask=jnp.ones((1, 1), dtype=jnp.int32),
+                rngs=rng_generator(config.rng_keys()),
+            )
+        return flax.core.frozen_dict.freeze(jax.eval_shape(init_params, next_rng()))
+
+    def load_params(checkpoint, shard_fns):
+        # Sharded checkpoints on local disk are memory mapped rather than
+        # read into memory, and only copied when placed on devices.
+        _, params = StreamingCheckpointer.load_trainstate_checkpoint(
+            checkpoint, disallow_trainstate=True, use_mmap=True,
+            params_shard_fns=shard_fns['params'],
+        )
+        return params
+
     model_ps = match_partition_rules(
-        LLaMAConfig.get_partition_rules(), params
+        LLaMAConfig.get_partition_rules(), params_shapes(hf_model, llama_config)
     )
     shard_fns, _ = make_shard_and_gather_fns(
         model_ps, get_float_dtype_by_name(FLAGS.dtype)
@@ -159,14 +186,267 @@ def main(argv):
 
     mesh = LLaMAConfig.get_jax_mesh(FLAGS.mesh_dim)
     with mesh:
-        params = tree_apply(shard_fns, params)
+        params = load_params(FLAGS.load_checkpoint, shard_fns)
         sharded_rng = next_rng()
 
+    decode_engine = None
+    assert FLAGS.continuous_batching or FLAGS.load_draft_checkpoint == '', (
+        'Speculative decoding requires continuous batching.'
+    )
+    if FLAGS.continuous_batching:
+        assert FLAGS.num_beams == 1, 'Beam search is not supported with continuous batching.'
+
+        draft_model, draft_params = None, None
+        draft_ps, draft_cache_ps = PS(), PS()
+        if FLAGS.load_draft_checkpoint != '':
+            with jax.default_device(jax.devices("cpu")[0]):
+                draft_config = LLaMAConfig.load_config(FLAGS.load_draft_llama_config)
+                draft_model = FlaxLLaMAForCausalLM(
+                    draft_config,
+                    input_shape=(1, FLAGS.seq_length),
+                    seed=FLAGS.seed,
+                    _do_init=False
+                )
+            draft_ps = match_partition_rules(
+                LLaMAConfig.get_partition_rules(),
+                params_shapes(draft_model, draft_config),
+            )
+            draft_shard_fns, _ = make_shard_and_gather_fns(
+                draft_ps, get_float_dtype_by_name(FLAGS.dtype)
+            )
+            with mesh:
+                draft_params = load_params(FLAGS.load_draft_checkpoint, draft_shard_fns)
+
+        def init_decode_cache(model):
+            if FLAGS.decode_engine.page_size > 0:
+                return model.init_paged_decode_cache(
+                    FLAGS.decode_engine.num_pages, FLAGS.decode_engine.page_size,
+                    dtype=get_float_dtype_by_name(FLAGS.dtype),
+                )
+            return model.init_decode_cache(
+                FLAGS.decode_engine.num_slots, FLAGS.seq_length,
+                dtype=get_float_dtype_by_name(FLAGS.dtype),
+            )
+
+        cache_ps = match_partition_rules(
+            LLaMAConfig.get_decode_cache_partition_rules(),
+            jax.eval_shape(partial(init_decode_cache, hf_model)),
+        )
+        if draft_model is not None:
+            # the draft cache shares the page tables of the target cache
+            draft_cache_ps = match_partition_rules(
+                LLaMAConfig.get_decode_cache_partition_rules(),
+                jax.eval_shape(partial(init_decode_cache, draft_model)),
+            )
+
+        def write_draft_cache(draft_params, draft_cache, tokens, cache_lengths,
+                              input_mask, page_tables):
+            # keep the draft cache in sync with the target cache
+            if draft_model is None:
+                return draft_cache
+            _, draft_cache = draft_model.cached_forward(
+                draft_params, draft_cache, tokens, cache_lengths, input_mask,
+                logit_positions=jnp.zeros((tokens.shape[0], 1), dtype=jnp.int32),
+                page_tables=page_tables,
+            )
+            return draft_cache
+
+        @partial(
+            pjit,
+            in_shardings=(
+                model_ps, draft_ps, cache_ps, draft_cache_ps,
+                PS(), PS(), PS(), PS(), PS(), PS()
+            ),
+            out_shardings=(cache_ps, draft_cache_ps, PS(), PS()),
+            donate_argnums=(2, 3),
+        )
+        def forward_decode_step(params, draft_params, cache, draft_cache, rng, tokens,
+                                num_new_tokens, cache_lengths, temperature, page_tables):
+            rng_generator = JaxRNG(rng)
+            input_mask = jnp.arange(tokens.shape[1])[None, :] < num_new_tokens[:, None]
+            logits, cache = hf_model.cached_forward(
+                params, cache, tokens, cache_lengths, input_mask.astype(jnp.int32),
+                logit_positions=jnp.maximum(num_new_tokens - 1, 0)[:, None],
+                page_tables=page_tables,
+            )
+            draft_cache = write_draft_cache(
+                draft_params, draft_cache, tokens, cache_lengths,
+                input_mask.astype(jnp.int32), page_tables,
+            )
+            next_tokens = sample_next_tokens(
+                logits[:, 0], rng_generator(), temperature,
+                top_k=FLAGS.top_k, top_p=FLAGS.top_p,
+            )
+            return cache, draft_cache, next_tokens, rng_generator()
+
+        @partial(
+            pjit,
+            in_shardings=(
+                model_ps, draft_ps, cache_ps, draft_cache_ps,
+                PS(), PS(), PS(), PS(), PS(), PS(), PS()
+            ),
+            out_shardings=(cache_ps, draft_cache_ps, PS(), PS(), PS(), PS()),
+            donate_argnums=(2, 3),
+        )
+        def forward_score_step(params, draft_params, cache, draft_cache, rng, tokens,
+                               num_new_tokens, cache_lengths, temperature, page_tables,
+                               target_tokens):
+            rng_generator = JaxRNG(rng)
+            input_mask = jnp.arange(tokens.shape[1])[None, :] < num_new_tokens[:, None]
+            logits, cache = hf_model.cached_forward(
+                params, cache, tokens, cache_lengths, input_mask.astype(jnp.int32),
+                page_tables=page_tables,
+            )
+            draft_cache = write_draft_cache(
+                draft_params, draft_cache, tokens, cache_lengths,
+                input_mask.astype(jnp.int32), page_tables,
+            )
+            target_logprobs = -optax.softmax_cross_entropy_with_integer_labels(
+                logits, target_tokens
+            )
+            target_is_greedy = jnp.argmax(logits, axis=-1) == target_tokens
+            last_logits = jnp.take_along_axis(
+                logits, jnp.maximum(num_new_tokens - 1, 0)[:, None, None], axis=1
+            )
+            next_tokens = sample_next_tokens(
+                last_logits[:, 0], rng_generator(), temperature,
+                top_k=FLAGS.top_k, top_p=FLAGS.top_p,
+            )
+            return (
+                cache, draft_cache, next_tokens, target_logprobs, target_is_greedy,
+                rng_generator()
+            )
+
+        @partial(
+            pjit,
+            in_shardings=(
+                model_ps, draft_ps, cache_ps, draft_cache_ps,
+                PS(), PS(), PS(), PS(), PS(), PS()
+            ),
+            out_shardings=(cache_ps, draft_cache_ps, PS(), PS(), PS()),
+            donate_argnums=(2, 3),
+        )
+        def forward_speculative_step(params, draft_params, cache, draft_cache, rng,
+                                     last_tokens, cache_lengths, temperature,
+                                     page_tables, active):
+            rng_generator = JaxRNG(rng)
+            cache, draft_cache, tokens, num_accepted = speculative_decode_step(
+                partial(hf_model.cached_forward, params, page_tables=page_tables),
+                partial(draft_model.cached_forward, draft_params, page_tables=page_tables),
+                cache, draft_cache, last_tokens, cache_lengths, active,
+                rng_generator(), temperature, FLAGS.decode_engine.num_draft_tokens,
+                top_k=FLAGS.top_k, top_p=FLAGS.top_p,
+            )
+            return cache, draft_cache, tokens, num_accepted, rng_generator()
+
+        with mesh:
+            decode_cache = pjit(
+                partial(init_decode_cache, hf_model), out_shardings=cache_ps
+            )()
+            draft_cache = None
+            if draft_model is not None:
+                draft_cache = pjit(
+                    partial(init_decode_cache, draft_model), out_shardings=draft_cache_ps
+                )()
+            decode_rng = next_rng()
+
+        def decode_step(tokens, num_new_tokens, cache_lengths, temperature, page_tables):
+            # called from the decode engine thread
+            nonlocal decode_cache, draft_cache, decode_rng
+            with mesh:
+                decode_cache, draft_cache, next_tokens, decode_rng = forward_decode_step(
+                    params, draft_params, decode_cache, draft_cache, decode_rng,
+                    tokens, num_new_tokens, cache_lengths, temperature, page_tables,
+                )
+                return jax.device_get(next_tokens)
+
+        def score_step(tokens, num_new_tokens, cache_lengths, temperature,
+                       page_tables, target_tokens):
+            nonlocal decode_cache, draft_cache, decode_rng
+            with mesh:
+                (decode_cache, draft_cache, next_tokens, target_logprobs,
+                 target_is_greedy, decode_rng) = forward_score_step(
+                    params, draft_params, decode_cache, draft_cache, decode_rng,
+                    tokens, num_new_tokens, cache_lengths, temperature, page_tables,
+                    target_tokens,
+                )
+                return jax.device_get((next_tokens, target_logprobs, target_is_greedy))
+
+        def speculate_step(last_tokens, cache_lengths, temperature, page_tables, active):
+            nonlocal decode_cache, draft_cache, decode_rng
+            with mesh:
+                (decode_cache, draft_cache, tokens, num_accepted,
+                 decode_rng) = forward_speculative_step(
+                    params, draft_params, decode_cache, draft_cache, decode_rng,
+                    last_tokens, cache_lengths, temperature, page_tables, active,
+                )
+                return jax.device_get((tokens, num_accepted))
+
+        decode_engine = DecodeEngine(
+            FLAGS.decode_engine, decode_step,
+            max_length=FLAGS.seq_length,
+            eos_token_id=tokenizer.eos_token_id,
+            score_fn=score_step,
+            speculate_fn=speculate_step if draft_model is not None else None,
+        )
+
+    def encode_prompt(text):
+        tokens = tokenizer(text, add_special_tokens=False).input_ids
+        if FLAGS.add_bos_token:
+            return [tokenizer.bos_token_id] + tokens[-(FLAGS.input_length - 1):]
+        return tokens[-FLAGS.input_length:] or [tokenizer.bos_token_id]
+
+    def encode_continuation(prefix_text, text):
+        # truncated the same way as the padded batches of forward_loglikelihood
+        prefix = tokenizer(prefix_text, add_special_tokens=False).input_ids
+        prefix = prefix[-FLAGS.input_length:]
+        continuation = tokenizer(text, add_special_tokens=False).input_ids
+        continuation = continuation[:FLAGS.seq_length - FLAGS.input_length]
+        if FLAGS.add_bos_token or len(prefix) == 0:
+            prefix = [tokenizer.bos_token_id] + prefix
+        return prefix + continuation, len(prefix)
+
+    def make_stop_fn(until):
+        if len(until) == 0:
+            return None
+        # only decode enough trailing tokens to contain any of the until strings
+        window = max(len(x) for x in until) + 4
+        return lambda tokens: any(x in tokenizer.decode(tokens[-window:]) for x in until)
+
     class ModelServer(LMServer):
+        concurrent_generation = FLAGS.continuous_batching
+        chat_concurrency = FLAGS.decode_engine.num_slots if FLAGS.continuous_batching else 1
+
+        @staticmethod
+        def metrics():
+            if decode_engine is None:
+                return {}
+            return decode_engine.metrics
 
         @staticmethod
         def loglikelihood(prefix_text, text):
             nonlocal sharded_rng
+            if decode_engine is not None:
+                # score the continuations of each distinct prefix together,
+                # so that the prefix is only computed once
+                groups = {}
+                for i, (pf, t) in enumerate(zip(prefix_text, text)):
+                    tokens, continuation_start = encode_continuation(pf, t)
+                    prefix = tuple(tokens[:continuation_start])
+                    groups.setdefault(prefix, []).append((i, tokens[continuation_start:]))
+                futures = [None] * len(text)
+                for prefix, continuations in groups.items():
+                    group_futures = decode_engine.submit_loglikelihood_group(
+                        prefix, [x[1] for x in continuations]
+                    )
+                    for (i, _), future in zip(continuations, group_futures):
+                        futures[i] = future
+                results = [future.result() for future in futures]
+                return (
+                    np.array([x[0] for x in results], dtype=np.float32),
+                    np.array([x[1] for x in results]),
+                )
+
             prefix = prefix_tokenizer(
                 prefix_text,
                 padding='max_length',
@@ -282,6 +562,14 @@ def main(argv):
         @staticmethod
         def generate(text, temperature):
             nonlocal sharded_rng
+            if decode_engine is not None:
+                outputs = decode_engine.generate(
+                    [encode_prompt(x) for x in text],
+                    max_new_tokens=FLAGS.seq_length - FLAGS.input_length,
+                    temperature=temperature if FLAGS.do_sample else 0.0,
+                )
+                return [tokenizer.decode(x) for x in outputs]
+
             inputs = prefix_tokenizer(
                 text,
                 padding='max_length',
@@ -314,6 +602,24 @@ def main(argv):
         @staticmethod
         def greedy_until(prefix_text, until, max_length):
             nonlocal sharded_rng
+            if decode_engine is not None:
+                until = [[x] if isinstance(x, str) else x for x in until]
+                futures = [
+                    decode_engine.submit(
+                        encode_prompt(pf), max_length, temperature=0.0,
+                        stop_fn=make_stop_fn(ut),
+                    )
+                    for pf, ut in zip(prefix_text, until)
+                ]
+                all_outputs = []
+                for future, ut in zip(futures, until):
+                    output_text = tokenizer.decode(future.result())
+                    for s in ut:
+                        if s in output_text:
+                            output_text = output_text.split(s, maxsplit=1)[0]
+                    all_outputs.append(output_text)
+                return all_outputs
+
             all_outputs = []
             for pf, ut in zip(prefix_text, until):
                 if isinstance(ut, str):
@@ -4,6 +4,7 @@ import os
 import time
 
 from tqdm import tqdm, trange
+import numpy as np
 import mlxu
 
 import jax
@@ -13,14 +14,15 @@ from jax.sharding import PartitionSpec as PS
 from flax.training.train_state import TrainState
 import torch
 
-from EasyLM.data import DatasetFactory
+from EasyLM.data import DatasetFactory, length_bucket_batch_shapes
 from EasyLM.checkpoint import StreamingCheckpointer
 from EasyLM.optimizers import OptimizerFactory
 from EasyLM.jax_utils import (
     JaxRNG, JaxDistributedConfig, next_rng, match_partition_rules,
     cross_entropy_loss_and_accuracy, global_norm, get_float_dtype_by_name,
     set_random_seed, average_metrics, get_weight_decay_mask,
-    make_shard_and_gather_fns, with_sharding_constraint, average_metrics
+    make_shard_and_gather_fns, with_sharding_constraint, average_metrics,
+    DevicePrefetchIterator
 )
 from EasyLM.models.llama.llama_model import (
     LLaMAConfig, FlaxLLaMAForCausalLMModule, LlamaTokenizerFast
@@ -42,6 +44,7 @@ FLAGS, FLAGS_DEF = mlxu.define_flags_with_default(
     save_milestone_freq=0,
     eval_steps=0,
     num_epochs=0,
+    prefetch_batches=0,
     tokenizer='', # now, we just use the HF tokenizers.
     tokenizer_pad_token_id=128255, # default is random unused llama 3 token. for llama 2, use 0 (unk token)
     train_dataset=DatasetFactory.get_default_config(),
@@ -82,8 +85,15 @@ def main(argv):
     real_batch_size = wrapped_dataset.config.batch_size
     # for the scheduler, which only gets updated with 'real' grad steps
     simulated_batch_size = real_batch_size * FLAGS.optimizer.accumulate_gradient_steps
-    steps_per_epoch = len(wrapped_dataset) // real_batch_size
-    simulated_steps_per_epoch = len(wrapped_dataset) // simulated_batch_size
+    # with shard_by_process, each host only holds 1/num_shards of the examples
+    if hasattr(wrapped_dataset, '__len__'):
+        num_examples = len(wrapped_dataset) * getattr(wrapped_dataset, 'num_shards', 1)
+    else:
+        # streaming datasets have no length, so a single epoch of total_steps is run
+        assert FLAGS.num_epochs <= 1, 'num_epochs requires a dataset with a defined length.'
+        num_examples = FLAGS.total_steps * real_batch_size
+    steps_per_epoch = num_examples // real_batch_size
+    simulated_steps_per_epoch = num_examples // simulated_batch_size
     print(f"Make sure your scheduler steps are based on the simulated batch size: {simulated_batch_size}!")
     print(f"Total simulated steps: {simulated_steps_per_epoch * FLAGS.num_epochs}")
 
@@ -122,7 +132,8 @@ def main(argv):
         FLAGS.optimizer.adamw_optimizer.lr_decay_steps = total_simulated_steps
         if FLAGS.optimizer.adamw_optimizer.warmup_ratio > 0:
             FLAGS.optimizer.adamw_optimizer.lr_warmup_steps = math.ceil(FLAGS.optimizer.adamw_optimizer.warmup_ratio * total_simulated_steps)
-
+    else:
+        total_simulated_steps = FLAGS.total_steps // FLAGS.optimizer.accumulate_gradient_steps
     print(f"Total simulated steps: {total_simulated_steps}")
     print(f"Total simulated warmup steps: {FLAGS.optimizer.adamw_optimizer.lr_warmup_steps}")
     print(f"Total simulated decay steps: {FLAGS.optimizer.adamw_optimizer.lr_decay_steps}")
@@ -150,6 +161,8 @@ def main(argv):
         batch = with_sharding_constraint(batch, PS(('dp', 'fsdp')))
         logits = model.apply(
             train_state.params, batch['input_tokens'], batch['attention_mask'],
+            position_ids=batch.get('position_ids'),
+            segment_ids=batch.get('segment_ids'),
             deterministic=True, rngs=rng_generator(llama_config.rng_keys()),
         ).logits
         loss, accuracy = cross_entropy_loss_and_accuracy(
@@ -167,6 +180,8 @@ def main(argv):
         def loss_and_accuracy(params):
             logits = model.apply(
                 params, batch['input_tokens'], batch['attention_mask'],
+                position_ids=batch.get('position_ids'),
+                segment_ids=batch.get('segment_ids'),
                 deterministic=False, rngs=rng_generator(llama_config.rng_keys()),
             ).logits
             return cross_entropy_loss_and_accuracy(
@@ -210,9 +225,16 @@ def main(argv):
         donate_argnums=(0, ),
     )
 
+    prefetch_batches = FLAGS.prefetch_batches
+    if FLAGS.train_dataset.shard_by_process:
+        # each host loads only its slice of the batch, and the prefetcher
+        # assembles the slices into global arrays.
+        prefetch_batches = max(prefetch_batches, 1)
+    # prefetched batches are already placed on device with batch sharding
+    batch_partition = PS(('dp', 'fsdp')) if prefetch_batches > 0 else PS()
     sharded_train_step = pjit(
         train_step,
-        in_shardings=(train_state_partition, PS(), PS()),
+        in_shardings=(train_state_partition, PS(), batch_partition),
         out_shardings=(train_state_partition, PS(), PS()),
         donate_argnums=(0, 1),
     )
@@ -224,6 +246,13 @@ def main(argv):
         donate_argnums=(1,),
     )
 
+    def dataset_state():
+        # A prefetching dataset runs ahead of training in another thread, so
+        # save the state recorded with the last batch it handed out.
+        if isinstance(epoch_dataset, DevicePrefetchIterator):
+            return epoch_dataset.state_dict
+        return getattr(wrapped_dataset, 'get_state_dict', lambda: None)()
+
     def save_checkpoint(train_state, milestone=False):
         step = int(jax.device_get(train_state.step))
         metadata = dict(
@@ -236,6 +265,7 @@ def main(argv):
             train_state=train_state,
             gather_fns=gather_fns,
             metadata=metadata,
+            dataset=dataset_state(),
             milestone=milestone,
         )
 
@@ -267,6 +297,18 @@ def main(argv):
 
         sharded_rng = next_rng()
 
+        # with length buckets, compile the train step once per bucket up front
+        # so that the number of compilations is bounded by the bucket count.
+        compiled_train_steps = None
+        if getattr(wrapped_dataset, 'length_buckets', None) is not None:
+            compiled_train_steps = {}
+            bucket_batch_shapes = length_bucket_batch_shapes(wrapped_dataset, real_batch_size)
+            for bucket_length, batch_shapes in bucket_batch_shapes.items():
+                print(f"Compiling train step for length bucket {bucket_length}...")
+                compiled_train_steps[bucket_length] = sharded_train_step.lower(
+                    train_state, sharded_rng, batch_shapes
+                ).compile()
+
         if FLAGS.num_epochs > 0:
             epoch_counter = trange(start_epoch, FLAGS.num_epochs, ncols=0, position=0)
             step_counter = trange(start_step, steps_per_epoch, ncols=0, position=1)
@@ -275,18 +317,27 @@ def main(argv):
             step_counter = trange(start_step, FLAGS.total_steps, ncols=0, position=1)
 
         overall_step = 0
+        epoch_dataset = dataset
         for epoch in epoch_counter:
-            for step, batch in zip(step_counter, dataset):
+            epoch_dataset = dataset
+            if prefetch_batches > 0:
+                epoch_dataset = DevicePrefetchIterator(
+                    dataset, mesh, prefetch_size=prefetch_batches,
+                    process_local=FLAGS.train_dataset.shard_by_process,
+                    state_fn=getattr(wrapped_dataset, 'get_state_dict', None),
+                )
+            for step, batch in zip(step_counter, epoch_dataset):
+                dataset_metrics = {}
                 if isinstance(batch, (list, tuple)):
-                    batch = {
-                        'input_tokens': batch['input_tokens'],
-                        'attention_mask': batch['attention_mask'],
-                        'loss_masks': batch['loss_masks'],
-                        'target_tokens': batch['target_tokens'],
-                    }
+                    # streaming datasets yield (batch, dataset_metrics) pairs
+                    batch, dataset_metrics = batch
                 # just measuring the train step time.
                 start_time = time.time()
-                train_state, sharded_rng, metrics = sharded_train_step(
+                if compiled_train_steps is not None:
+                    train_step_fn = compiled_train_steps[batch['input_tokens'].shape[1]]
+                else:
+                    train_step_fn = sharded_train_step
+                train_state, sharded_rng, metrics = train_step_fn(
                     train_state, sharded_rng, batch
                 )
                 step_time = time.time() - start_time
@@ -314,6 +365,12 @@ def main(argv):
                     }
                     log_metrics = jax.device_get(log_metrics)
                     log_metrics.update(metrics)
+                    log_metrics.update(dataset_metrics)
+                    if prefetch_batches > 0:
+                        log_metrics.update(epoch_dataset.metrics)
+                    log_metrics.update(checkpointer.metrics)
+                    if getattr(wrapped_dataset, 'packing_efficiency', None) is not None:
+                        log_metrics["dataset/packing_efficiency"] = wrapped_dataset.packing_efficiency
                     log_metrics = {k: float(v) for k, v in log_metrics.items()}
                     logger.log(log_metrics)
                     tqdm.write("\n" + pprint.pformat(log_metrics) + "\n")
@@ -322,6 +379,11 @@ def main(argv):
                     save_checkpoint(train_state, milestone=True)
                 elif FLAGS.save_model_freq > 0 and (step + 1) % FLAGS.save_model_freq == 0:
                     save_checkpoint(train_state)
+            if prefetch_batches > 0:
+                epoch_dataset.close()
+                if epoch_dataset.state_dict is not None:
+                    # rewind the dataset over the batches prefetched but not trained on
+                    wrapped_dataset.load_state_dict(epoch_dataset.state_dict)
             # save model at the end of each epoch
             if FLAGS.save_model_freq > 0:
                 save_checkpoint(train_state, milestone=True)
@@ -340,6 +402,7 @@ def main(argv):
             tqdm.write("\n" + pprint.pformat(log_metrics) + "\n")
         if True:#FLAGS.save_model_freq > 0:
             save_checkpoint(train_state, milestone=True)
+        checkpointer.wait_for_saves()
 
 
 if __name__ == "__main__":
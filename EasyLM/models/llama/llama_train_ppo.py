@@ -3,6 +3,7 @@ import math
 import time
 from tqdm import tqdm, trange
 import copy
+from functools import partial
 import os
 
 import mlxu
@@ -17,12 +18,13 @@ import wandb
 
 from ...data import DatasetFactory
 from EasyLM.checkpoint import StreamingCheckpointer
+from EasyLM.decoding import speculative_generate
 from EasyLM.optimizers import OptimizerFactory
 from EasyLM.jax_utils import (
     JaxRNG, JaxDistributedConfig, next_rng, match_partition_rules,
     global_norm, get_float_dtype_by_name, set_random_seed,
     get_weight_decay_mask, make_shard_and_gather_fns,
-    with_sharding_constraint
+    with_sharding_constraint, tree_apply
 )
 from EasyLM.models.llama.llama_model import (
     LLaMAConfig, FlaxLLaMAForCausalLM, FlaxLLaMAForSequenceClassification, FlaxLLaMAForTokenRegression, LlamaTokenizerFast
@@ -47,6 +49,9 @@ FLAGS, FLAGS_DEF = mlxu.define_flags_with_default(
     update_llama_config_reward='',
     load_checkpoint_policy='',
     load_checkpoint_reward='',
+    load_llama_config_draft='',
+    load_checkpoint_draft='',
+    num_draft_tokens=4,
     load_dataset_state='',
     log_freq=1,
     save_model_freq=0,
@@ -182,8 +187,8 @@ def compute_advantages(values, rewards, mask):
     return advantages, returns
 
 def ppo_rollout(
-    policy_train_state,
-    policy_model,
+    policy_train_state, draft_params,
+    policy_model, draft_model,
     rng, batch, tokenizer,
 ):
     rng_generator = JaxRNG(rng)
@@ -202,14 +207,40 @@ def ppo_rollout(
         max_new_tokens=FLAGS.max_continuation_len,
         # forced_eos_token_id=eos_token_id,
     )
-    outputs = policy_model.generate(
-        input_ids=prompt_input_ids,
-        attention_mask=prompt_attn_mask,
-        generation_config=generation_config,
-        params=policy_train_state.params['params'],
-        prng_key=rng_generator(),
-    )
-    input_ids = outputs.sequences # (B, L)
+    rollout_stats = {}
+    if draft_model is None:
+        outputs = policy_model.generate(
+            input_ids=prompt_input_ids,
+            attention_mask=prompt_attn_mask,
+            generation_config=generation_config,
+            params=policy_train_state.params['params'],
+            prng_key=rng_generator(),
+        )
+        input_ids = outputs.sequences # (B, L)
+    else:
+        # speculative decoding with a draft model, which samples from the same distribution
+        def init_decode_cache(model):
+            cache = model.init_decode_cache(
+                prompt_input_ids.shape[0], PL + FLAGS.max_continuation_len + FLAGS.num_draft_tokens + 1,
+                dtype=get_float_dtype_by_name(FLAGS.dtype),
+            )
+            return with_sharding_constraint(cache, match_partition_rules(
+                LLaMAConfig.get_decode_cache_partition_rules(), cache
+            ))
+        input_ids, num_draft_tokens, num_accepted_tokens = speculative_generate(
+            partial(policy_model.cached_forward, policy_train_state.params),
+            partial(draft_model.cached_forward, draft_params),
+            init_decode_cache(policy_model), init_decode_cache(draft_model),
+            prompt_input_ids, prompt_attn_mask, rng_generator(),
+            max_new_tokens=FLAGS.max_continuation_len,
+            num_draft_tokens=FLAGS.num_draft_tokens,
+            eos_token_id=tokenizer.eos_token_id,
+            pad_token_id=tokenizer.pad_token_id,
+            temperature=generation_config.temperature,
+            top_k=generation_config.top_k,
+            top_p=generation_config.top_p,
+        ) # (B, L)
+        rollout_stats['rollout/draft_acceptance_rate'] = num_accepted_tokens / jnp.maximum(num_draft_tokens, 1)
 
     # NOTE: This is a hack because generate() weirdly forces the last token to be 0 instead of 2
     last_token_index = jnp.argmax(jnp.cumsum(jnp.where(input_ids == tokenizer.pad_token_id, 0, 1), axis=1), axis=1) # (B)
@@ -231,7 +262,7 @@ def ppo_rollout(
 
     batch = with_sharding_constraint(batch, PS())
 
-    return rng_generator(), batch
+    return rng_generator(), batch, rollout_stats
 
 def ppo_forward_backward(
     policy_train_state, reference_params, value_train_state, reward_params,
@@ -465,20 +496,30 @@ def main(argv):
         donate_argnums=(0, ),
     )
 
+    draft_model, draft_params, draft_params_partition = None, None, PS()
+    if FLAGS.load_checkpoint_draft != '':
+        llama_config_draft = LLaMAConfig.load_config(FLAGS.load_llama_config_draft)
+        draft_model = FlaxLLaMAForCausalLM(llama_config_draft, dtype=get_float_dtype_by_name(FLAGS.dtype), _do_init=False)
+        print("Loading checkpoint (draft) ... (may take time to download)")
+        _, draft_params = StreamingCheckpointer.load_trainstate_checkpoint(FLAGS.load_checkpoint_draft, disallow_trainstate=True)
+        print("Checkpoint (draft) loaded.")
+        draft_params_partition = match_partition_rules(LLaMAConfig.get_partition_rules(), draft_params)
+        shard_fns_draft, _ = make_shard_and_gather_fns(draft_params_partition, get_float_dtype_by_name(FLAGS.dtype))
+
     def ppo_rollout_wrapper(
-        policy_train_state,
+        policy_train_state, draft_params,
         rng, batch,
     ):
         return ppo_rollout(
-            policy_train_state,
-            policy_model,
+            policy_train_state, draft_params,
+            policy_model, draft_model,
             rng, batch, tokenizer,
         )
     sharded_ppo_rollout = pjit(
         ppo_rollout_wrapper,
-        in_shardings=(train_state_partition_policy, PS(), PS()),
-        out_shardings=(PS(), PS()),
-        donate_argnums=(1,),  # rng
+        in_shardings=(train_state_partition_policy, draft_params_partition, PS(), PS()),
+        out_shardings=(PS(), PS(), PS()),
+        donate_argnums=(2,),  # rng
     )
     def ppo_forward_backward_wrapper(
         policy_train_state, reference_params, value_train_state, reward_params,
@@ -581,6 +622,9 @@ def main(argv):
             if not FLAGS.use_tpu:
                 reward_params = flax.core.frozen_dict.unfreeze(reward_params)
 
+        if draft_params is not None:
+            draft_params = tree_apply(shard_fns_draft, draft_params)
+
         sharded_rng = next_rng()
 
         global_step = 0
@@ -594,16 +638,18 @@ def main(argv):
 
                 t0 = time.time()
                 t = time.time()
-                sharded_rng, batch = sharded_ppo_rollout(policy_train_state, sharded_rng, batch)
+                sharded_rng, batch, rollout_stats = sharded_ppo_rollout(policy_train_state, draft_params, sharded_rng, batch)
                 batch['cont_position_ids'].block_until_ready()
                 # If we do not use jax.device_get() to convert into numpy array first, we will get an error when iterating a sharded array with dim >= 100
                 batch = {k: jax.device_get(v) for k, v in batch.items()}
+                rollout_stats = {k: float(jax.device_get(v)) for k, v in rollout_stats.items()}
                 time_rollout = time.time() - t
                 # jax.profiler.save_device_memory_profile('/dev/shm/memory.prof')
 
                 if FLAGS.generate_only:
                     stats = {
                         'time/ppo/rollout': time_rollout,
+                        **rollout_stats,
                     }
                     queries = tokenizer.batch_decode(batch['prompt_input_ids'], skip_special_tokens=False, clean_up_tokenization_spaces=False)
                     responses = tokenizer.batch_decode(batch['cont_input_ids'], skip_special_tokens=False, clean_up_tokenization_spaces=False)
@@ -647,6 +693,7 @@ def main(argv):
                         'time/ppo/forward_backward': time_forward_backward,
                         'time/ppo/total': time_total,
                     })
+                    stats.update(rollout_stats)
                     queries = tokenizer.batch_decode(batch['prompt_input_ids'], skip_special_tokens=False, clean_up_tokenization_spaces=False)
                     responses = tokenizer.batch_decode(batch['cont_input_ids'], skip_special_tokens=False, clean_up_tokenization_spaces=False)
                     rewards = batch['reward']
@@ -661,6 +708,7 @@ def main(argv):
             # save model at the end of each epoch
             if FLAGS.save_model_freq > 0 or FLAGS.save_milestone_freq > 0:
                 save_checkpoint(policy_train_state, value_train_state, step=global_step, milestone=True)
+        checkpointer.wait_for_saves()
 
 
 if __name__ == "__main__":
@@ -25,7 +25,7 @@ from EasyLM.jax_utils import (
     JaxRNG, JaxDistributedConfig, next_rng, match_partition_rules,
     global_norm, get_float_dtype_by_name, set_random_seed,
     get_weight_decay_mask, make_shard_and_gather_fns,
-    with_sharding_constraint
+    with_sharding_constraint, DevicePrefetchIterator
 )
 from EasyLM.models.llama.llama_model import (
     LLaMAConfig, FlaxLLaMAForSequenceClassificationModule, FlaxLLaMAForCausalLMModule, LlamaTokenizerFast
@@ -47,6 +47,7 @@ FLAGS, FLAGS_DEF = mlxu.define_flags_with_default(
     save_milestone_freq=0,
     eval_steps=0,
     num_epochs=0,
+    prefetch_batches=0,
     tokenizer='', # now, we just use the HF tokenizers.
     tokenizer_pad_token_id=128255, # default is random unused llama 3 token. for llama 2, use 0 (unk token)
     train_dataset=DatasetFactory.get_default_config(),
@@ -119,8 +120,10 @@ def main(argv):
     real_batch_size = wrapped_dataset.config.batch_size
     # for the scheduler, which only gets updated with 'real' grad steps
     simulated_batch_size = real_batch_size * FLAGS.optimizer.accumulate_gradient_steps
-    steps_per_epoch = len(wrapped_dataset) // real_batch_size
-    simulated_steps_per_epoch = len(wrapped_dataset) // simulated_batch_size
+    # with shard_by_process, each host only holds 1/num_shards of the examples
+    num_examples = len(wrapped_dataset) * getattr(wrapped_dataset, 'num_shards', 1)
+    steps_per_epoch = num_examples // real_batch_size
+    simulated_steps_per_epoch = num_examples // simulated_batch_size
     print(f"Make sure your scheduler steps are based on the simulated batch size: {simulated_batch_size}!")
     print(f"Total simulated steps: {simulated_steps_per_epoch * FLAGS.num_epochs}")
 
@@ -250,7 +253,14 @@ def main(argv):
         donate_argnums=(0, ),
     )
 
-    in_shardings = (train_state_partition, PS(), PS())
+    prefetch_batches = FLAGS.prefetch_batches
+    if FLAGS.train_dataset.shard_by_process:
+        # each host loads only its slice of the batch, and the prefetcher
+        # assembles the slices into global arrays.
+        prefetch_batches = max(prefetch_batches, 1)
+    # prefetched batches are already placed on device with batch sharding
+    batch_partition = PS(('dp', 'fsdp')) if prefetch_batches > 0 else PS()
+    in_shardings = (train_state_partition, PS(), batch_partition)
     sharded_train_step = pjit(
         train_step,
         in_shardings=in_shardings,
@@ -320,7 +330,13 @@ def main(argv):
 
         overall_step = 0
         for epoch in epoch_counter:
-            for step, batch in zip(step_counter, dataset):
+            epoch_dataset = dataset
+            if prefetch_batches > 0:
+                epoch_dataset = DevicePrefetchIterator(
+                    dataset, mesh, prefetch_size=prefetch_batches,
+                    process_local=FLAGS.train_dataset.shard_by_process
+                )
+            for step, batch in zip(step_counter, epoch_dataset):
                 start_time = time.time()
 
                 train_state, sharded_rng, metrics = sharded_train_step(
@@ -339,6 +355,9 @@ def main(argv):
                     }
                     log_metrics = jax.device_get(log_metrics)
                     log_metrics.update(metrics)
+                    if prefetch_batches > 0:
+                        log_metrics.update(epoch_dataset.metrics)
+                    log_metrics.update(checkpointer.metrics)
                     log_metrics = {k: float(v) for k, v in log_metrics.items()}
                     logger.log(log_metrics)
                     tqdm.write("\n" + pprint.pformat(log_metrics) + "\n")
@@ -347,6 +366,8 @@ def main(argv):
                     save_checkpoint(train_state, milestone=True)
                 elif FLAGS.save_model_freq > 0 and (step + 1) % FLAGS.save_model_freq == 0:
                     save_checkpoint(train_state)
+            if prefetch_batches > 0:
+                epoch_dataset.close()
             # save model at the end of each epoch
             if FLAGS.save_model_freq > 0:
                 save_checkpoint(train_state, milestone=True)
@@ -364,6 +385,7 @@ def main(argv):
             logger.log(log_metrics)
             tqdm.write("\n" + pprint.pformat(log_metrics) + "\n")
         save_checkpoint(train_state, milestone=True)
+        checkpointer.wait_for_saves()
 
 
 if __name__ == "__main__":
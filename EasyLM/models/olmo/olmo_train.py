@@ -20,7 +20,8 @@ from EasyLM.jax_utils import (
     JaxRNG, JaxDistributedConfig, next_rng, match_partition_rules,
     cross_entropy_loss_and_accuracy, global_norm, get_float_dtype_by_name,
     set_random_seed, average_metrics, get_weight_decay_mask,
-    make_shard_and_gather_fns, with_sharding_constraint, average_metrics
+    make_shard_and_gather_fns, with_sharding_constraint, average_metrics,
+    DevicePrefetchIterator
 )
 from EasyLM.models.olmo.olmo_model import (
     OLMoConfig, FlaxOLMoForCausalLMModule, OlmoTokenizer
@@ -42,6 +43,7 @@ FLAGS, FLAGS_DEF = mlxu.define_flags_with_default(
     save_milestone_freq=0,
     eval_steps=0,
     num_epochs=0,
+    prefetch_batches=0,
     tokenizer='allenai/OLMo-7B',
     train_dataset=DatasetFactory.get_default_config(),
     eval_dataset=DatasetFactory.get_default_config(),
@@ -82,8 +84,15 @@ def main(argv):
     
     # for the scheduler, which only gets updated with 'real' grad steps
     simulated_batch_size = real_batch_size * FLAGS.optimizer.accumulate_gradient_steps
-    steps_per_epoch = len(wrapped_dataset) // real_batch_size
-    simulated_steps_per_epoch = len(wrapped_dataset) // simulated_batch_size
+    # with shard_by_process, each host only holds 1/num_shards of the examples
+    if hasattr(wrapped_dataset, '__len__'):
+        num_examples = len(wrapped_dataset) * getattr(wrapped_dataset, 'num_shards', 1)
+    else:
+        # streaming datasets have no length, so a single epoch of total_steps is run
+        assert FLAGS.num_epochs <= 1, 'num_epochs requires a dataset with a defined length.'
+        num_examples = FLAGS.total_steps * real_batch_size
+    steps_per_epoch = num_examples // real_batch_size
+    simulated_steps_per_epoch = num_examples // simulated_batch_size
     print(f"Make sure your scheduler steps are based on the simulated batch size: {simulated_batch_size}!")
     print(f"Total simulated steps: {simulated_steps_per_epoch * FLAGS.num_epochs}")
 
@@ -120,7 +129,8 @@ def main(argv):
         FLAGS.optimizer.adamw_optimizer.lr_decay_steps = total_simulated_steps
         if FLAGS.optimizer.adamw_optimizer.warmup_ratio > 0:
             FLAGS.optimizer.adamw_optimizer.lr_warmup_steps = math.ceil(FLAGS.optimizer.adamw_optimizer.warmup_ratio * total_simulated_steps)
-
+    else:
+        total_simulated_steps = FLAGS.total_steps // FLAGS.optimizer.accumulate_gradient_steps
     print(f"Total simulated steps: {total_simulated_steps}")
     print(f"Total simulated warmup steps: {FLAGS.optimizer.adamw_optimizer.lr_warmup_steps}")
     print(f"Total simulated decay steps: {FLAGS.optimizer.adamw_optimizer.lr_decay_steps}")
@@ -208,9 +218,16 @@ def main(argv):
         donate_argnums=(0, ),
     )
 
+    prefetch_batches = FLAGS.prefetch_batches
+    if FLAGS.train_dataset.shard_by_process:
+        # each host loads only its slice of the batch, and the prefetcher
+        # assembles the slices into global arrays.
+        prefetch_batches = max(prefetch_batches, 1)
+    # prefetched batches are already placed on device with batch sharding
+    batch_partition = PS(('dp', 'fsdp')) if prefetch_batches > 0 else PS()
     sharded_train_step = pjit(
         train_step,
-        in_shardings=(train_state_partition, PS(), PS()),
+        in_shardings=(train_state_partition, PS(), batch_partition),
         out_shardings=(train_state_partition, PS(), PS()),
         donate_argnums=(0, 1),
     )
@@ -222,6 +239,13 @@ def main(argv):
         donate_argnums=(1,),
     )
 
+    def dataset_state():
+        # A prefetching dataset runs ahead of training in another thread, so
+        # save the state recorded with the last batch it handed out.
+        if isinstance(epoch_dataset, DevicePrefetchIterator):
+            return epoch_dataset.state_dict
+        return getattr(wrapped_dataset, 'get_state_dict', lambda: None)()
+
     def save_checkpoint(train_state, milestone=False):
         step = int(jax.device_get(train_state.step))
         metadata = dict(
@@ -234,6 +258,7 @@ def main(argv):
             train_state=train_state,
             gather_fns=gather_fns,
             metadata=metadata,
+            dataset=dataset_state(),
             milestone=milestone,
         )
 
@@ -273,15 +298,20 @@ def main(argv):
             step_counter = trange(start_step, FLAGS.total_steps, ncols=0, position=1)
 
         overall_step = 0
+        epoch_dataset = dataset
         for epoch in epoch_counter:
-            for step, batch in zip(step_counter, dataset):
+            epoch_dataset = dataset
+            if prefetch_batches > 0:
+                epoch_dataset = DevicePrefetchIterator(
+                    dataset, mesh, prefetch_size=prefetch_batches,
+                    process_local=FLAGS.train_dataset.shard_by_process,
+                    state_fn=getattr(wrapped_dataset, 'get_state_dict', None),
+                )
+            for step, batch in zip(step_counter, epoch_dataset):
+                dataset_metrics = {}
                 if isinstance(batch, (list, tuple)):
-                    batch = {
-                        'input_tokens': batch['input_tokens'],
-                        'attention_mask': batch['attention_mask'],
-                        'loss_masks': batch['loss_masks'],
-                        'target_tokens': batch['target_tokens'],
-                    }
+                    # streaming datasets yield (batch, dataset_metrics) pairs
+                    batch, dataset_metrics = batch
                 # just measuring the train step time.
                 start_time = time.time()
                 train_state, sharded_rng, metrics = sharded_train_step(
@@ -312,6 +342,10 @@ def main(argv):
                     }
                     log_metrics = jax.device_get(log_metrics)
                     log_metrics.update(metrics)
+                    log_metrics.update(dataset_metrics)
+                    if prefetch_batches > 0:
+                        log_metrics.update(epoch_dataset.metrics)
+                    log_metrics.update(checkpointer.metrics)
                     log_metrics = {k: float(v) for k, v in log_metrics.items()}
                     logger.log(log_metrics)
                     tqdm.write("\n" + pprint.pformat(log_metrics) + "\n")
@@ -320,6 +354,11 @@ def main(argv):
                     save_checkpoint(train_state, milestone=True)
                 elif FLAGS.save_model_freq > 0 and (step + 1) % FLAGS.save_model_freq == 0:
                     save_checkpoint(train_state)
+            if prefetch_batches > 0:
+                epoch_dataset.close()
+                if epoch_dataset.state_dict is not None:
+                    # rewind the dataset over the batches prefetched but not trained on
+                    wrapped_dataset.load_state_dict(epoch_dataset.state_dict)
             # save model at the end of each epoch
             if FLAGS.save_model_freq > 0:
                 save_checkpoint(train_state, milestone=True)
@@ -338,6 +377,7 @@ def main(argv):
             tqdm.write("\n" + pprint.pformat(log_metrics) + "\n")
         if True:#FLAGS.save_model_freq > 0:
             save_checkpoint(train_state, milestone=True)
+        checkpointer.wait_for_saves()
 
 
 if __name__ == "__main__":
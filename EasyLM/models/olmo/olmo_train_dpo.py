@@ -7,23 +7,28 @@ import math
 import time
 
 from tqdm import tqdm, trange
+import numpy as np
 import mlxu
 
 import jax
 import jax.numpy as jnp
+from jax.experimental import multihost_utils
 from jax.experimental.pjit import pjit
 from jax.sharding import PartitionSpec as PS
 from flax.training.train_state import TrainState
 import torch
 
-from EasyLM.data import DatasetFactory, pad_out_to_full_batch
+from EasyLM.data import (
+    DatasetFactory, ReferenceLogps, ReferenceLogpsCache, pad_out_to_full_batch,
+    length_bucket_batch_shapes,
+)
 from EasyLM.checkpoint import StreamingCheckpointer
 from EasyLM.optimizers import OptimizerFactory
 from EasyLM.jax_utils import (
     JaxRNG, JaxDistributedConfig, next_rng, match_partition_rules,
     global_norm, get_float_dtype_by_name, set_random_seed,
     get_weight_decay_mask, make_shard_and_gather_fns,
-    with_sharding_constraint
+    with_sharding_constraint, DevicePrefetchIterator
 )
 from EasyLM.models.olmo.olmo_model import (
     OLMoConfig, FlaxOLMoForCausalLMModule, OlmoTokenizer
@@ -46,6 +51,7 @@ FLAGS, FLAGS_DEF = mlxu.define_flags_with_default(
     save_milestone_freq=0,
     eval_steps=0,
     num_epochs=0,
+    prefetch_batches=0,
     tokenizer='',
     train_dataset=DatasetFactory.get_default_config(),
     eval_dataset=DatasetFactory.get_default_config(),
@@ -59,6 +65,7 @@ FLAGS, FLAGS_DEF = mlxu.define_flags_with_default(
     dpo_label_smoothing=0.0,  # label smoothing for constrained DPO
     use_ipo=False,  # use IPO instead of DPO
     precalculate_reference_logps=False,  # precalculate reference logps, speeds up training and saves memory.
+    reference_logps_cache_dir='',  # cache precalculated reference logps here, shared across runs.
 )
 
 
@@ -182,8 +189,10 @@ def main(argv):
     real_batch_size = wrapped_dataset.config.batch_size
     # for the scheduler, which only gets updated with 'real' grad steps
     simulated_batch_size = real_batch_size * FLAGS.optimizer.accumulate_gradient_steps
-    steps_per_epoch = len(wrapped_dataset) // real_batch_size
-    simulated_steps_per_epoch = len(wrapped_dataset) // simulated_batch_size
+    # with shard_by_process, each host only holds 1/num_shards of the examples
+    num_examples = len(wrapped_dataset) * getattr(wrapped_dataset, 'num_shards', 1)
+    steps_per_epoch = num_examples // real_batch_size
+    simulated_steps_per_epoch = num_examples // simulated_batch_size
     print(f"Make sure your scheduler steps are based on the simulated batch size: {simulated_batch_size}!")
     print(f"Total simulated steps: {simulated_steps_per_epoch * FLAGS.num_epochs}")
 
@@ -292,10 +301,18 @@ def main(argv):
         donate_argnums=(0, ),
     )
 
+    prefetch_batches = FLAGS.prefetch_batches
+    if FLAGS.train_dataset.shard_by_process:
+        # each host loads only its slice of the batch, and the prefetcher
+        # assembles the slices into global arrays.
+        prefetch_batches = max(prefetch_batches, 1)
+    # prefetched batches are already placed on device with batch sharding
+    batch_partition = PS(('dp', 'fsdp')) if prefetch_batches > 0 else PS()
     if not FLAGS.precalculate_reference_logps:
-        in_shardings = (train_state_partition, PS(), PS(), PS(), train_state_partition)
+        in_shardings = (train_state_partition, PS(), batch_partition, PS(), train_state_partition)
     else:
-        in_shardings = (train_state_partition, PS(), PS(), PS(), PS())
+        # precalculated reference logps are sharded like the batch
+        in_shardings = (train_state_partition, PS(), batch_partition, batch_partition, PS())
     sharded_train_step = pjit(
         train_step,
         in_shardings=in_shardings,
@@ -306,8 +323,8 @@ def main(argv):
     no_model_concate_forward = lambda train_state, rng, batch: concatenated_forward(model, train_state, rng, batch, train=False)
     sharded_concatenated_forward = pjit(
         no_model_concate_forward,
-        in_shardings=(params_partition, PS(), PS()),
-        out_shardings=(PS(), PS()),
+        in_shardings=(params_partition, PS(), batch_partition),
+        out_shardings=(batch_partition, batch_partition),
     )
 
     def save_checkpoint(train_state, milestone=False):
@@ -366,36 +383,93 @@ def main(argv):
                 reference_train_state = sharded_create_trainstate_from_params(reference_params)
                 del reference_params
         else:
-            # run an epoch to precalculate policy logps
-            print("Precalculating policy logps...")
-            all_reference_chosen_logps = []
-            all_reference_rejected_logps = []
-            # re-create a dataloader without shuffling so we can reference
-            # using indices later.
-            from torch.utils.data import DataLoader
-            from transformers.data.data_collator import numpy_default_data_collator
-            no_shuffle_dataset = DataLoader(
-                dataset.dataset,
-                batch_size=dataset.batch_size,
-                num_workers=dataset.num_workers,
-                shuffle=False,
-                collate_fn=numpy_default_data_collator,
-            )
-            for batch in tqdm(no_shuffle_dataset):
-                batch.pop('indices')
-                if batch['chosen_input_ids'].shape[0] < real_batch_size:
-                    batch = pad_out_to_full_batch(real_batch_size, batch)
-                rng = next_rng()
-                rng_generator = JaxRNG(rng)
-                # rng shouldnt matter here since i think?
-                reference_chosen_logps, reference_rejected_logps = sharded_concatenated_forward(
-                    train_state.params, rng_generator(olmo_config.rng_keys()), batch
+            if FLAGS.load_reference_checkpoint != '':
+                reference_checkpoint = FLAGS.load_reference_checkpoint
+            else:
+                reference_checkpoint = FLAGS.load_checkpoint
+            if FLAGS.reference_logps_cache_dir != '':
+                reference_cache = ReferenceLogpsCache(
+                    FLAGS.reference_logps_cache_dir, wrapped_dataset,
+                    reference_checkpoint, extra=FLAGS.dtype, seed=FLAGS.seed,
+                )
+                cache_found = reference_cache.load()
+            else:
+                reference_cache = ReferenceLogps()
+                cache_found = False
+            if jax.process_count() > 1:
+                # the forward pass is collective, so all hosts must agree
+                cache_found = bool(np.all(multihost_utils.process_allgather(np.array(cache_found))))
+
+            if not cache_found:
+                # run an epoch to precalculate reference logps
+                print("Precalculating reference logps...")
+                if FLAGS.load_reference_checkpoint != '':
+                    _, reference_params = checkpointer.load_trainstate_checkpoint(
+                        reference_checkpoint, train_state_shapes, shard_fns
+                    )
+                else:
+                    reference_params = train_state.params
+                # re-create a dataloader without shuffling so we can reference
+                # using indices later. with shard_by_process, every host only
+                # computes the logps of its own examples.
+                from torch.utils.data import DataLoader
+                from transformers.data.data_collator import numpy_default_data_collator
+                local_batch_size = getattr(wrapped_dataset, 'local_batch_size', real_batch_size)
+                no_shuffle_dataset = DataLoader(
+                    wrapped_dataset,
+                    batch_size=local_batch_size,
+                    num_workers=wrapped_dataset.config.num_workers,
+                    shuffle=False,
+                    collate_fn=numpy_default_data_collator,
+                )
+
+                def padded_batches():
+                    for batch in no_shuffle_dataset:
+                        indices = batch.pop('indices').reshape(-1)
+                        if indices.shape[0] < local_batch_size:
+                            batch = jax.device_get(pad_out_to_full_batch(local_batch_size, batch))
+                            # padding examples are dropped from the results
+                            indices = np.pad(indices, (0, local_batch_size - indices.shape[0]), constant_values=-1)
+                        batch['indices'] = indices
+                        yield batch
+
+                reference_batches = padded_batches()
+                if prefetch_batches > 0:
+                    reference_batches = DevicePrefetchIterator(
+                        reference_batches, mesh, prefetch_size=prefetch_batches,
+                        process_local=FLAGS.train_dataset.shard_by_process,
+                        host_keys=('indices', ),
+                    )
+                all_indices, all_reference_chosen_logps, all_reference_rejected_logps = [], [], []
+                for batch in tqdm(reference_batches, total=len(no_shuffle_dataset)):
+                    indices = batch.pop('indices')
+                    rng_generator = JaxRNG(next_rng())
+                    reference_chosen_logps, reference_rejected_logps = sharded_concatenated_forward(
+                        reference_params, rng_generator(olmo_config.rng_keys()), batch
+                    )
+                    if FLAGS.train_dataset.shard_by_process:
+                        reference_chosen_logps, reference_rejected_logps = multihost_utils.global_array_to_host_local_array(
+                            (reference_chosen_logps, reference_rejected_logps), mesh, batch_partition
+                        )
+                    reference_chosen_logps, reference_rejected_logps = jax.device_get(
+                        (reference_chosen_logps, reference_rejected_logps)
+                    )
+                    valid = indices >= 0
+                    all_indices.append(indices[valid])
+                    all_reference_chosen_logps.append(reference_chosen_logps[valid])
+                    all_reference_rejected_logps.append(reference_rejected_logps[valid])
+                if prefetch_batches > 0:
+                    reference_batches.close()
+                if FLAGS.load_reference_checkpoint != '':
+                    del reference_params
+                reference_cache.update(
+                    np.concatenate(all_indices),
+                    np.concatenate(all_reference_chosen_logps),
+                    np.concatenate(all_reference_rejected_logps),
                 )
-                all_reference_chosen_logps.append(jax.device_get(reference_chosen_logps))
-                all_reference_rejected_logps.append(jax.device_get(reference_rejected_logps))
-                del reference_chosen_logps, reference_rejected_logps
-            all_reference_chosen_logps = jnp.concatenate(all_reference_chosen_logps, axis=0)
-            all_reference_rejected_logps = jnp.concatenate(all_reference_rejected_logps, axis=0)                
+                if FLAGS.reference_logps_cache_dir != '' and (
+                        reference_cache.num_shards > 1 or jax.process_index() == 0):
+                    reference_cache.save()
 
         start_step = int(jax.device_get(train_state.step))
         start_epoch = start_step // steps_per_epoch
@@ -403,6 +477,30 @@ def main(argv):
 
         sharded_rng = next_rng()
 
+        # with length buckets, compile the train step once per bucket up front
+        # so that the number of compilations is bounded by the bucket count.
+        compiled_train_steps = None
+        if getattr(wrapped_dataset, 'length_buckets', None) is not None:
+            compiled_train_steps = {}
+            bucket_batch_shapes = length_bucket_batch_shapes(wrapped_dataset, real_batch_size)
+            for bucket_length, batch_shapes in bucket_batch_shapes.items():
+                print(f"Compiling train step for length bucket {bucket_length}...")
+                # indices are popped from the batch before the train step
+                batch_shapes.pop('indices', None)
+                if FLAGS.precalculate_reference_logps:
+                    reference_logps_shapes = (
+                        jax.ShapeDtypeStruct((real_batch_size, ), np.float32),
+                        jax.ShapeDtypeStruct((real_batch_size, ), np.float32),
+                    )
+                    step_reference_train_state = None
+                else:
+                    reference_logps_shapes = None
+                    step_reference_train_state = reference_train_state
+                compiled_train_steps[bucket_length] = sharded_train_step.lower(
+                    train_state, sharded_rng, batch_shapes,
+                    reference_logps_shapes, step_reference_train_state,
+                ).compile()
+
         if FLAGS.num_epochs > 0:
             epoch_counter = trange(start_epoch, FLAGS.num_epochs, ncols=0, position=0)
             step_counter = trange(start_step, steps_per_epoch, ncols=0, position=1)
@@ -412,18 +510,33 @@ def main(argv):
 
         overall_step = 0
         for epoch in epoch_counter:
-            for step, batch in zip(step_counter, dataset):
+            epoch_dataset = dataset
+            if prefetch_batches > 0:
+                epoch_dataset = DevicePrefetchIterator(
+                    dataset, mesh, prefetch_size=prefetch_batches,
+                    process_local=FLAGS.train_dataset.shard_by_process,
+                    host_keys=('indices', ),
+                )
+            for step, batch in zip(step_counter, epoch_dataset):
+                # indices stay on host, they are only used to look up reference logps
+                indices = batch.pop('indices')
                 start_time = time.time()
                 if FLAGS.precalculate_reference_logps:
                     reference_train_state = None
                     # gather based on indices in batch
-                    reference_chosen_logps = all_reference_chosen_logps[batch['indices']].squeeze(1)
-                    reference_rejected_logps = all_reference_rejected_logps[batch['indices']].squeeze(1)
-                    reference_logps = (reference_chosen_logps, reference_rejected_logps)
+                    reference_logps = reference_cache(indices)
+                    if FLAGS.train_dataset.shard_by_process:
+                        reference_logps = multihost_utils.host_local_array_to_global_array(
+                            reference_logps, mesh, batch_partition
+                        )
                 else:
                     reference_logps = None
 
-                train_state, sharded_rng, metrics = sharded_train_step(
+                if compiled_train_steps is not None:
+                    train_step_fn = compiled_train_steps[batch['chosen_input_ids'].shape[1]]
+                else:
+                    train_step_fn = sharded_train_step
+                train_state, sharded_rng, metrics = train_step_fn(
                     train_state, sharded_rng, batch, reference_logps, reference_train_state
 
                 )
@@ -439,6 +552,9 @@ def main(argv):
                     }
                     log_metrics = jax.device_get(log_metrics)
                     log_metrics.update(metrics)
+                    if prefetch_batches > 0:
+                        log_metrics.update(epoch_dataset.metrics)
+                    log_metrics.update(checkpointer.metrics)
                     log_metrics = {k: float(v) for k, v in log_metrics.items()}
                     logger.log(log_metrics)
                     tqdm.write("\n" + pprint.pformat(log_metrics) + "\n")
@@ -447,6 +563,8 @@ def main(argv):
                     save_checkpoint(train_state, milestone=True)
                 elif FLAGS.save_model_freq > 0 and (step + 1) % FLAGS.save_model_freq == 0:
                     save_checkpoint(train_state)
+            if prefetch_batches > 0:
+                epoch_dataset.close()
             # save model at the end of each epoch
             if FLAGS.save_model_freq > 0:
                 save_checkpoint(train_state, milestone=True)
@@ -464,6 +582,7 @@ def main(argv):
             logger.log(log_metrics)
             tqdm.write("\n" + pprint.pformat(log_metrics) + "\n")
         save_checkpoint(train_state, milestone=True)
+        checkpointer.wait_for_saves()
 
 
 if __name__ == "__main__":
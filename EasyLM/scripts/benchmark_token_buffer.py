@@ -0,0 +1,84 @@
+# This script benchmarks the batch assembly of the streaming datasets, comparing
+# the python list buffer previously used by the huggingface and JSON datasets
+# against the preallocated numpy TokenBuffer. Examples are random token lists,
+# so only the buffering and batching cost is measured, not tokenization.
+
+from time import time
+
+import numpy as np
+import mlxu
+
+from EasyLM.data import TokenBuffer
+
+
+FLAGS, _ = mlxu.define_flags_with_default(
+    seed=42,
+    seq_length=8192,
+    batch_size=64,
+    mean_example_length=2048,
+    num_batches=20,
+)
+
+
+def list_buffer_batches(examples, batch_size, seq_length):
+    chunk_size = batch_size * seq_length
+    token_buffer = []
+    loss_mask_buffer = []
+    for tokens, loss_masks in examples:
+        token_buffer.extend(tokens)
+        loss_mask_buffer.extend(loss_masks)
+        while len(token_buffer) > chunk_size + 1:
+            batch = {
+                'input_tokens': np.array(token_buffer[:chunk_size], dtype=np.int32).reshape(
+                    batch_size, -1
+                ),
+                'target_tokens': np.array(token_buffer[1:chunk_size + 1], dtype=np.int32).reshape(
+                    batch_size, -1
+                ),
+                'loss_masks': np.array(loss_mask_buffer[1:chunk_size + 1], dtype=np.float32).reshape(
+                    batch_size, -1
+                ),
+            }
+            yield batch
+            token_buffer = token_buffer[chunk_size:]
+            loss_mask_buffer = loss_mask_buffer[chunk_size:]
+
+
+def token_buffer_batches(examples, batch_size, seq_length):
+    chunk_size = batch_size * seq_length
+    buffer = TokenBuffer(2 * (chunk_size + 1))
+    for tokens, loss_masks in examples:
+        buffer.extend(tokens, loss_masks)
+        while len(buffer) > chunk_size + 1:
+            yield buffer.take_batch(batch_size, seq_length)
+
+
+def main(argv):
+    rng = np.random.default_rng(FLAGS.seed)
+    num_tokens = (FLAGS.num_batches + 1) * FLAGS.batch_size * FLAGS.seq_length
+    examples = []
+    total = 0
+    while total < num_tokens:
+        length = int(rng.integers(1, 2 * FLAGS.mean_example_length))
+        # the text processor returns python lists
+        examples.append((
+            rng.integers(0, 32000, length).tolist(),
+            rng.integers(0, 2, length).astype(np.float32).tolist(),
+        ))
+        total += length
+
+    results = {}
+    for name, batch_fn in [('list', list_buffer_batches), ('numpy', token_buffer_batches)]:
+        start_time = time()
+        batches = 0
+        for batch in batch_fn(examples, FLAGS.batch_size, FLAGS.seq_length):
+            batches += 1
+        elapsed = time() - start_time
+        results[name] = elapsed / (batches * FLAGS.batch_size * FLAGS.seq_length)
+        print(f'{name} buffer: {batches} batches in {elapsed:.3f}s, {results[name] * 1e9:.2f} ns per token')
+
+    print(f'Speedup: {results["list"] / results["numpy"]:.2f}x')
+
+
+if __name__ == "__main__":
+    mlxu.run(main)
@@ -0,0 +1,95 @@
+# This script benchmarks the tulu chat format tokenization used by the
+# tulu_json_torch and preference_json_torch datasets. It compares the
+# reference implementation, which re-tokenizes every message prefix, against
+# the offset mapping implementation without the check against the reference,
+# and counts the examples where their tokens, labels or truncation flags
+# differ. With 0 mismatches on your data and tokenizer, the check can be
+# turned off with json_torch_dataset.check_tokenization=False.
+
+import os
+import json
+from time import time
+
+import mlxu
+from transformers import AutoTokenizer
+
+from EasyLM.data import TuluJsonTorchDataset
+
+
+FLAGS, _ = mlxu.define_flags_with_default(
+    input_file='',
+    messages_field='messages',
+    tokenizer='',
+    seq_length=4096,
+    only_train_last_message=False,
+    num_examples=2000,
+    batch_size=1000,
+)
+
+
+def load_conversations(path, field, num_examples):
+    conversations = []
+    with mlxu.open_file(path, 'r') as fin:
+        for line in fin:
+            if not line or line == '\n':
+                continue
+            conversations.append(json.loads(line)[field])
+            if len(conversations) >= num_examples:
+                break
+    return conversations
+
+
+def main(argv):
+    assert FLAGS.input_file != '', 'input_file must be specified'
+    tokenizer = AutoTokenizer.from_pretrained(FLAGS.tokenizer, use_auth_token=os.getenv('HF_TOKEN', None))
+    conversations = load_conversations(
+        FLAGS.input_file, FLAGS.messages_field, FLAGS.num_examples
+    )
+    num_turns = sum(len(x) for x in conversations) / len(conversations)
+    print(f'Loaded {len(conversations)} conversations, {num_turns:.2f} messages on average')
+
+    start_time = time()
+    reference = [
+        TuluJsonTorchDataset._encode_with_messages_format_by_prefix(
+            messages, tokenizer, FLAGS.seq_length, FLAGS.only_train_last_message
+        )
+        for messages in conversations
+    ]
+    reference_time = time() - start_time
+
+    start_time = time()
+    single = [
+        TuluJsonTorchDataset.encode_with_messages_format(
+            messages, tokenizer, FLAGS.seq_length, FLAGS.only_train_last_message,
+            check=False,
+        )
+        for messages in conversations
+    ]
+    single_time = time() - start_time
+
+    start_time = time()
+    batched = []
+    for i in range(0, len(conversations), FLAGS.batch_size):
+        batched.extend(TuluJsonTorchDataset.encode_batch_with_messages_format(
+            conversations[i:i + FLAGS.batch_size], tokenizer,
+            FLAGS.seq_length, FLAGS.only_train_last_message, check=False,
+        ))
+    batched_time = time() - start_time
+
+    mismatches = 0
+    for ref, x, y in zip(reference, single, batched):
+        for output in (x, y):
+            if (ref[0].tolist() != output[0].tolist()
+                    or ref[1].tolist() != output[1].tolist()
+                    or ref[3] != output[3]):
+                mismatches += 1
+                break
+
+    print(f'Prefix tokenization: {reference_time:.3f}s')
+    print(f'Offset tokenization: {single_time:.3f}s ({reference_time / single_time:.2f}x)')
+    print(f'Batched offset tokenization: {batched_time:.3f}s ({reference_time / batched_time:.2f}x)')
+    print(f'Mismatched examples: {mismatches} / {len(conversations)}')
+
+
+if __name__ == "__main__":
+    mlxu.run(main)
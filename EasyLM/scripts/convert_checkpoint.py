@@ -18,6 +18,10 @@ FLAGS, FLAGS_DEF = mlxu.define_flags_with_default(
     load_checkpoint='',
     output_file='',
     streaming=False,
+    sharded=False,
+    compression='',
+    quantization='',
+    quantization_block_size=128,
     float_dtype='bf16',
 )
 
@@ -28,7 +32,14 @@ def main(argv):
         FLAGS.load_checkpoint, disallow_trainstate=True
     )[1]['params']
 
-    if FLAGS.streaming:
+    if FLAGS.sharded:
+        StreamingCheckpointer.save_train_state_to_dir(
+            params, FLAGS.output_file, float_dtype=FLAGS.float_dtype,
+            compression=FLAGS.compression or None,
+            quantization=FLAGS.quantization or None,
+            quantization_block_size=FLAGS.quantization_block_size,
+        )
+    elif FLAGS.streaming:
         StreamingCheckpointer.save_train_state_to_file(
             params, FLAGS.output_file, float_dtype=FLAGS.float_dtype
         )
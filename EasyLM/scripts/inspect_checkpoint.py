@@ -0,0 +1,113 @@
+# This script inspects checkpoints saved by EasyLM in any of the streaming,
+# sharded or distributed formats. The list command only reads the checkpoint
+# index, the stats command prints summary statistics of the selected tensors,
+# and the extract command writes the selected tensors to a new checkpoint.
+# Tensors are selected by matching a regular expression against their names,
+# which are the nested dict keys joined by '/'.
+
+import re
+
+import numpy as np
+import mlxu
+from flax.traverse_util import unflatten_dict
+
+from EasyLM.checkpoint import StreamingCheckpointer
+
+
+FLAGS, FLAGS_DEF = mlxu.define_flags_with_default(
+    checkpoint='',
+    command='list',
+    keys='',
+    output_file='',
+    sharded=False,
+    float_dtype='',
+    io_threads=8,
+)
+
+
+def tensor_name(key):
+    return '/'.join(str(x) for x in key)
+
+
+def format_bytes(nbytes):
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if nbytes < 1024:
+            return f'{nbytes:.1f}{unit}'
+        nbytes /= 1024
+    return f'{nbytes:.1f}TB'
+
+
+def iterate_selected(path, pattern, index):
+    keys_to_ignore = None
+    if index is not None:
+        keys_to_ignore = {
+            x['key'] for x in index if not pattern.search(tensor_name(x['key']))
+        }
+    for key, tensor in StreamingCheckpointer.iterate_checkpoint(
+        path, keys_to_ignore=keys_to_ignore, io_threads=FLAGS.io_threads,
+        use_mmap=True,
+    ):
+        if pattern.search(tensor_name(key)):
+            yield key, tensor
+
+
+def main(argv):
+    assert FLAGS.checkpoint != '', 'checkpoint must be specified'
+    # Accept the same load_checkpoint strings used by the trainers
+    path = FLAGS.checkpoint.split('::', 1)[-1]
+    pattern = re.compile(FLAGS.keys)
+    index = StreamingCheckpointer.load_checkpoint_index(path)
+
+    if FLAGS.command == 'list':
+        assert index is not None, 'Checkpoint has no index, use the stats command instead'
+        total = 0
+        for entry in index:
+            if not pattern.search(tensor_name(entry['key'])):
+                continue
+            size = int(np.prod(entry['shape'])) * np.dtype(entry['dtype']).itemsize
+            total += size
+            print(
+                f'{tensor_name(entry["key"])}  {entry["dtype"]}{list(entry["shape"])}'
+                f'  {format_bytes(size)}'
+            )
+        print(f'Total: {format_bytes(total)}')
+    elif FLAGS.command == 'stats':
+        for key, tensor in iterate_selected(path, pattern, index):
+            tensor = np.asarray(tensor)
+            values = tensor.astype(np.float32)
+            finite = values[np.isfinite(values)]
+            if finite.size == 0:
+                finite = np.zeros(1, dtype=np.float32)
+            print(
+                f'{tensor_name(key)}  {tensor.dtype}{list(tensor.shape)}'
+                f'  mean={finite.mean():.4g} std={finite.std():.4g}'
+                f' min={finite.min():.4g} max={finite.max():.4g}'
+                f' absmax={np.abs(finite).max():.4g}'
+                f' norm={np.sqrt(np.sum(np.square(finite, dtype=np.float64))):.4g}'
+                f' nan={int(np.isnan(values).sum())} inf={int(np.isinf(values).sum())}'
+            )
+    elif FLAGS.command == 'extract':
+        assert FLAGS.output_file != '', 'output_file must be specified'
+        tensors = {
+            key: np.asarray(tensor)
+            for key, tensor in iterate_selected(path, pattern, index)
+        }
+        assert len(tensors) > 0, 'No tensors match the given keys'
+        float_dtype = FLAGS.float_dtype or None
+        if FLAGS.sharded:
+            StreamingCheckpointer.save_train_state_to_dir(
+                unflatten_dict(tensors), FLAGS.output_file,
+                float_dtype=float_dtype, io_threads=FLAGS.io_threads,
+            )
+        else:
+            StreamingCheckpointer.save_train_state_to_file(
+                unflatten_dict(tensors), FLAGS.output_file,
+                float_dtype=float_dtype,
+            )
+        print(f'Extracted {len(tensors)} tensors to {FLAGS.output_file}')
+    else:
+        raise ValueError(f'Unknown command: {FLAGS.command}')
+
+
+if __name__ == "__main__":
+    mlxu.run(main)
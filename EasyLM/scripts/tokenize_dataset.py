@@ -0,0 +1,82 @@
+# This script tokenizes a JSON lines dataset once with the TextProcessor and
+# writes the result as flat token and loss mask arrays, which can then be
+# memory-mapped for training with the 'memmap' dataset type. This removes
+# JSON parsing and tokenization from the training input pipeline entirely.
+
+import os
+import json
+
+import numpy as np
+import mlxu
+from tqdm import tqdm
+from transformers import AutoTokenizer
+
+from EasyLM.data import TextProcessor, JsonTokenizerPool
+
+
+FLAGS, FLAGS_DEF = mlxu.define_flags_with_default(
+    input_file='',
+    output_dir='',
+    tokenizer='',
+    text_processor=TextProcessor.get_default_config(),
+    tokenizer_processes=1,
+    tokenizer_parallel_chunk_bytes=4 * 1024 * 1024,
+)
+
+
+def parse_json_lines(path):
+    with mlxu.open_file(path, 'r') as fin:
+        for line in fin:
+            if not line or line == '\n':
+                continue
+            try:
+                yield json.loads(line)
+            except json.decoder.JSONDecodeError:
+                print(f'Error parsing json line:\n{line}')
+
+
+def main(argv):
+    assert FLAGS.input_file != '' and FLAGS.output_dir != '', 'input and output must be specified'
+    tokenizer = AutoTokenizer.from_pretrained(FLAGS.tokenizer, use_auth_token=os.getenv('HF_TOKEN', None))
+    text_processor = TextProcessor(FLAGS.text_processor, tokenizer)
+    os.makedirs(FLAGS.output_dir, exist_ok=True)
+
+    num_tokens = 0
+    num_examples = 0
+    token_file = open(os.path.join(FLAGS.output_dir, 'tokens.bin'), 'wb')
+    loss_mask_file = open(os.path.join(FLAGS.output_dir, 'loss_masks.bin'), 'wb')
+    offset_file = open(os.path.join(FLAGS.output_dir, 'offsets.bin'), 'wb')
+    if FLAGS.tokenizer_processes > 1:
+        tokenizer_pool = JsonTokenizerPool(
+            text_processor, FLAGS.tokenizer_processes,
+            FLAGS.tokenizer_parallel_chunk_bytes,
+        )
+        examples = (
+            (tokens, loss_masks) for tokens, loss_masks, *_ in
+            tokenizer_pool.iterate(FLAGS.input_file, loop=False)
+        )
+    else:
+        examples = map(text_processor, parse_json_lines(FLAGS.input_file))
+    with token_file, loss_mask_file, offset_file:
+        for tokens, loss_masks in tqdm(examples, ncols=0):
+            offset_file.write(np.array([num_tokens], dtype=np.int64).tobytes())
+            token_file.write(np.asarray(tokens, dtype=np.int32).tobytes())
+            loss_mask_file.write(np.asarray(loss_masks, dtype=np.float32).tobytes())
+            num_tokens += len(tokens)
+            num_examples += 1
+
+    metadata = dict(
+        num_tokens=num_tokens,
+        num_examples=num_examples,
+        token_dtype='int32',
+        loss_mask_dtype='float32',
+        tokenizer=FLAGS.tokenizer,
+        text_processor=FLAGS.text_processor.to_dict(),
+    )
+    with open(os.path.join(FLAGS.output_dir, 'metadata.json'), 'w') as fout:
+        json.dump(metadata, fout, indent=2)
+    print(f'Wrote {num_tokens} tokens from {num_examples} examples to {FLAGS.output_dir}')
+
+
+if __name__ == "__main__":
+    mlxu.run(main)
@@ -1,3 +1,4 @@
+import contextlib
 import dataclasses
 import pprint
 from functools import partial
@@ -37,6 +38,12 @@ class ChatRequest(BaseModel):
 class LMServer(object):
     """ HTTP server for serving langauge models. """
 
+    # Set by model servers whose generate, greedy_until and loglikelihood
+    # batch concurrent calls themselves. These requests are then neither
+    # serialized nor split into batch_size chunks.
+    concurrent_generation = False
+    chat_concurrency = 1
+
     @staticmethod
     def get_default_config(updates=None):
         config = ConfigDict()
@@ -72,6 +79,7 @@ class LMServer(object):
         self.app.post('/greedy-until')(self.serve_greedy_until)
         self.app.post('/chat')(self.serve_chat)
         self.app.get('/ready')(self.serve_ready)
+        self.app.get('/metrics')(self.serve_metrics)
         self.app = gr.mount_gradio_app(self.app, self.create_chat_app(), '/')
 
     @staticmethod
@@ -90,6 +98,10 @@ class LMServer(object):
     def greedy_until(prefix_text, until, max_length):
         raise NotImplementedError()
 
+    @staticmethod
+    def metrics():
+        return {}
+
     @staticmethod
     def to_list(x):
         if isinstance(x, np.ndarray):
@@ -99,8 +111,16 @@ class LMServer(object):
     def serve_ready(self):
         return 'Ready!\n'
 
+    def serve_metrics(self):
+        return self.metrics()
+
+    def generation_lock(self):
+        if self.concurrent_generation:
+            return contextlib.nullcontext()
+        return self.lock
+
     def serve_loglikelihood(self, data: InferenceRequest):
-        with self.lock:
+        with self.generation_lock():
             if self.config.logging:
                 absl.logging.info(
                     '\n========= Serving Log Likelihood Request ========= \n'
@@ -121,23 +141,28 @@ class LMServer(object):
 
             log_likelihood = []
             is_greedy = []
-            for i in trange(0, len(text), self.config.batch_size, ncols=0):
-                batch_prefix_text = prefix_text[i:i + self.config.batch_size]
-                batch_text = text[i:i + self.config.batch_size]
-                batch_size = len(batch_text)
-
-                if batch_size < self.config.batch_size:
-                    extra = self.config.batch_size - batch_size
-                    batch_prefix_text.extend(['a' for _ in range(extra)])
-                    batch_text.extend(['a' for _ in range(extra)])
-
-                batch_log_likelihood, batch_is_greedy = self.loglikelihood(
-                    batch_prefix_text, batch_text
-                )
-                batch_log_likelihood = self.to_list(batch_log_likelihood)
-                batch_is_greedy = self.to_list(batch_is_greedy)
-                log_likelihood.extend(batch_log_likelihood[:batch_size])
-                is_greedy.extend(batch_is_greedy[:batch_size])
+            if self.concurrent_generation:
+                log_likelihood, is_greedy = self.loglikelihood(prefix_text, text)
+                log_likelihood = self.to_list(log_likelihood)
+                is_greedy = self.to_list(is_greedy)
+            else:
+                for i in trange(0, len(text), self.config.batch_size, ncols=0):
+                    batch_prefix_text = prefix_text[i:i + self.config.batch_size]
+                    batch_text = text[i:i + self.config.batch_size]
+                    batch_size = len(batch_text)
+
+                    if batch_size < self.config.batch_size:
+                        extra = self.config.batch_size - batch_size
+                        batch_prefix_text.extend(['a' for _ in range(extra)])
+                        batch_text.extend(['a' for _ in range(extra)])
+
+                    batch_log_likelihood, batch_is_greedy = self.loglikelihood(
+                        batch_prefix_text, batch_text
+                    )
+                    batch_log_likelihood = self.to_list(batch_log_likelihood)
+                    batch_is_greedy = self.to_list(batch_is_greedy)
+                    log_likelihood.extend(batch_log_likelihood[:batch_size])
+                    is_greedy.extend(batch_is_greedy[:batch_size])
 
             output = {
                 'prefix_text': data.prefix_text,
@@ -197,7 +222,7 @@ class LMServer(object):
         return output
 
     def serve_generate(self, data: InferenceRequest):
-        with self.lock:
+        with self.generation_lock():
             if self.config.logging:
                 absl.logging.info(
                     '\n========= Serving Generate Request ========= \n'
@@ -212,19 +237,24 @@ class LMServer(object):
                 data.temperature = self.config.default_temperature
 
             output_text = []
-            for i in trange(0, len(prefix_text), self.config.batch_size, ncols=0):
-                batch_prefix_text = prefix_text[i:i + self.config.batch_size]
-                batch_size = len(batch_prefix_text)
+            if self.concurrent_generation:
+                output_text = self.to_list(
+                    self.generate(prefix_text, temperature=data.temperature)
+                )
+            else:
+                for i in trange(0, len(prefix_text), self.config.batch_size, ncols=0):
+                    batch_prefix_text = prefix_text[i:i + self.config.batch_size]
+                    batch_size = len(batch_prefix_text)
 
-                if batch_size < self.config.batch_size:
-                    extra = self.config.batch_size - batch_size
-                    batch_prefix_text.extend(['a' for _ in range(extra)])
+                    if batch_size < self.config.batch_size:
+                        extra = self.config.batch_size - batch_size
+                        batch_prefix_text.extend(['a' for _ in range(extra)])
 
-                batch_output_text = self.generate(
-                    batch_prefix_text,
-                    temperature=data.temperature,
-                )
-                output_text.extend(self.to_list(batch_output_text)[:batch_size])
+                    batch_output_text = self.generate(
+                        batch_prefix_text,
+                        temperature=data.temperature,
+                    )
+                    output_text.extend(self.to_list(batch_output_text)[:batch_size])
 
             output = {
                 'prefix_text': data.prefix_text,
@@ -239,7 +269,7 @@ class LMServer(object):
         return output
 
     def serve_greedy_until(self, data: InferenceRequest):
-        with self.lock:
+        with self.generation_lock():
             if self.config.logging:
                 absl.logging.info(
                     '\n========= Serving Greedy Until Request ========= \n'
@@ -253,13 +283,18 @@ class LMServer(object):
             max_length = self.config.greedy_until_max_length
 
             output_text = []
-            for i in range(0, len(prefix_text), self.config.batch_size):
-                batch_prefix_text = prefix_text[i:i + self.config.batch_size]
-                batch_until = until[i:i + self.config.batch_size]
-                batch_size = len(batch_prefix_text)
+            if self.concurrent_generation:
+                output_text = self.to_list(
+                    self.greedy_until(prefix_text, until, max_length)
+                )
+            else:
+                for i in range(0, len(prefix_text), self.config.batch_size):
+                    batch_prefix_text = prefix_text[i:i + self.config.batch_size]
+                    batch_until = until[i:i + self.config.batch_size]
+                    batch_size = len(batch_prefix_text)
 
-                batch_output_text = self.greedy_until(batch_prefix_text, batch_until, max_length)
-                output_text.extend(self.to_list(batch_output_text)[:batch_size])
+                    batch_output_text = self.greedy_until(batch_prefix_text, batch_until, max_length)
+                    output_text.extend(self.to_list(batch_output_text)[:batch_size])
 
             output = {
                 'prefix_text': data.prefix_text,
@@ -400,7 +435,7 @@ class LMServer(object):
                 queue=False
             )
 
-        gradio_chatbot.queue(concurrency_count=1)
+        gradio_chatbot.queue(concurrency_count=self.chat_concurrency)
         return gradio_chatbot
 
     def run(self):
@@ -34,6 +34,8 @@ h5py
 ml_collections
 wandb==0.13.5
 gcsfs>=2022.11.0
+zstandard
+lz4
 requests
 typing-extensions
 lm-eval==0.3.0